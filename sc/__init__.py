@@ -29,6 +29,7 @@ def set_constants():
     tmp_dir = base_dir / 'tmp'
     webassets_manifest_path = db_dir / 'webassets' / 'manifest'
     webassets_cache_dir = db_dir / 'webassets' / 'cache'
+    jinja2_bytecode_cache_dir = db_dir / 'jinja2'
     indexer_dir = base_dir / 'elasticsearch' / 'indexers'
     
     text_image_source_dir = base_dir / 'text_images'
@@ -30,3 +30,8 @@ def setup(test=False):
     cherrypy.engine.autoreload.match = r'^(?!plumbum).+'
 
     logger.setup()
+
+    # Compile the templates now rather than on the first requests.
+    if config.precompile_templates and not test:
+        from sc import views
+        views.precompile_templates()
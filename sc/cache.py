@@ -1,6 +1,11 @@
+import sys
 import cherrypy
+import threading
+from collections import OrderedDict, namedtuple
 from cherrypy.lib.caching import MemoryCache
 
+import sc
+
 class Cache(MemoryCache):
     """ Cache that only caches certain pages
 
@@ -44,3 +49,105 @@ class Cache(MemoryCache):
                 return False
 
         return super().get()
+
+_TextPageEntry = namedtuple('_TextPageEntry', 'validator page size')
+
+class TextPageCache:
+    """ Cache of rendered pages, bounded by their total size
+
+    Pages are cached under a key which identifies the variant of the page
+    and stored with a validator (for example the file mtime and IMM
+    generation), a page is only returned if the validator matches. The
+    views store pages gzipped, so that they can be sent as they are.
+
+    This is a segmented LRU: a new page goes into the probationary
+    segment and is promoted to the protected segment when it is hit
+    again. Pages are evicted from the probationary segment first, so
+    crawlers requesting each text once only evict each other rather than
+    the pages which are actually being read.
+
+    """
+    # The fraction of max_bytes which the protected segment may use.
+    PROTECTED_FRACTION = 0.8
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._probation_bytes = 0
+        self._protected_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _pop(self, key):
+        entry = self._probation.pop(key, None)
+        if entry is not None:
+            self._probation_bytes -= entry.size
+            return entry
+        entry = self._protected.pop(key, None)
+        if entry is not None:
+            self._protected_bytes -= entry.size
+        return entry
+
+    def get(self, key, validator):
+        """ Returns the cached page or None """
+        with self._lock:
+            entry = self._pop(key)
+            if entry is None or entry.validator != validator:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._protected[key] = entry
+            self._protected_bytes += entry.size
+            protected_max = self.max_bytes * self.PROTECTED_FRACTION
+            while self._protected_bytes > protected_max:
+                demoted_key, demoted = self._protected.popitem(last=False)
+                self._protected_bytes -= demoted.size
+                self._probation[demoted_key] = demoted
+                self._probation_bytes += demoted.size
+            self._evict()
+            return entry.page
+
+    def put(self, key, validator, page):
+        size = sys.getsizeof(page)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._probation[key] = _TextPageEntry(validator, page, size)
+            self._probation_bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self._probation_bytes + self._protected_bytes > self.max_bytes:
+            if self._probation:
+                key, entry = self._probation.popitem(last=False)
+                self._probation_bytes -= entry.size
+            else:
+                key, entry = self._protected.popitem(last=False)
+                self._protected_bytes -= entry.size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._probation.clear()
+            self._protected.clear()
+            self._probation_bytes = 0
+            self._protected_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0,
+                'evictions': self.evictions,
+                'entries': len(self._probation) + len(self._protected),
+                'bytes': self._probation_bytes + self._protected_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+text_page_cache = TextPageCache(sc.config.text_page_cache_mb * 1024 * 1024)
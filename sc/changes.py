@@ -0,0 +1,160 @@
+""" Shared change detection for the periodic updaters
+
+Rather than each updater globbing and stating the whole text tree, a
+DirectoryWatcher keeps a snapshot of the tree and is polled once per
+update cycle (before the other updaters run). Subscribers are called
+with a Changeset of the paths, relative to the watched directory, which
+were added, changed or deleted since the last poll.
+
+Adding, removing or replacing a file (which is how git updates a
+checkout) changes the mtime of its directory, so only the directories
+whose mtime moved are listed again. A file which is modified in place
+does not change its directory's mtime, so the known files are stated
+on every poll.
+
+"""
+
+import os
+import stat
+import pathlib
+import threading
+import logging
+from collections import namedtuple
+
+import sc
+
+logger = logging.getLogger(__name__)
+
+FileStat = namedtuple('FileStat', 'mtime_ns size')
+
+Changeset = namedtuple('Changeset', 'added changed deleted')
+
+class DirectoryWatcher:
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        # Directory (path relative to root, '' for the root itself)
+        # to (mtime_ns, filenames, subdirs)
+        self._dirs = {}
+        # Path relative to root to FileStat
+        self._files = {}
+        self._subscribers = []
+        self._polls = 0
+        self._max_mtime_ns = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """ Call callback with each non-empty Changeset """
+        self._subscribers.append(callback)
+
+    def stats(self):
+        """ Returns a dict of relative path to FileStat for all files
+
+        The watcher is polled first if it never has been.
+
+        """
+        if not self._polls:
+            self.poll()
+        return self._files
+
+    def max_mtime_ns(self):
+        # Cached for each snapshot of the files, polls replace it.
+        stats = self.stats()
+        cached = self._max_mtime_ns
+        if cached is None or cached[0] is not stats:
+            cached = self._max_mtime_ns = (stats, max(
+                [fstat.mtime_ns for fstat in stats.values()] or [0]))
+        return cached[1]
+
+    def poll(self):
+        """ Detect the changes since the last poll and publish them """
+        with self._lock:
+            self._polls += 1
+            dirs = {}
+            files = dict(self._files)
+            added, changed, deleted = set(), set(), set()
+            self._scan_dir('', dirs, files, added, changed)
+            for path in self._files.keys() - files.keys():
+                deleted.add(path)
+            self._dirs = dirs
+            self._files = files
+            changeset = Changeset(added, changed, deleted)
+        if added or changed or deleted:
+            logger.info('{!s}: {} added, {} changed, {} deleted'.format(
+                self.root, len(added), len(changed), len(deleted)))
+            for callback in self._subscribers:
+                callback(changeset)
+        return changeset
+
+    def _scan_dir(self, relpath, dirs, files, added, changed):
+        path = self.root / relpath
+        try:
+            mtime_ns = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._forget_dir(relpath, files)
+            return
+        old = self._dirs.get(relpath)
+        if old and old[0] == mtime_ns:
+            mtime_ns, filenames, subdirs = old
+            for filename in filenames:
+                self._stat_file(self._join(relpath, filename), files,
+                                added, changed)
+        else:
+            filenames = []
+            subdirs = []
+            for name in sorted(os.listdir(str(path))):
+                try:
+                    fstat = os.stat(str(path / name))
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISDIR(fstat.st_mode):
+                    subdirs.append(name)
+                else:
+                    filenames.append(name)
+                    self._set_stat(self._join(relpath, name), fstat, files,
+                                   added, changed)
+            if old:
+                for filename in set(old[1]).difference(filenames):
+                    files.pop(self._join(relpath, filename), None)
+                for subdir in set(old[2]).difference(subdirs):
+                    self._forget_dir(self._join(relpath, subdir), files)
+        dirs[relpath] = (mtime_ns, filenames, subdirs)
+        for subdir in subdirs:
+            self._scan_dir(self._join(relpath, subdir), dirs, files,
+                           added, changed)
+
+    def _stat_file(self, relpath, files, added, changed):
+        try:
+            fstat = (self.root / relpath).stat()
+        except FileNotFoundError:
+            files.pop(relpath, None)
+            return
+        self._set_stat(relpath, fstat, files, added, changed)
+
+    @staticmethod
+    def _set_stat(relpath, fstat, files, added, changed):
+        new = FileStat(fstat.st_mtime_ns, fstat.st_size)
+        old = files.get(relpath)
+        if old is None:
+            added.add(relpath)
+        elif old != new:
+            changed.add(relpath)
+        files[relpath] = new
+
+    def _forget_dir(self, relpath, files):
+        if not relpath:
+            files.clear()
+            return
+        prefix = relpath + os.sep
+        for path in [path for path in files if path.startswith(prefix)]:
+            del files[path]
+
+    @staticmethod
+    def _join(relpath, name):
+        return os.path.join(relpath, name) if relpath else name
+
+text_watcher = DirectoryWatcher(sc.text_dir)
+table_watcher = DirectoryWatcher(sc.table_dir)
+
+def periodic_update(i):
+    text_watcher.poll()
+    table_watcher.poll()
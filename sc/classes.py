@@ -1,5 +1,7 @@
 import regex
+from array import array
 from collections import namedtuple, Counter
+from collections.abc import Sequence
 from sc.util import ConciseRepr
 
 class Serializable:
@@ -31,7 +33,7 @@ class Serializable:
         result = {}
         for attr in self._serialize_attrs:
             value = getattr(self, attr)
-            if isinstance(value, list):
+            if isinstance(value, (list, ParallelsView)):
                 value = [smart_convert(e) for e in value]
             else:
                 value = smart_convert(value)
@@ -168,10 +170,20 @@ class SuttaCommon(Serializable):
 class Sutta(ConciseRepr, namedtuple('Sutta',
         'uid acronym alt_acronym name vagga_number '
         'number_in_vagga number lang subdivision vagga '
-        'volpage alt_volpage_info biblio_entry '
-        'parallels, imm'), SuttaCommon):
+        'volpage alt_volpage_info biblio_uid '
+        'imm'), SuttaCommon):
     __slots__ = ()
 
+    @property
+    def parallels(self):
+        return self.imm.parallel_graph.get(self.uid)
+
+    @property
+    def biblio_entry(self):
+        # Looked up rather than stored so the biblio table can be
+        # reloaded without rebuilding the suttas.
+        return self.imm.biblios.get(self.biblio_uid)
+
     @property
     def name(self):
         supname = super().name
@@ -191,8 +203,7 @@ class GroupedSutta(SuttaCommon):
     
     """
     
-    __slots__ = {'uid', 'ref_uid', 'volpage', '_textinfo',
-                'parallel_group', 'imm'}
+    __slots__ = {'uid', 'ref_uid', 'volpage', '_textinfo', 'imm'}
     
     no_show_parallels = True
     
@@ -206,6 +217,10 @@ class GroupedSutta(SuttaCommon):
         self.imm = imm
         self._textinfo = imm.tim.get(uid, self.lang.uid)
     
+    @property
+    def parallel_group(self):
+        return self.imm.parallel_groups.get(self)
+    
     @property
     def name(self):
         if self._textinfo and '-pm' not in self.uid and '-vb' not in self.uid:
@@ -357,6 +372,96 @@ class Parallel(ConciseRepr, Serializable, namedtuple('Parallel',
                     "partial": self.partial,
                     "footnote": self.footnote}
 
+class ParallelGraph:
+    """ Compact storage for the parallels between suttas.
+
+    The graph is stored in compressed sparse row form: the edges of the
+    sutta numbered n are at offsets[n]:offsets[n + 1] of the targets,
+    flags and footnote_ids arrays, already in canonical order. Footnotes
+    are interned, as most are empty or repeated.
+
+    Parallel objects are only created when they are accessed, through
+    the ParallelsView returned by get.
+
+    """
+
+    PARTIAL = 1
+    INDIRECT = 2
+
+    def __init__(self, suttas, footnotes, fulls, indirects, partials):
+        """ suttas is a list of the suttas which have parallels, fulls,
+        indirects and partials map a sutta's number to a collection of
+        (target number, footnote number) pairs. """
+        
+        self.suttas = suttas
+        self.footnotes = footnotes
+        self.index = {sutta.uid: i for i, sutta in enumerate(suttas)}
+        self.offsets = offsets = array('I', [0])
+        self.targets = targets = array('I')
+        self.flags = flags = array('B')
+        self.footnote_ids = footnote_ids = array('I')
+
+        # Parallel.sort_key, with the partial flag spliced in.
+        target_keys = [(s.lang.priority, s.subdivision.order, s.number_in_vagga)
+                       for s in suttas]
+        def sort_key(edge):
+            key = target_keys[edge[0]]
+            return (key[0], edge[1] & self.PARTIAL, key[1], key[2])
+
+        for i in range(len(suttas)):
+            edges = [(target, 0, fn) for target, fn in fulls.get(i, ())]
+            edges.extend((target, self.INDIRECT, fn)
+                         for target, fn in indirects.get(i, ()))
+            edges.extend((target, self.PARTIAL, fn)
+                         for target, fn in partials.get(i, ()))
+            edges.sort(key=sort_key)
+            for target, flag, fn in edges:
+                targets.append(target)
+                flags.append(flag)
+                footnote_ids.append(fn)
+            offsets.append(len(targets))
+
+    def get(self, uid):
+        """ Returns the parallels of the sutta with uid as a sequence """
+        i = self.index.get(uid)
+        if i is None:
+            return ParallelsView(self, 0, 0)
+        return ParallelsView(self, self.offsets[i], self.offsets[i + 1])
+
+    def parallel(self, position):
+        flag = self.flags[position]
+        return Parallel(sutta=self.suttas[self.targets[position]],
+                        partial=bool(flag & self.PARTIAL),
+                        indirect=bool(flag & self.INDIRECT),
+                        footnote=self.footnotes[self.footnote_ids[position]])
+
+    def __len__(self):
+        return len(self.targets)
+
+class ParallelsView(Sequence):
+    """ A read only sequence of the parallels of one sutta """
+    __slots__ = ('_graph', '_start', '_stop')
+
+    def __init__(self, graph, start, stop):
+        self._graph = graph
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('parallel index out of range')
+        return self._graph.parallel(self._start + i)
+
+    def __repr__(self):
+        return 'ParallelsView({!r})'.format(list(self))
+
 class NegatedParallel:
     __slots__ = ('division')
     negated = '---'
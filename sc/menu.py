@@ -45,9 +45,10 @@ class SectMenu(list):
         super().__init__(divisions)
 
 
-def build_menu():
+def build_menu(imm=None):
     """Build and return the SuttaCentral menu."""
-    imm = sc.scimm.imm()
+    if imm is None:
+        imm = sc.scimm.imm()
     menu = Menu()
     pitaka_menu = None
     lang_menu = None
@@ -63,10 +64,40 @@ def build_menu():
     return menu
 
 
-_menu = None
-def get_menu():
-    """Return the cached SuttaCentral menu."""
+def render_menu(menu):
+    """Return the HTML of the menu panel."""
+    from sc.views import jinja2_environment
+    return jinja2_environment().get_template('panel.html').render(menu=menu)
+
+
+_CachedMenu = namedtuple('_CachedMenu', 'generation menu html')
+
+_menu = _CachedMenu(None, None, None)
+def update(imm):
+    """Build the menu and its HTML for the IMM.
+
+    This is called whenever the IMM changes, so that the old menu (and
+    through it the old IMM) is let go of.
+    """
     global _menu
-    if _menu is None:
-        _menu = build_menu()
+    menu = build_menu(imm)
+    _menu = _CachedMenu(imm.generation, menu, render_menu(menu))
     return _menu
+
+sc.scimm.subscribe(update)
+
+def _get_cached_menu():
+    imm = sc.scimm.imm()
+    cached = _menu
+    if cached.generation != imm.generation:
+        # The IMM changed before this module was imported.
+        cached = update(imm)
+    return cached
+
+def get_menu():
+    """Return the cached SuttaCentral menu."""
+    return _get_cached_menu().menu
+
+def get_menu_html():
+    """Return the cached HTML of the menu panel."""
+    return _get_cached_menu().html
@@ -12,17 +12,21 @@ Example:
 import time
 import math
 import regex
+import pickle
+import pathlib
 import hashlib
 import logging
 import threading
 from bisect import bisect
 from datetime import datetime
-from itertools import chain
+from itertools import chain, count
 from collections import OrderedDict, defaultdict, namedtuple
 
 import sc
+import sc.changes
 from sc import config, textfunctions, textdata
 from sc.classes import *
+import sc.classes
 import sc.updater
 
 from sc.csv_loader import table_reader
@@ -45,22 +49,128 @@ def numsortkey(input, index=0):
     return ( [int(a) if a.isnumeric() else a
                    for a in regex.split(r'(\d+)', string)] )
 
+_Phase = namedtuple('_Phase', 'name tables depends incremental')
+
+# The generation of an IMM changes whenever its content (or TIM) does,
+# so it can be used to validate anything derived from it.
+_generations = count(1)
+
+_subscribers = []
+
+def subscribe(callback):
+    """ Call callback with the IMM whenever it is replaced or updated
+
+    Callbacks are run on the thread doing the update, so anything derived
+    from the IMM can be rebuilt there rather than on a request thread.
+
+    """
+    _subscribers.append(callback)
+
+def _publish(instance):
+    for callback in _subscribers:
+        try:
+            callback(instance)
+        except Exception:
+            logger.exception('IMM subscriber {!r} failed'.format(callback))
+
 class _Imm:
+    """ The In-Memory Model.
+
+    The model is built in phases, each phase declares which tables it is
+    built from and which phases it depends on. When tables change, only
+    the phases affected by the change (and their dependents) are rerun.
+    A phase is incremental if it can be rerun against the live model,
+    it must compute its result aside and then assign it, so that readers
+    always see either the old or the new result. If any affected phase
+    is not incremental then the whole model is rebuilt.
+
+    The '__source__' pseudo-table stands for the source of the modules
+    which build the model.
+
+    """
     _uidlangcache = {}
     _instance = None
     _ready = threading.Event()
-    def __init__(self, timestamp):
+
+    phases = [
+        _Phase('build', {'__source__', 'uid_expansion', 'pitaka', 'sect',
+                         'language', 'external_text', 'collection',
+                         'division', 'subdivision', 'vagga', 'sutta'},
+               depends=set(), incremental=False),
+        _Phase('load_biblios', {'biblio'}, depends=set(), incremental=True),
+        _Phase('build_parallels', {'correspondence'}, depends={'build'},
+               incremental=True),
+        _Phase('build_grouped_suttas', {'vinaya_rules'}, depends={'build'},
+               incremental=False),
+        _Phase('build_parallel_sutta_groups', {'vinaya_pm', 'vinaya_kd'},
+               depends={'build_grouped_suttas'}, incremental=True),
+        _Phase('load_epigraphs', {'epigraphs'},
+               depends={'build', 'build_grouped_suttas'}, incremental=True),
+        _Phase('build_next_prev', set(), depends={'build'}, incremental=True),
+    ]
+
+    def __init__(self, timestamp, table_digests):
         self.tim = textdata.tim()
-        self.build()
-        self.build_parallels_data()
-        self.build_parallels()
-        self.build_grouped_suttas()
-        self.build_parallel_sutta_group('vinaya_pm')
-        self.build_parallel_sutta_group('vinaya_kd')
-        # self.build_search_data()
-        self.load_epigraphs()
+        for phase in self.phases:
+            getattr(self, phase.name)()
+        self.table_digests = table_digests
+        self.key = table_digests_key(table_digests)
+        self.timestamp = timestamp
+        self.build_time = datetime.now()
+        self.generation = next(_generations)
+
+    def get_affected_phases(self, table_digests):
+        """ Returns the names of the phases affected by changed tables
+
+        If the affected phases cannot be rerun incrementally None is
+        returned, meaning a full rebuild is required.
+
+        """
+        
+        changed = {name for name in set(self.table_digests) | set(table_digests)
+                   if self.table_digests.get(name) != table_digests.get(name)}
+        affected = []
+        for phase in self.phases:
+            if phase.tables & changed or phase.depends.intersection(affected):
+                if not phase.incremental:
+                    return None
+                affected.append(phase.name)
+        return affected
+
+    def update(self, phases, timestamp, table_digests):
+        """ Rerun phases (as returned by get_affected_phases)
+
+        If a phase fails the results of the phases before it are undone,
+        so the model is left as it was.
+
+        """
+        state = self.__dict__.copy()
+        try:
+            for name in phases:
+                logger.info('Updating IMM phase {}'.format(name))
+                getattr(self, name)()
+        except Exception:
+            # Phases only ever assign attributes.
+            self.__dict__.update(state)
+            raise
+        self.table_digests = table_digests
+        self.key = table_digests_key(table_digests)
         self.timestamp = timestamp
         self.build_time = datetime.now()
+        self.generation = next(_generations)
+
+    def __getstate__(self):
+        # The TIM has its own persistence and life cycle, so it is
+        # not included in the snapshot, nor is the next/prev table
+        # which refers to it.
+        state = self.__dict__.copy()
+        del state['tim']
+        del state['next_prev']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.set_tim(textdata.tim())
     
     def __call__(self, uid):
         if uid in self.collections:
@@ -267,14 +377,6 @@ class _Imm:
                     name=None,
                     suttas=[]))
         
-        # Load biblio entries (Not into an instance variable)
-        biblios = {}
-        for row in table_reader('biblio'):
-            biblios[row.uid] = BiblioEntry(
-                uid=row.uid,
-                name=row.name,
-                text=row.text)
-        
         # Build suttas (indexed by uid)
         suttas = []
         for row in table_reader('sutta'):
@@ -301,10 +403,6 @@ class _Imm:
             else:
                 number = 9999
             
-            biblio_entry = None
-            if row.biblio_uid:
-                biblio_entry = biblios.get(row.biblio_uid)
-            
             sutta = Sutta(
                 uid=row.uid,
                 acronym=acro[0],
@@ -318,8 +416,7 @@ class _Imm:
                 number_in_vagga=row.number_in_vagga,
                 volpage=volpage[0],
                 alt_volpage_info=volpage[1] if len(volpage) > 1 else None,
-                biblio_entry=biblio_entry,
-                parallels=[],
+                biblio_uid=row.biblio_uid,
                 imm=self,
             )
             suttas.append( (uid, sutta) )
@@ -333,64 +430,101 @@ class _Imm:
             sutta.subdivision.suttas.append(sutta)
             sutta.vagga.suttas.append(sutta)
         
+    def load_biblios(self):
+        biblios = {}
+        for row in table_reader('biblio'):
+            biblios[row.uid] = BiblioEntry(
+                uid=row.uid,
+                name=row.name,
+                text=row.text)
+        self.biblios = biblios
+
     def build_parallels_data(self):
+        """ Collect the parallels, identifying suttas and footnotes by number.
+        
+        Indirect parallels are the full parallels of full parallels.
+        
+        """
+        
+        suttas = []
+        index = {}
+        footnotes = ['']
+        footnote_index = {'': 0}
         
         fulls = defaultdict(set)
         partials = defaultdict(set)
         indirects = defaultdict(set)
-        # initially we operate purely on ids using id, footnote tuples
+        
+        def number(uid):
+            try:
+                return index[uid]
+            except KeyError:
+                index[uid] = len(suttas)
+                suttas.append(self.suttas[uid])
+                return index[uid]
 
         #Populate partial and full parallels
         for row in table_reader('correspondence'):
+            a = number(row.sutta_uid)
+            b = number(row.other_sutta_uid)
+            try:
+                fn = footnote_index[row.footnote]
+            except KeyError:
+                fn = footnote_index[row.footnote] = len(footnotes)
+                footnotes.append(row.footnote)
             if row.partial:
-                partials[row.sutta_uid].add( (row.other_sutta_uid, row.footnote) )
-                partials[row.other_sutta_uid].add( (row.sutta_uid, row.footnote) )
+                partials[a].add( (b, fn) )
+                partials[b].add( (a, fn) )
             else:
-                fulls[row.sutta_uid].add( (row.other_sutta_uid, row.footnote) )
-                fulls[row.other_sutta_uid].add( (row.sutta_uid, row.footnote) )
+                fulls[a].add( (b, fn) )
+                fulls[b].add( (a, fn) )
 
-        # Populate indirect full parallels
-        for id, parallels in fulls.items():
-            for pid, footnote in parallels:
-                if pid in fulls:
-                    indirects[id].update(fulls[pid])
-
-        for id, parallels in indirects.items():
-            # Remove self and fulls
-            indirects[id] -= set(a for a in indirects[id] if a[0] == id)
+        # Populate indirect full parallels. Parallels mostly come in
+        # clusters where every sutta lists every other, so within a
+        # connected component of such a cluster the full parallels of a's
+        # full parallels are all the component's parallels, less those
+        # only a itself lists. That is found once per component instead
+        # of by a union over every member's parallels for every member.
+        seen = set()
+        for start in fulls:
+            if start in seen:
+                continue
+            component = {start}
+            stack = [start]
+            while stack:
+                for b, footnote in fulls[stack.pop()]:
+                    if b not in component:
+                        component.add(b)
+                        stack.append(b)
+            seen.update(component)
+            if all({b for b, footnote in fulls[a]} == component - {a}
+                   for a in component):
+                listed_by = {}
+                for a in component:
+                    for e in fulls[a]:
+                        listed_by[e] = a if e not in listed_by else None
+                for a in component:
+                    indirects[a] = {e for e, only in listed_by.items()
+                                    if e[0] != a and only != a}
+                continue
+            for a in component:
+                indirect = set()
+                for b, footnote in fulls[a]:
+                    indirect.update(fulls[b])
+                # Remove self
+                indirects[a] = {e for e in indirect if e[0] != a}
 
         return {
-            'fulls': fulls.items(),
-            'indirects': indirects.items(),
-            'partials': partials.items(),
+            'suttas': suttas,
+            'footnotes': footnotes,
+            'fulls': fulls,
+            'indirects': indirects,
+            'partials': partials,
             }
     
     def build_parallels(self):
-        parallels_data = self.build_parallels_data()
-        fulls = parallels_data['fulls']
-        indirects = parallels_data['indirects']
-        partials = parallels_data['partials']
-        
-        for sutta_uid, parallels in fulls:
-            sutta = self.suttas[sutta_uid]
-            for p_uid, note in parallels:
-                p_sutta = self.suttas[p_uid]
-                sutta.parallels.append(Parallel(p_sutta, False, False, note))
-                
-        for sutta_uid, parallels in indirects:
-            sutta = self.suttas[sutta_uid]
-            for p_uid, note in parallels:
-                p_sutta = self.suttas[p_uid]
-                sutta.parallels.append(Parallel(p_sutta, False, True, note))
-
-        for sutta_uid, parallels in partials:
-            sutta = self.suttas[sutta_uid]
-            for p_uid, note in parallels:
-                p_sutta = self.suttas[p_uid]
-                sutta.parallels.append(Parallel(p_sutta, True, False, note))
-
-        for sutta in self.suttas.values():
-            sutta.parallels.sort(key=Parallel.sort_key)
+        # Assigning a new graph replaces all the parallels at once.
+        self.parallel_graph = ParallelGraph(**self.build_parallels_data())
     
     def build_grouped_suttas(self):
         vinaya_rules = {}
@@ -410,7 +544,15 @@ class _Imm:
             
             self.suttas[uid] = rule
 
-    def build_parallel_sutta_group(self, table_name):
+    def build_parallel_sutta_groups(self):
+        # GroupedSutta.parallel_group looks itself up in parallel_groups,
+        # so assigning a new dict replaces all the groups at once.
+        groups = {}
+        self.build_parallel_sutta_group('vinaya_pm', groups)
+        self.build_parallel_sutta_group('vinaya_kd', groups)
+        self.parallel_groups = groups
+
+    def build_parallel_sutta_group(self, table_name, groups):
         """ Generate a cleaned up form of the table data
         
         A parallel group is a different way of defining parallels, in essence
@@ -474,12 +616,12 @@ class _Imm:
             group = ParallelSuttaGroup(row[0], row[1:])
             for rule in row[1:]:
                 if isinstance(rule, GroupedSutta):
-                    if hasattr(rule, 'parallel_group'):
-                        if not isinstance(rule.parallel_group, MultiParallelSuttaGroup):
-                            rule.parallel_group = MultiParallelSuttaGroup(rule.parallel_group)
-                        rule.parallel_group.add_group(group)
+                    if rule in groups:
+                        if not isinstance(groups[rule], MultiParallelSuttaGroup):
+                            groups[rule] = MultiParallelSuttaGroup(groups[rule])
+                        groups[rule].add_group(group)
                     else:
-                        rule.parallel_group = group
+                        groups[rule] = group
 
     def build_search_data(self):
         """ Build useful search data.
@@ -693,7 +835,7 @@ class _Imm:
     def load_epigraphs(self):
         import lxml.etree
         file = sc.data_dir / 'table' / 'epigraphs.xml'
-        self.epigraphs = []
+        epigraphs = []
         
         doc = lxml.etree.parse(str(file))
         valid = 0
@@ -719,50 +861,74 @@ class _Imm:
                     logger.warning('{}:{} - Sutta "{}" has no english translation. Using details page instead.'.format(file.name, element.sourceline, uid))
                     href = '/{}'.format(uid)
                 else:
-                    self.epigraphs.append({'sutta': self.suttas[uid], 'content': content, 'href': href})
+                    epigraphs.append({'sutta': self.suttas[uid], 'content': content, 'href': href})
                     valid += 1
         logger.info('Loaded {} epigraphs, {} are valid, {} are invalid'.format(count + 1, valid, count - valid))
+        self.epigraphs = epigraphs
 
     def get_random_epigraph(self):
         import random
         return random.choice(self.epigraphs)
 
+    def build_next_prev(self):
+        self.next_prev = self.compute_next_prev(self.tim)
+
+    def compute_next_prev(self, tim):
+        """ Returns a table of the next and previous texts
+
+        The table is keyed by (uid, lang_uid) and the values are a
+        (next, prev) pair of TextInfo entries, either may be falsy.
+        Texts with neither a next nor a previous text are omitted.
+
+        """
+        sutta_order = defaultdict(dict)
+        for division in self.divisions.values():
+            suttas = list(chain(*(sd.suttas for sd in division.subdivisions)))
+            
+            prev = None
+            for sutta in suttas:
+                if prev:
+                    sutta_order[sutta.uid]['prev'] = prev.uid
+                    sutta_order[prev.uid]['next'] = sutta.uid
+                prev = sutta
+        
+        table = {}
+        for lang_uid in tim.get_langs():
+            texts = tim.get_nav_entries(lang_uid)
+            for uid, textdata in texts.items():
+                nextdata = None
+                prevdata = None
+                nextprev = sutta_order.get(uid)
+                if nextprev:
+                    # if the sutta data says that a sutta is the start/end
+                    # of a division, we will trust it, hence we use 'False',
+                    # for there is no next/prev sutta, rather than 'None'
+                    # for unknown.
+                    nextdata = (texts.get(nextprev['next'])
+                                if 'next' in nextprev
+                                else False)
+                    prevdata = (texts.get(nextprev['prev'])
+                                if 'prev' in nextprev
+                                else False)
+                if nextdata is None and textdata.next_uid:
+                    nextdata = texts.get(textdata.next_uid)
+                if prevdata is None and textdata.prev_uid:
+                    prevdata = texts.get(textdata.prev_uid)
+                if nextdata or prevdata:
+                    table[(uid, lang_uid)] = (nextdata, prevdata)
+        return table
+
+    def set_tim(self, tim):
+        """ Swap in a new TIM along with a matching next/prev table """
+        next_prev = self.compute_next_prev(tim)
+        self.tim = tim
+        self.next_prev = next_prev
+        self.generation = next(_generations)
+        if self is _Imm._instance:
+            _publish(self)
+
     def get_next_prev(self, uid, lang_uid):
-        if not hasattr(self, 'sutta_order_cache'):
-            self.sutta_order_cache = soc = defaultdict(dict)
-            for division in self.divisions.values():
-                suttas = list(chain(*(sd.suttas for sd in division.subdivisions)))
-                
-                prev = None
-                for sutta in suttas:
-                    if prev:
-                        soc[sutta.uid]['prev'] = prev.uid
-                        soc[prev.uid]['next'] = sutta.uid
-                    prev = sutta
-        soc = self.sutta_order_cache
-        tim = self.tim
-        
-        nextdata = None
-        prevdata = None
-        
-        nextprev = soc.get(uid)
-        if nextprev:
-            # if the sutta data says that a sutta is the start/end of a 
-            # division, we will trust it, hence we use 'False', for there
-            # is no next/prev sutta, rather than 'None' for unknown.
-            nextdata = (tim.get(uid=nextprev.get('next'), lang_uid=lang_uid)
-                if 'next' in nextprev
-                else False)
-            prevdata = (tim.get(uid=nextprev.get('prev'), lang_uid=lang_uid)
-                        if 'prev' in nextprev
-                        else False)
-    
-        textdata = tim.get(uid=uid, lang_uid=lang_uid)
-        if textdata:
-            if nextdata is None and textdata.next_uid:
-                nextdata = tim.get(uid=textdata.next_uid, lang_uid=lang_uid)
-            if prevdata is None and textdata.prev_uid:
-                prevdata = tim.get(uid=textdata.prev_uid, lang_uid=lang_uid)
+        nextdata, prevdata = self.next_prev.get((uid, lang_uid), (None, None))
         return {'next': nextdata,
                 'prev': prevdata}
         
@@ -786,15 +952,156 @@ def imm(wait=True):
             _Imm._ready.wait()
     return _Imm._instance
 
-def periodic_update(i):
-    timestamp = max(int(file.stat().st_mtime) for file in sc.table_dir.glob('**/*'))
-    if not _Imm._instance or _Imm._instance.timestamp != timestamp:
-        logger.info('Building IMM')
+# Table file path to (FileStat, digest), so that only the tables which
+# have changed on disk are read.
+_table_digest_cache = {}
+
+def table_digests(extra_files=(__file__, sc.classes.__file__)):
+    """ Returns md5 digests of the table contents, keyed by table name
+
+    The table name is the path relative to the table dir, without the
+    suffix, i.e. 'sutta' or 'epigraphs'.
+
+    Unlike a modification time this is not affected by files being
+    touched (for example by a git checkout) without their content
+    changing.
+
+    The source of this module and the classes module are digested
+    under the name '__source__' since changes to them are likely to
+    result in a different IMM.
+
+    """
+
+    digests = {}
+    for path, stat in sc.changes.table_watcher.stats().items():
+        name = str(pathlib.Path(path).with_suffix(''))
+        cached = _table_digest_cache.get(path)
+        if cached and cached[0] == stat:
+            digests[name] = cached[1]
+            continue
+        with (sc.table_dir / path).open('rb') as f:
+            digests[name] = hashlib.md5(f.read()).hexdigest()
+        _table_digest_cache[path] = (stat, digests[name])
+
+    md5 = hashlib.md5()
+    for file in extra_files:
+        with open(file, 'rb') as f:
+            md5.update(f.read())
+    digests['__source__'] = md5.hexdigest()
+    return digests
+
+def table_digests_key(digests):
+    """ Combine table digests into a single key """
+    md5 = hashlib.md5()
+    for name in sorted(digests):
+        md5.update('{}:{}\n'.format(name, digests[name]).encode())
+    return md5.hexdigest()
+
+snapshot_name_tmpl = 'imm_{}.pickle'
+
+# Increment when the layout of a snapshot file changes.
+snapshot_format = 1
+
+def load_snapshot(key, source_digest):
+    """ Load a saved IMM, returns None if no usable snapshot exists.
+
+    The snapshot matching key is preferred, otherwise the most recently
+    saved snapshot is returned, this can be served while a fresh IMM
+    is built. Only snapshots saved by the same source (as digested by
+    table_digests) are loaded, an IMM pickled by other code may not
+    unpickle into something which works.
+
+    """
+
+    snapshot_files = sorted(sc.db_dir.glob(snapshot_name_tmpl.format('*')),
+                            key=lambda f: f.stat().st_mtime,
+                            reverse=True)
+    best_file = sc.db_dir / snapshot_name_tmpl.format(key)
+    if best_file in snapshot_files:
+        snapshot_files.remove(best_file)
+        snapshot_files.insert(0, best_file)
+    for file in snapshot_files:
+        logger.info('Loading IMM snapshot {.name}'.format(file))
         try:
             start = time.time()
-            _Imm._instance = _Imm(timestamp)
-            logger.info('imm build took {} seconds'.format(time.time() - start))
+            with file.open('rb') as f:
+                header = pickle.load(f)
+                if header != (snapshot_format, source_digest):
+                    raise ValueError('saved by different source')
+                instance = pickle.load(f)
+            logger.info('IMM snapshot load took {} seconds'.format(time.time() - start))
+            return instance
+        except Exception as e:
+            logger.warning('IMM snapshot {.name} is unusable, removing ({!s})'.format(file, e))
+            file.unlink()
+    return None
+
+def save_snapshot(instance):
+    """ Save the IMM to the db dir, replacing any older snapshots. """
+
+    snapshot_file = sc.db_dir / snapshot_name_tmpl.format(instance.key)
+    tmp_file = snapshot_file.with_suffix('.tmp')
+    try:
+        if not sc.db_dir.exists():
+            sc.db_dir.mkdir(parents=True)
+        with tmp_file.open('wb') as f:
+            header = (snapshot_format, instance.table_digests['__source__'])
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(instance, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_file.replace(snapshot_file)
+    # Pickling too deep a structure raises a RuntimeError (on Python 3.5
+    # and later a RecursionError, which is one).
+    except (OSError, pickle.PicklingError, RuntimeError) as e:
+        logger.error('Could not save IMM snapshot ({!s})'.format(e))
+        if tmp_file.exists():
+            tmp_file.unlink()
+        return
+    for file in sc.db_dir.glob(snapshot_name_tmpl.format('*')):
+        if file != snapshot_file:
+            file.unlink()
+
+def periodic_update(i):
+    timestamp = sc.changes.table_watcher.max_mtime_ns() // 1000000000
+    instance = _Imm._instance
+    if instance and instance.timestamp == timestamp:
+        return
+    
+    digests = table_digests()
+    key = table_digests_key(digests)
+    if not instance:
+        instance = load_snapshot(key, digests['__source__'])
+        if instance:
+            _Imm._instance = instance
             _Imm._ready.set()
+            _publish(instance)
+    if instance and instance.key == key:
+        # The tables were touched but their content is unchanged.
+        instance.timestamp = timestamp
+        return
+    
+    if instance:
+        try:
+            phases = instance.get_affected_phases(digests)
+            if phases is not None:
+                start = time.time()
+                instance.update(phases, timestamp, digests)
+                logger.info('imm update ({}) took {} seconds'.format(
+                    ', '.join(phases), time.time() - start))
+                _publish(instance)
+                save_snapshot(instance)
+                return
         except Exception as e:
-            logger.error("Critical Error: IMM buid failed.", e)
-            exit(2)
+            logger.exception('IMM update failed, rebuilding')
+    
+    logger.info('Building IMM')
+    try:
+        start = time.time()
+        instance = _Imm(timestamp, digests)
+        logger.info('imm build took {} seconds'.format(time.time() - start))
+        _Imm._instance = instance
+        _Imm._ready.set()
+    except Exception as e:
+        logger.error("Critical Error: IMM buid failed.", e)
+        exit(2)
+    _publish(instance)
+    save_snapshot(instance)
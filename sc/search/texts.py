@@ -1,13 +1,17 @@
+import os
 import json
 import time
+import pathlib
 import regex
 import hashlib
 import logging
 import lxml.html
 from copy import deepcopy
+from itertools import chain
 from collections import defaultdict
 from elasticsearch.helpers import scan
 import sc
+import sc.changes
 from sc import scimm, textfunctions
 from sc.util import unique, numericsortkey
 
@@ -31,6 +35,11 @@ class TextIndexer(ElasticIndexer):
     def __init__(self, config_name, lang_dir):
         self.lang_dir = lang_dir
         super().__init__(config_name)
+
+    def is_update_needed(self):
+        # Until the first update every language is checked against
+        # the stored mtimes, after that only languages with changes.
+        return _changed_langs is None or self.lang_dir.stem in _changed_langs
         
     def fix_text(self, string):
         """ Removes repeated whitespace and numbers.
@@ -198,7 +207,10 @@ class TextIndexer(ElasticIndexer):
             query=None,
             size=500)}
         print('{} stored mtimes'.format(len(stored_mtimes)))
-        current_mtimes = {file.stem: int(file.stat().st_mtime) for file in self.lang_dir.glob('**/*.html')}
+        prefix = lang_uid + os.sep
+        current_mtimes = {pathlib.PurePath(path).stem: stat.mtime_ns // 1000000000
+                          for path, stat in sc.changes.text_watcher.stats().items()
+                          if path.startswith(prefix) and path.endswith('.html')}
         print('{} current mtimes'.format(len(current_mtimes)))
         to_delete = set(stored_mtimes).difference(current_mtimes)
         to_add = current_mtimes.copy()
@@ -214,7 +226,19 @@ class TextIndexer(ElasticIndexer):
             
         
 
+# Languages with changed texts since the last update, None before
+# the first update.
+_changed_langs = None
+
+def _on_text_changes(changeset):
+    if _changed_langs is not None:
+        _changed_langs.update(path.partition(os.sep)[0]
+                              for path in chain(*changeset))
+
+sc.changes.text_watcher.subscribe(_on_text_changes)
+
 def update(force=False):
+    global _changed_langs
     def sort_key(d):
         if d.stem == 'en':
             return 0
@@ -227,6 +251,10 @@ def update(force=False):
         if lang_dir.is_dir():
             indexer = TextIndexer(lang_dir.stem, lang_dir)
             indexer.update()
+    if _changed_langs is None:
+        _changed_langs = set()
+    else:
+        _changed_langs.difference_update(lang_dir.stem for lang_dir in lang_dirs)
 
 def periodic_update(i):
     if not sc.search.is_available():
@@ -49,7 +49,7 @@ def default(*args, **kwargs):
             return InfoView(uid).render()
 
         if uid in imm.pitakas:
-            return PitakaView(imm.pitakas[uid]).render()
+            return PitakaView(imm.pitakas[uid]).stream()
 
         if uid == 'uids':
             return UidsView().render()
@@ -65,16 +65,16 @@ def default(*args, **kwargs):
                         full = True
             if division.has_subdivisions():
                 if full:
-                    return DivisionView(division).render()
+                    return DivisionView(division).stream()
                 else:
-                    return SubdivisionHeadingsView(division).render()
+                    return SubdivisionHeadingsView(division).stream()
             elif not full:
-                return DivisionView(division).render()
+                return DivisionView(division).stream()
 
         # Subdivisions
         subdivision = imm.subdivisions.get(uid)
         if subdivision:
-            return SubdivisionView(subdivision).render()
+            return SubdivisionView(subdivision).stream()
 
         # Sutta Parallels
         sutta = imm.suttas.get(uid)
@@ -129,9 +129,9 @@ def default(*args, **kwargs):
                 return EditView(sutta, lang_code, canonical).render()
             
         if sutta:
-            return SuttaView(sutta, lang, canonical).render()
+            return SuttaView(sutta, lang, canonical).stream()
         else:
-            return TextView(uid, lang_code, canonical).render()
+            return TextView(uid, lang_code, canonical).stream()
 
     raise cherrypy.NotFound()
 
@@ -0,0 +1,361 @@
+""" Pre-extracted text content for the TextView
+
+Every text page needs the contents of the text's body element, a
+snippet of its opening paragraphs and whether it contains quotation
+marks, Chinese texts also need their newlines removed. This is the same
+work for every visitor, so it is done once per text file and the results
+are kept in a TextContentStore.
+
+Selections of paragraphs, which embedded quotes are made of, are made
+by ordinal from the top level elements of the text's article. Each record
+is followed by the HTML of those paragraphs and their offsets, so that a
+selection reads only the paragraphs it needs.
+
+The store is a data file of records appended one after another and an
+index of relative path to (offset, length, paragraphs length, mtime_ns,
+size). The index is held in memory, so reading a record is a single
+pread. When a text file changes its new record is appended, once more
+than half of the data file is made up of dead records it is rewritten.
+
+Every server process shares the store, one of them updates it and the
+others reload the index when it changes. The data file is only ever
+appended to or replaced, so a process holding an older index keeps
+reading consistent records from its open data file.
+
+"""
+
+import os
+import sys
+import pickle
+import struct
+import hashlib
+import logging
+import threading
+from array import array
+from collections import namedtuple
+
+import regex
+
+import sc, sc.util, sc.changes
+
+logger = logging.getLogger(__name__)
+
+TextContent = namedtuple('TextContent', 'text snippet has_quotes cjk_text')
+
+# Extract the (non-nestable) body element using regex, DOTALL
+# and non-greedy matching makes this straightforward.
+content_regex = regex.compile(r'''
+    <body[^>]*>
+    (?<content>.*)
+    </body>
+    ''', flags=regex.DOTALL | regex.VERBOSE)
+
+# Eliminate newlines from Full-width-glyph languages like Chinese
+# because they convert into spaces when rendered.
+# TODO: This check should use 'language' table
+cjk_langs = {'zh'}
+
+def get_snippet(html, target_len=500):
+    from sc.tools import html as _html
+    root = _html.fromstring(html[:target_len + 2000])
+    for e in root.cssselect('.hgroup'):
+        e.drop_tree()
+    article = root.cssselect('article')[0]
+    parts = []
+    total_len = 0
+    for e in article:
+        if e.tag not in {'p', 'blockquote'}:
+            continue
+        text = e.text_content()
+        parts.append(text)
+        total_len += len(text)
+        if total_len > target_len:
+            break
+
+    text = '   '.join(parts)
+    if len(text) > target_len:
+        text = text[:target_len] + ' …'
+    return text
+
+def has_quotes(text):
+    return '‘' in text or '“' in text
+
+def massage_cjk(text):
+    def deline(string):
+        return string.replace('\n', '').replace('<p', '\n<p')
+
+    m = regex.match(r'(?s)(.*?)(<aside[^>]+id="metaarea".*?</aside>)(.*)', text)
+    if m or not m:
+        pre, meta, post = m[1:]
+        return ''.join([deline(pre), meta, deline(post)])
+    return deline(text)
+
+# The elements which can be selected by ordinal.
+paragraphs_selector = ('article > *:not(div), article > div.hgroup, '
+                       'article > div:not(.hgroup) > *')
+
+def extract_paragraphs(html):
+    """ Returns the HTML of each selectable paragraph of a text
+
+    The HTML of a paragraph includes its tail.
+
+    """
+    from sc.tools import html as _html
+    root = _html.fromstring(html)
+    return [str(e) for e in root.cssselect(paragraphs_selector)]
+
+def extract_content(html, lang_uid, uid=None):
+    """ Returns the TextContent of the html string of a text
+
+    The texts are inserted into templates as they are, so indentation is
+    stripped from them as it is from the templates.
+
+    """
+    text = content_regex.search(html)['content']
+    try:
+        snippet = get_snippet(text)
+    except Exception as e:
+        logger.error('Failed to generated snippet for {} ({})'.format(uid, str(e)))
+        snippet = ''
+    cjk_text = None
+    if lang_uid in cjk_langs:
+        cjk_text = sc.util.strip_indentation(massage_cjk(text))
+    return TextContent(sc.util.strip_indentation(text),
+                       sc.util.strip_indentation(snippet),
+                       has_quotes(text), cjk_text)
+
+class TextContentStore:
+    data_name_tmpl = 'text-content_{}.data'
+    index_name_tmpl = 'text-content_{}.index'
+
+    # Lengths of text, snippet and cjk_text in bytes, and has_quotes.
+    _header = struct.Struct('<IIIB')
+    _no_cjk = 0xFFFFFFFF
+    # The paragraphs are a count, then count + 1 offsets from the end of
+    # the offsets, then the HTML of the paragraphs.
+    _count = struct.Struct('<I')
+
+    def __init__(self, db_dir=None):
+        self.db_dir = db_dir = db_dir or sc.db_dir
+        key = self.get_db_key()
+        self.data_path = db_dir / self.data_name_tmpl.format(key)
+        self.index_path = db_dir / self.index_name_tmpl.format(key)
+        self.lock_path = db_dir / (self.data_name_tmpl.format(key) + '.lock')
+        # (data file, index, index stat), replaced as a whole so
+        # readers always see a data file and index which belong together.
+        self._state = (None, {}, None)
+        self._update_lock = threading.Lock()
+
+    def get_db_key(self):
+        # The records depend on the extraction code in this module.
+        with open(__file__, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def __len__(self):
+        return len(self._state[1])
+
+    def get(self, relpath, mtime_ns, size):
+        """ Returns the TextContent of a text file or None
+
+        None is returned if the store has no record of the file as it
+        is, in which case the file should be processed directly.
+
+        """
+        file, index, _ = self._state
+        entry = index.get(relpath)
+        if entry is None:
+            return None
+        offset, length, _, entry_mtime_ns, entry_size = entry
+        if not length or entry_mtime_ns != mtime_ns or entry_size != size:
+            return None
+        return self._decode(os.pread(file.fileno(), length, offset))
+
+    def get_paragraphs(self, relpath, mtime_ns, size, ordinals):
+        """ Returns the HTML of the paragraphs of a text file or None
+
+        Paragraphs are selected by ordinal, an IndexError is raised for
+        ordinals which are out of range. None is returned if the store has
+        no record of the file as it is.
+
+        """
+        file, index, _ = self._state
+        entry = index.get(relpath)
+        if entry is None:
+            return None
+        offset, length, para_length, entry_mtime_ns, entry_size = entry
+        if not para_length or entry_mtime_ns != mtime_ns or entry_size != size:
+            return None
+        fd = file.fileno()
+        offset += length
+        count, = self._count.unpack(os.pread(fd, self._count.size, offset))
+        offset += self._count.size
+        offsets = array('I', os.pread(fd, 4 * (count + 1), offset))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        offset += 4 * (count + 1)
+        results = []
+        for ordinal in ordinals:
+            if ordinal < 0:
+                ordinal += count
+            if not 0 <= ordinal < count:
+                raise IndexError('paragraph index out of range')
+            start, end = offsets[ordinal], offsets[ordinal + 1]
+            results.append(os.pread(fd, end - start, offset + start).decode())
+        return results
+
+    def _encode(self, content):
+        text = content.text.encode()
+        snippet = content.snippet.encode()
+        if content.cjk_text is None:
+            cjk_text = b''
+            cjk_len = self._no_cjk
+        else:
+            cjk_text = content.cjk_text.encode()
+            cjk_len = len(cjk_text)
+        return b''.join([self._header.pack(len(text), len(snippet), cjk_len,
+                                           content.has_quotes),
+                         text, snippet, cjk_text])
+
+    def _encode_paragraphs(self, paragraphs):
+        data = [paragraph.encode() for paragraph in paragraphs]
+        offsets = array('I', [0])
+        for paragraph in data:
+            offsets.append(offsets[-1] + len(paragraph))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        return b''.join([self._count.pack(len(data)), offsets.tobytes()]
+                        + data)
+
+    def _decode(self, data):
+        text_len, snippet_len, cjk_len, has_quotes = self._header.unpack_from(data)
+        i = self._header.size
+        text = data[i:i + text_len].decode()
+        i += text_len
+        snippet = data[i:i + snippet_len].decode()
+        i += snippet_len
+        cjk_text = None if cjk_len == self._no_cjk else data[i:].decode()
+        return TextContent(text, snippet, bool(has_quotes), cjk_text)
+
+    def reload(self):
+        """ Load the index if it has changed since it was last loaded """
+        try:
+            stat = self.index_path.stat()
+        except FileNotFoundError:
+            return False
+        # The index is always replaced, never written in place.
+        index_stat = (stat.st_ino, stat.st_mtime_ns)
+        if index_stat == self._state[2]:
+            return False
+        with self.index_path.open('rb') as f:
+            data_ino, index = pickle.load(f)
+        try:
+            file = self.data_path.open('rb')
+        except FileNotFoundError:
+            return False
+        if os.fstat(file.fileno()).st_ino != data_ino:
+            # The data file was rewritten after the index was read,
+            # its index will be picked up next time.
+            file.close()
+            return False
+        self._state = (file, index, index_stat)
+        return True
+
+    def update(self):
+        """ Bring the store up to date with the text files
+
+        Returns the number of records written, or None if another
+        process is updating the store.
+
+        """
+        with self._update_lock, \
+                sc.util.filelock(str(self.lock_path), block=False) as acquired:
+            if not acquired:
+                self.reload()
+                return None
+            for file in self.db_dir.glob(self.data_name_tmpl.format('*') + '*'):
+                if not file.name.startswith(self.data_path.name):
+                    logger.info('{.name} is obsolete, removing'.format(file))
+                    file.unlink()
+            for file in self.db_dir.glob(self.index_name_tmpl.format('*') + '*'):
+                if not file.name.startswith(self.index_path.name):
+                    file.unlink()
+            self.reload()
+            return self._update()
+
+    def _update(self):
+        _, old_index, _ = self._state
+        stats = {path: fstat for path, fstat
+                 in sc.changes.text_watcher.stats().items()
+                 if os.sep in path and path.endswith('.html')}
+        index = {path: entry for path, entry in old_index.items()
+                 if path in stats}
+        changed = [path for path, fstat in sorted(stats.items())
+                   if path not in index or index[path][3:] != tuple(fstat)]
+        if not changed and len(index) == len(old_index):
+            return 0
+
+        mode = 'ab' if self.data_path.exists() else 'wb'
+        with self.data_path.open(mode) as f:
+            offset = f.tell()
+            for path in changed:
+                fstat = stats[path]
+                lang_uid = path.partition(os.sep)[0]
+                try:
+                    with (sc.text_dir / path).open('r', encoding='utf-8') as tf:
+                        html = tf.read()
+                except FileNotFoundError:
+                    index.pop(path, None)
+                    continue
+                # Empty records, so the file isn't retried until it changes.
+                try:
+                    record = self._encode(extract_content(
+                        html, lang_uid, uid=os.path.basename(path)[:-5]))
+                except Exception as e:
+                    logger.error('Failed to extract content of {} ({})'.format(path, e))
+                    record = b''
+                try:
+                    paragraphs = self._encode_paragraphs(
+                        extract_paragraphs(html))
+                except Exception as e:
+                    logger.error('Failed to extract paragraphs of {} ({})'.format(path, e))
+                    paragraphs = b''
+                f.write(record)
+                f.write(paragraphs)
+                index[path] = (offset, len(record), len(paragraphs),
+                               fstat.mtime_ns, fstat.size)
+                offset += len(record) + len(paragraphs)
+
+        live = sum(entry[1] + entry[2] for entry in index.values())
+        if offset > 2 * live:
+            index = self._compact(index)
+
+        self._save_index(index)
+        self.reload()
+        logger.info('Updated text content store with {} records'.format(len(changed)))
+        return len(changed)
+
+    def _compact(self, index):
+        """ Rewrite the data file with only the live records """
+        file, _, _ = self._state
+        tmp_path = self.data_path.with_name(self.data_path.name + '.tmp')
+        new_index = {}
+        with self.data_path.open('rb') as src, tmp_path.open('wb') as dst:
+            for path, (offset, length, para_length, mtime_ns, size) in sorted(
+                    index.items(), key=lambda t: t[1][0]):
+                new_index[path] = (dst.tell(), length, para_length,
+                                   mtime_ns, size)
+                dst.write(os.pread(src.fileno(), length + para_length, offset))
+        os.replace(str(tmp_path), str(self.data_path))
+        return new_index
+
+    def _save_index(self, index):
+        data_ino = self.data_path.stat().st_ino
+        tmp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+        with tmp_path.open('wb') as f:
+            pickle.dump((data_ino, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp_path), str(self.index_path))
+
+text_content_store = TextContentStore()
+
+def periodic_update(i):
+    text_content_store.update()
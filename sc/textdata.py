@@ -1,14 +1,20 @@
+import os
 import time
 import regex
 import pickle
+import hashlib
+import tempfile
 import pathlib
 import sqlite3
 import datetime
 import functools
 import threading
+from array import array
+from bisect import bisect_left, bisect_right
 from itertools import chain
+from collections import namedtuple
 
-import sc, sc.util, sc.logger
+import sc, sc.util, sc.logger, sc.changes
 from sc.tools import html
 import logging
 logger = logging.getLogger(__name__)
@@ -30,13 +36,15 @@ def text_dir_md5(extra_files=[__file__]):
 
     This can be used to detect if the database is up to date.
 
-    By default uses all directories (not files) in the text_dir,
-    plus this module file since changes to this module are quite
-    likely to result in a different final database.
+    By default uses all html files in the text_dir, plus this module
+    file since changes to this module are quite likely to result in a
+    different final database.
 
     """
-    files = chain(sc.text_dir.glob('**/*.html'), (pathlib.Path(f) for f in extra_files))
-    mtimes = (file.stat().st_mtime_ns for file in files)
+    stats = sc.changes.text_watcher.stats()
+    mtimes = chain((stats[path].mtime_ns for path in sorted(stats)
+                    if path.endswith('.html')),
+                   (pathlib.Path(f).stat().st_mtime_ns for f in extra_files))
     
     from hashlib import md5
     from array import array
@@ -68,93 +76,219 @@ class TextInfo:
             out = out + '#{}'.format(self.bookmark)
         return out
 
+FileRecord = namedtuple('FileRecord', 'mtime_ns size textinfo embedded explicit_order')
+
 class TIMManager:
+    """ Maintains the TextInfoModel and its saved copy
+
+    The saved copy consists of a snapshot of the model and a journal of
+    the changes made to it since, both keyed by the source of this
+    module. Updates only re-extract the text files which have been added,
+    changed or deleted and append the changes to the journal, once the
+    journal grows beyond JOURNAL_MAX entries the snapshot is rewritten.
+
+    With the 'sqlite' tim_backend the model is a SqliteBackedTIM instead,
+    which is its own saved copy.
+
+    """
     instance = None
     db_name_tmpl = 'text-info-model_{}.pickle'
+    journal_name_tmpl = 'text-info-model_{}.journal'
+    sqlite_name_tmpl = 'text-info-model_{}.sqlite'
+    JOURNAL_MAX = 1000
     def __init__(self):
         self.instance = None
         self.ready = threading.Event()
         # up_to_date is False if stale, True if fresh, None if undetermined.
         self.up_to_date = None
+        self.journal_length = 0
+        # The state of the SqliteBackedTIM database when it was last set.
+        self.db_state = None
+        sc.changes.text_watcher.subscribe(self.on_text_changes)
+    
+    def on_text_changes(self, changeset):
+        self.up_to_date = False
     
-    def get_db_name(self):
-        files = sc.text_dir.glob('**/*.html')
-        mtime = int(max(file.stat().st_mtime for file in files))
-        return self.db_name_tmpl.format(mtime)
+    def get_db_key(self):
+        # Changes to this module are quite likely to result in a
+        # different model, so the saved copy is keyed by its source.
+        with open(__file__, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
     
     def load(self, obsolete_okay=False):
         """ Load an instance of the TextInfoModel 
         
         If a saved copy is present, it will be made available nearly
         instantly. Whether or not a saved copy is available, it will
-        then check if it is up to date, and set the up_to_date flag (takes a few seconds),
-        if it is not up_to_date, it will then proceed to generate
-        a fresh version of the database (takes a few minutes), the fresh
-        version will then be made ready.
+        then check which text files have changed, and set the up_to_date
+        flag, only those files are then processed and the changes are
+        made to the live instance. If there is no saved copy a fresh
+        instance is built (takes a few minutes) and made ready.
         
         """
+        if sc.config.tim_backend == 'sqlite':
+            self._load_sqlite(obsolete_okay)
+        else:
+            self._load_pickle(obsolete_okay)
+    
+    def _load_sqlite(self, obsolete_okay):
+        db_file = sc.db_dir / self.sqlite_name_tmpl.format(self.get_db_key())
         
-        best_mtime = ''
-        best_file = None
-        name_rex = regex.compile(self.db_name_tmpl.format('([0-9a-f]+)', '([0-9]+)'))
-        db_files = list(sc.db_dir.glob(self.db_name_tmpl.format('*')))
-        for file in db_files:
-            m = name_rex.match(file.name)
-            build_logger.info('{.name} appears to be saved TIM'.format(file))
-            if not m:
-                build_logger.info('{.name} name format not recognized, skipping'.format(file));
-                continue
-            mtime = m[1]
-            if mtime > best_mtime:
-                best_mtime = mtime
-                best_file = file
-        if best_file:
-            build_logger.info('{.name} looks like most recent saved TIM'.format(best_file))
-            for file in db_files:
-                if file != best_file:
+        instance = self.instance
+        if instance is None:
+            for file in sc.db_dir.glob(self.sqlite_name_tmpl.format('*') + '*'):
+                if not file.name.startswith(db_file.name):
+                    build_logger.info('{.name} is obsolete, removing'.format(file))
                     file.unlink()
-            build_logger.info('Loading {.name}'.format(best_file))
-            try:
-                with file.open('rb') as f:
-                    instance = pickle.load(f)
-                self._set_instance(instance)
-            except (EOFError, ValueError):
-                build_logger.info('{.name} is corrupt, removing'.format(best_file))
-                best_file.unlink()
-                best_file = None
-                best_mtime = ''
+            instance = SqliteBackedTIM(db_file)
+            if instance.is_happy():
+                self._set_sqlite_instance(instance)
+            else:
+                build_logger.info('{.name} is empty, building'.format(db_file))
         
-        db_file_name = self.get_db_name()
-        if best_file:
-            self.up_to_date = (best_file.name == db_file_name)
-            build_logger.info('TIM DB name = {}, up_to_date = {}'.format(db_file_name, self.up_to_date))
-        else:
-            build_logger.info('No TIM DB exists')
+        if obsolete_okay:
+            if self.ready.is_set():
+                return
         
-        if not self.up_to_date:
-            if obsolete_okay:
-                if self.ready.is_set():
-                    return
-            db_file = sc.db_dir / db_file_name
-            db_file.touch()
+        # Every server process shares the database, only one of them
+        # needs to update it. Until there is an instance the others wait
+        # for it to be built.
+        with sc.util.filelock(str(db_file) + '.lock',
+                              block=not self.ready.is_set()) as acquired:
+            if acquired:
+                self.up_to_date = True
+                changes = instance.build()
+                if changes:
+                    build_logger.info('Updated TIM with {} changes'.format(len(changes)))
+            else:
+                build_logger.info('{.name} is being updated by another process'.format(db_file))
+        # Whichever process changed the database, the others must be made
+        # aware of the changes.
+        if not self.ready.is_set() or instance.get_db_state() != self.db_state:
+            self._set_sqlite_instance(instance)
+    
+    def _set_sqlite_instance(self, instance):
+        # Recorded first, so changes made meanwhile are seen next time.
+        self.db_state = instance.get_db_state()
+        self._set_instance(instance)
+    
+    def _load_pickle(self, obsolete_okay):
+        key = self.get_db_key()
+        db_file = sc.db_dir / self.db_name_tmpl.format(key)
+        journal_file = sc.db_dir / self.journal_name_tmpl.format(key)
+        
+        instance = self.instance
+        if instance is None:
+            for file in chain(sc.db_dir.glob(self.db_name_tmpl.format('*')),
+                              sc.db_dir.glob(self.journal_name_tmpl.format('*'))):
+                if file not in (db_file, journal_file):
+                    build_logger.info('{.name} is obsolete, removing'.format(file))
+                    file.unlink()
+            if db_file.exists():
+                build_logger.info('Loading {.name}'.format(db_file))
+                try:
+                    with db_file.open('rb') as f:
+                        instance = pickle.load(f)
+                    if journal_file.exists():
+                        self.journal_length = self._replay_journal(instance, journal_file)
+                    self._set_instance(instance)
+                except (EOFError, ValueError, pickle.UnpicklingError):
+                    build_logger.info('{.name} is corrupt, removing'.format(db_file))
+                    instance = None
+                    db_file.unlink()
+                    if journal_file.exists():
+                        journal_file.unlink()
+            else:
+                build_logger.info('No TIM DB exists')
+        
+        if instance is None:
             build_logger.info('Building new instance, filename = {.name}'.format(db_file))
+            self.up_to_date = True
             instance = self.build()
             self._set_instance(instance)
-            build_logger.info('Saving TIM to disk as {.name}'.format(db_file))
-            with db_file.open('wb') as f:
-                pickle.dump(instance, f)
-            for file in db_files:
-                if file != db_file and file.exists():
-                    file.unlink()
+            self._save_snapshot(instance, db_file, journal_file)
+            return
+        
+        if obsolete_okay:
+            if self.ready.is_set():
+                return
+        
+        self.up_to_date = True
+        changes = instance.build()
+        if changes:
+            build_logger.info('Updated TIM with {} changes'.format(len(changes)))
+            if self.journal_length + len(changes) > self.JOURNAL_MAX:
+                self._save_snapshot(instance, db_file, journal_file)
+            else:
+                with journal_file.open('ab') as f:
+                    pickle.dump(changes, f)
+                self.journal_length += len(changes)
+            # Other users of the TIM must be made aware of the changes.
+            self._set_instance(instance)
     
     def build(self):
         tim = TextInfoModel()
         tim.build()
         return tim
     
+    def rebuild(self, processes=None):
+        """ Rebuild the saved copy with every text file processed again
+
+        The saved copy is replaced as a whole (or for the 'sqlite'
+        tim_backend, updated in place) so running servers carry on using
+        it, picking up the new copy when they next update. processes is
+        as for TextInfoModel.build.
+
+        """
+        key = self.get_db_key()
+        if sc.config.tim_backend == 'sqlite':
+            instance = SqliteBackedTIM(sc.db_dir / self.sqlite_name_tmpl.format(key))
+            with sc.util.filelock(str(instance._db_path) + '.lock'):
+                instance.build(force=True, processes=processes)
+        else:
+            instance = TextInfoModel()
+            instance.build(processes=processes)
+            self._save_snapshot(instance,
+                                sc.db_dir / self.db_name_tmpl.format(key),
+                                sc.db_dir / self.journal_name_tmpl.format(key))
+        return instance
+    
     def get(self):
         self.ready.wait()
         return self.instance
+    
+    def _replay_journal(self, instance, journal_file):
+        """ Apply the changes in the journal, returns the number applied """
+        changes = []
+        with journal_file.open('rb') as f:
+            while True:
+                try:
+                    changes.extend(pickle.load(f))
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    # A partially written entry, the files it refers to
+                    # will be found to be changed on the next update.
+                    break
+        instance.apply_changes(changes)
+        build_logger.info('Replayed {} TIM journal entries'.format(len(changes)))
+        return len(changes)
+    
+    def _save_snapshot(self, instance, db_file, journal_file):
+        build_logger.info('Saving TIM to disk as {.name}'.format(db_file))
+        # Every server process may be saving, each to a file of its own.
+        with tempfile.NamedTemporaryFile(dir=str(db_file.parent),
+                prefix=db_file.name + '.', suffix='.tmp', delete=False) as f:
+            try:
+                pickle.dump(instance, f)
+            except:
+                f.close()
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, str(db_file))
+        if journal_file.exists():
+            journal_file.unlink()
+        self.journal_length = 0
         
     def _set_instance(self, instance):
         self.instance = instance
@@ -166,7 +300,7 @@ class TIMManager:
             import sc.scimm
             imm = sc.scimm.imm(wait=False)
             if imm:
-                imm.tim = instance
+                imm.set_tim(instance)
         except NameError:
             pass
 
@@ -186,9 +320,16 @@ class TextInfoModel:
 
     """
     FILES_N = 200
+    CHUNK_SIZE = 100
+    HEAD_CHUNK_SIZE = 16384
+    # Longer than any of the markers looked for by _needs_full_parse.
+    MARKER_OVERLAP = 1024
+    _section_sutta_rex = regex.compile(rb'<section\b[^>]*\bsutta\b')
     def __init__(self):
         self._by_lang = {}
         self._by_uid = {}
+        # File records keyed by path relative to the text dir.
+        self._files = {}
     
     def build_process(self, percent):
         if percent % 10 == 0:
@@ -242,6 +383,19 @@ class TextInfoModel:
         except KeyError:
             return False
 
+    def get_langs(self):
+        return list(self._by_lang)
+
+    def get_nav_entries(self, lang_uid):
+        """ Returns a dict of the entries of a language keyed by uid
+
+        Only the uid, lang, bookmark, name, prev_uid and next_uid of the
+        entries are needed, which is all that navigating between texts
+        uses, so a backend can avoid loading the rest.
+
+        """
+        return self.get(lang_uid=lang_uid)
+
     def add_text_info(self, lang_uid, uid, textinfo):
         if lang_uid not in self._by_lang:
             self._by_lang[lang_uid] = {}
@@ -268,7 +422,21 @@ class TextInfoModel:
         if m1 and m2 and m1 == m2:
             return True
     
-    def build(self, force=False):
+    def build(self, force=False, processes=None):
+        """ Scan the texts and bring the model up to date
+
+        Only text files which have been added, changed (by mtime or size)
+        or deleted since they were last scanned are processed, unless
+        force is set. The files to be processed are split into chunks
+        (by language, and then into pieces of at most CHUNK_SIZE files),
+        the TextInfo entries are extracted from each chunk, possibly by a
+        pool of worker processes, and then merged in file order, so the
+        result does not depend on how many processes were used. processes
+        defaults to tim_build_processes, 0 means one per CPU.
+
+        Returns the list of changes made, as taken by apply_changes.
+
+        """
         # The pagenumbinator should be scoped because it uses
         # a large chunk of memory which should be gc'd.
         # But it shouldn't be created at all if we don't need it.
@@ -277,94 +445,347 @@ class TextInfoModel:
         file_i = 0
         file_of_total_i = 0
         percent = 0
-        file_count = sum(1 for _ in sc.text_dir.glob('**/*.html'))
-        for lang_dir in sc.text_dir.glob('*'):
-            lang_uid = lang_dir.stem
-            files = sorted(lang_dir.glob('**/*.html'), key=lambda f: sc.util.numericsortkey(f.stem))
-            for i, htmlfile in enumerate(files):
-             try:
-                if not self._should_process_file(htmlfile, force):
-                    continue
-                logger.info('Adding file: {!s}'.format(htmlfile))
-                uid = htmlfile.stem
-                root = html.parse(str(htmlfile)).getroot()
-
-                # Set the previous and next uids, using explicit data
-                # if available, otherwise making a safe guess.
-                # The safe guess relies on comparing uids, and will not
-                # capture relationships such as the order of patimokha
-                # rules.
-                prev_uid = root.get('data-prev')
-                next_uid = root.get('data-next')
-                if not (prev_uid or next_uid):
-                    if i > 0:
-                        prev_uid = files[i - 1].stem
-                        if not self.uids_are_related(uid, prev_uid):
-                            prev_uid = None
-                    if i + 1 < len(files):
-                        next_uid = files[i + 1].stem
-                        if not self.uids_are_related(uid, next_uid):
-                            next_uid = None
-                
-                path = htmlfile.relative_to(sc.text_dir)
-                author = self._get_author(root, lang_uid, uid)
-                name = self._get_name(root, lang_uid, uid)
-                volpage = self._get_volpage(root, lang_uid, uid)
-                embedded = self._get_embedded_uids(root, lang_uid, uid)
-                
-                fstat = htmlfile.stat()
-                cdate = self.datestr(fstat.st_ctime)
-                mdate = self.datestr(fstat.st_mtime)
-
-                textinfo = TextInfo(uid=uid, lang=lang_uid, path=path, 
-                                    name=name, author=author,
-                                    volpage=volpage, prev_uid=prev_uid,
-                                    next_uid=next_uid,
-                                    cdate=cdate,
-                                    mdate=mdate)
-                self.add_text_info(lang_uid, uid, textinfo)
-
-                for child in embedded:
-                    child.path = path
-                    child.author = author
-                    self.add_text_info(lang_uid, child.uid, child)
-
-                m = regex.match(r'(.*?)(\d+)-(\d+)$', uid)
-                if m:
-                    range_textinfo = TextInfo(uid=uid+'#', lang=lang_uid, path=path, name=name, author=author, volpage=volpage)
-                    start = int(m[2])
-                    end = int(m[3]) + 1
-                    for i in range(start, end):
-                        iuid = m[1] + str(i)
-                        if self.exists(iuid, lang_uid):
-                            continue
-
-                        self.add_text_info(lang_uid, iuid, range_textinfo)
-                file_i += 1
-                if (file_i % self.FILES_N) == 0:
-                    self._on_n_files()
-                file_of_total_i += 1
-                new_percent = int(0.5 + 100 * file_of_total_i / file_count)
-                if new_percent > percent:
-                    percent = new_percent
-                    self.build_process(percent)
-             except Exception as e:
-                 print('An exception occured: {!s}'.format(htmlfile))
-                 raise
-        if (file_i % self.FILES_N) != 0:
-            self._on_n_files()
+        seen = set()
+        chunks = list(self._get_chunks(force, seen))
+        file_count = sum(len(files) for lang_uid, files in chunks)
+        changes = [('delete', path) for path in self._get_file_paths() if path not in seen]
+        if file_count:
+            processes = self._get_build_processes(len(chunks), processes)
+            build_logger.info('Processing {} TIM files using {} process(es)'.format(
+                file_count, processes))
+            start = time.time()
+            if processes > 1:
+                results = self._extract_chunks_in_pool(chunks, processes)
+            else:
+                results = (self.extract_chunk(lang_uid, files)
+                           for lang_uid, files in chunks)
+            for lang_uid, records in results:
+                for path, record in records:
+                    changes.append(('set', path, record))
+                    file_i += 1
+                    if (file_i % self.FILES_N) == 0:
+                        self._on_n_files()
+                    file_of_total_i += 1
+                    new_percent = int(0.5 + 100 * file_of_total_i / file_count)
+                    if new_percent > percent:
+                        percent = new_percent
+                        self.build_process(percent)
+            if (file_i % self.FILES_N) != 0:
+                self._on_n_files()
+            build_logger.info('Processing {} TIM files took {:.1f} seconds'.format(
+                file_count, time.time() - start))
+        self.apply_changes(changes)
         
         del self._ppn
+        return changes
+
+    def apply_changes(self, changes):
+        """ Apply ('set', path, record) and ('delete', path) changes
+
+        Afterwards the entries of each affected language are rebuilt.
+
+        """
+        langs = set()
+        for change in changes:
+            path = change[1]
+            old_lang_uid = self._remove_file_record(path)
+            if old_lang_uid:
+                langs.add(old_lang_uid)
+            if change[0] == 'set':
+                record = change[2]
+                self._set_file_record(path, record)
+                langs.add(record.textinfo.lang)
+        for lang_uid in sorted(langs):
+            self._reindex_lang(lang_uid)
+
+    # Storage primitives, which a subclass may override to store the
+    # model in something other than python dicts.
+
+    def _get_file_paths(self):
+        return list(self._files)
+
+    def _get_file_record(self, path):
+        return self._files.get(path)
+
+    def _get_file_fingerprint(self, path):
+        """ Returns the (mtime_ns, size) of a file's record, or None """
+        record = self._files.get(path)
+        return (record.mtime_ns, record.size) if record else None
+
+    def _get_lang_file_records(self, lang_uid):
+        return [(path, record) for path, record in self._files.items()
+                if record.textinfo.lang == lang_uid]
+
+    def _set_file_record(self, path, record):
+        self._files[path] = record
+
+    def _remove_file_record(self, path):
+        """ Remove the record of a file, returns its lang_uid if present """
+        old = self._files.pop(path, None)
+        return old.textinfo.lang if old else None
+
+    def _set_lang_entries(self, lang_uid, entries):
+        """ Replace the entries of a language with the entries dict
+
+        The new entries are swapped in one uid at a time, so other
+        threads see either the old or the new entry, never no entry.
+
+        """
+        old_entries = self._by_lang.get(lang_uid, {})
+        if entries:
+            self._by_lang[lang_uid] = entries
+        else:
+            self._by_lang.pop(lang_uid, None)
+        for uid in old_entries.keys() - entries.keys():
+            by_lang = dict(self._by_uid[uid])
+            del by_lang[lang_uid]
+            if by_lang:
+                self._by_uid[uid] = by_lang
+            else:
+                del self._by_uid[uid]
+        for uid, textinfo in entries.items():
+            if old_entries.get(uid) is not textinfo:
+                by_lang = dict(self._by_uid.get(uid, {}))
+                by_lang[lang_uid] = textinfo
+                self._by_uid[uid] = by_lang
+
+    def _reindex_lang(self, lang_uid):
+        """ Rebuild the entries of a language from its file records
+
+        This is where the guessed previous and next uids and the range
+        entries are determined, since they depend on the neighbouring
+        files.
+
+        """
+        records = sorted(self._get_lang_file_records(lang_uid),
+                         key=lambda t: (sc.util.numericsortkey(t[1].textinfo.uid), t[0]))
+        entries = {}
+        for i, (path, record) in enumerate(records):
+            textinfo = record.textinfo
+            uid = textinfo.uid
+            if not record.explicit_order:
+                # Make a safe guess, this relies on comparing uids,
+                # and will not capture relationships such as the order
+                # of patimokha rules.
+                prev_uid = None
+                next_uid = None
+                if i > 0:
+                    prev_uid = records[i - 1][1].textinfo.uid
+                    if not self.uids_are_related(uid, prev_uid):
+                        prev_uid = None
+                if i + 1 < len(records):
+                    next_uid = records[i + 1][1].textinfo.uid
+                    if not self.uids_are_related(uid, next_uid):
+                        next_uid = None
+                textinfo.prev_uid = prev_uid
+                textinfo.next_uid = next_uid
+            entries[uid] = textinfo
+
+            for child in record.embedded:
+                child.path = textinfo.path
+                child.author = textinfo.author
+                entries[child.uid] = child
+
+            m = regex.match(r'(.*?)(\d+)-(\d+)$', uid)
+            if m:
+                range_textinfo = TextInfo(uid=uid+'#', lang=lang_uid,
+                                          path=textinfo.path,
+                                          name=textinfo.name,
+                                          author=textinfo.author,
+                                          volpage=textinfo.volpage)
+                start = int(m[2])
+                end = int(m[3]) + 1
+                for i in range(start, end):
+                    iuid = m[1] + str(i)
+                    if iuid in entries:
+                        continue
+
+                    entries[iuid] = range_textinfo
+
+        self._set_lang_entries(lang_uid, entries)
+
+    def _get_chunks(self, force, seen):
+        """ Yields (lang_uid, files) chunks of files to be processed
+
+        The paths (relative to the text dir) of all files found are
+        added to seen.
+
+        """
+        by_lang = {}
+        for path, fstat in sc.changes.text_watcher.stats().items():
+            lang_uid, sep, rest = path.partition(os.sep)
+            if sep and path.endswith('.html'):
+                by_lang.setdefault(lang_uid, []).append((path, fstat))
+        for lang_uid in sorted(by_lang):
+            files = sorted(by_lang[lang_uid], key=lambda t: sc.util.numericsortkey(pathlib.Path(t[0]).stem))
+            chunk = []
+            for path, fstat in files:
+                seen.add(path)
+                if not self._should_process_file(path, fstat, force):
+                    continue
+                chunk.append(str(sc.text_dir / path))
+                if len(chunk) == self.CHUNK_SIZE:
+                    yield lang_uid, chunk
+                    chunk = []
+            if chunk:
+                yield lang_uid, chunk
+
+    def _get_build_processes(self, chunk_count, processes=None):
+        if processes is None:
+            processes = sc.config.tim_build_processes or 1
+        if processes <= 0:
+            processes = sc.util.cpu_count()
+        return max(1, min(processes, chunk_count))
+
+    def _extract_chunks_in_pool(self, chunks, processes):
+        """ Yields the extracted chunks, in order, from a process pool """
+        worker_stats = {}
+        with sc.util.process_pool(processes) as pool:
+            # The workers may not share this process's text dir.
+            for lang_uid, records, pid, seconds in pool.imap(_extract_chunk,
+                    [(lang_uid, files, sc.text_dir) for lang_uid, files in chunks]):
+                files, total = worker_stats.get(pid, (0, 0))
+                worker_stats[pid] = (files + len(records), total + seconds)
+                yield lang_uid, records
+        for pid, (files, seconds) in sorted(worker_stats.items()):
+            build_logger.info('TIM build worker {}: {} files in {:.1f} seconds '
+                '({:.1f} files/second)'.format(pid, files, seconds,
+                    files / seconds if seconds else 0))
+
+    def extract_chunk(self, lang_uid, files, text_dir=None):
+        """ Returns a list of (path, FileRecord) for the files
+
+        The paths are relative to text_dir, by default sc.text_dir.
+
+        """
+        text_dir = text_dir or sc.text_dir
+        records = []
+        for filename in files:
+            htmlfile = pathlib.Path(filename)
+            try:
+                records.append((str(htmlfile.relative_to(text_dir)),
+                                self.extract_file(htmlfile, lang_uid)))
+            except Exception as e:
+                print('An exception occured: {!s}'.format(htmlfile))
+                raise
+        return lang_uid, records
+
+    def extract_file(self, htmlfile, lang_uid):
+        logger.info('Adding file: {!s}'.format(htmlfile))
+        uid = htmlfile.stem
+        fstat = htmlfile.stat()
+        with htmlfile.open('rb') as f:
+            root = None
+            if html.has_pull_parser and fstat.st_size > self.HEAD_CHUNK_SIZE:
+                root = self._parse_head(f, uid, lang_uid)
+            if root is None:
+                f.seek(0)
+                root = html.parse(f).getroot()
+
+        # Explicit previous and next uids, if not available a
+        # guess is made when the language is indexed.
+        prev_uid = root.get('data-prev')
+        next_uid = root.get('data-next')
+        
+        path = htmlfile.relative_to(sc.text_dir)
+        author = self._get_author(root, lang_uid, uid)
+        name = self._get_name(root, lang_uid, uid)
+        volpage = self._get_volpage(root, lang_uid, uid)
+        embedded = self._get_embedded_uids(root, lang_uid, uid)
+        
+        cdate = self.datestr(fstat.st_ctime)
+        mdate = self.datestr(fstat.st_mtime)
+
+        textinfo = TextInfo(uid=uid, lang=lang_uid, path=path, 
+                            name=name, author=author,
+                            volpage=volpage, prev_uid=prev_uid,
+                            next_uid=next_uid,
+                            cdate=cdate,
+                            mdate=mdate)
+        return FileRecord(mtime_ns=fstat.st_mtime_ns,
+                          size=fstat.st_size,
+                          textinfo=textinfo,
+                          embedded=embedded,
+                          explicit_order=bool(prev_uid or next_uid))
+
+    def _needs_full_parse(self, data, uid):
+        """ Returns True if the text may contain embedded uids
+
+        This is a conservative check of the raw document (or a part of
+        it) for the things which _get_embedded_uids looks for, if none of
+        them are present it would find nothing even in the full document.
+
+        """
+        return ('-pm' in uid
+                or b'data-uid' in data
+                or b'embeddedparallel' in data
+                or len(self._section_sutta_rex.findall(data)) > 1)
+
+    def _parse_head(self, f, uid, lang_uid):
+        """ Parse only as much of the document as is needed
+
+        The file is read in HEAD_CHUNK_SIZE chunks, which are fed to the
+        parser until the first author meta, the first .hgroup and (for
+        the languages which have them) the first volpage anchor are
+        complete. Since the metadata getters take the first match in
+        document order the partial document gives the same results as
+        the full document. If something is missing the whole document
+        ends up being parsed.
+
+        The rest of the file is only scanned, and if _needs_full_parse
+        finds something None is returned, the caller must then parse
+        the whole document. Requires html.has_pull_parser.
+
+        """
+        parser = html.get_pull_parser(events=('start', 'end'))
+        parsing = True
+        hgroup = None
+        found_author = False
+        found_name = False
+        volpage_classes = self._volpage_classes.get(lang_uid)
+        found_volpage = volpage_classes is None
+        # The end of the previous chunk is scanned again, in case a
+        # marker was split between the chunks.
+        tail = b''
+        sections = 0
+        for chunk in iter(lambda: f.read(self.HEAD_CHUNK_SIZE), b''):
+            window = tail + chunk
+            if self._needs_full_parse(window, uid):
+                return None
+            # Sections which ended in the tail were counted last time.
+            sections += sum(1 for m in self._section_sutta_rex.finditer(window)
+                            if m.end() > len(tail))
+            if sections > 1:
+                return None
+            tail = window[-self.MARKER_OVERLAP:]
+            if not parsing:
+                continue
+            parser.feed(chunk)
+            for event, e in parser.read_events():
+                if event == 'start':
+                    if hgroup is None and 'hgroup' in e.get('class', '').split():
+                        hgroup = e
+                elif e.tag == 'meta' and 'author' in e.attrib:
+                    found_author = True
+                elif e is hgroup:
+                    found_name = True
+                elif not found_volpage and e.tag == 'a':
+                    found_volpage = self._has_class(e, volpage_classes)
+            parsing = not (found_author and found_name and found_volpage)
+        return parser.close()
 
     def _on_n_files(self):
         return
-    def _should_process_file(self, file, force):
-        return True
+    def _should_process_file(self, path, fstat, force):
+        if force:
+            return True
+        return self._get_file_fingerprint(path) != tuple(fstat)
     
     # Class Variables
     _build_lock = threading.Lock()
     _build_ready = threading.Event()
     _instance = None
+    _ppn = None
     
     def _get_author(self, root, lang_uid, uid):
         try:
@@ -393,23 +814,38 @@ class TextInfoModel:
             logger.warn('Could not determine name for {}/{}'.format(lang_uid, uid))
             return ''
     
+    # The classes of the page anchors used for volpages
+    _volpage_classes = {'zh': {'t', 't-linehead'},
+                        'pi': {'ms'}}
+    
+    @staticmethod
+    def _has_class(element, classes):
+        """ Returns True if element or a descendant has one of the classes """
+        # Much faster than select_one, which compiles a css selector.
+        return any(classes.intersection(e.get('class', '').split())
+                   for e in element.iter('*'))
+    
+    def _get_volpage_anchor(self, element, lang_uid):
+        """ Returns the first page anchor after element """
+        classes = self._volpage_classes[lang_uid]
+        e = element.next_in_order()
+        while e is not None:
+            if e.tag == 'a' and self._has_class(e, classes):
+                return e
+            e = e.next_in_order()
+        return None
+    
     def _get_volpage(self, element, lang_uid, uid):
         if lang_uid == 'zh':
-            e = element.next_in_order()
-            while e is not None:
-                if e.tag =='a' and e.select_one('.t, .t-linehead'):
-                    break
-                e = e.next_in_order()
-            else:
+            e = self._get_volpage_anchor(element, lang_uid)
+            if e is None:
                 return
             return 'T {}'.format(e.attrib['id'])
         elif lang_uid == 'pi':
             ppn = self.get_palipagenumbinator()
-            e = element.next_in_order()
-            while e:
-                if e.tag == 'a' and e.select_one('.ms'):
-                    return ppn.get_pts_ref_from_pid(e.attrib['id'])
-                e = e.next_in_order()
+            e = self._get_volpage_anchor(element, lang_uid)
+            if e is not None:
+                return ppn.get_pts_ref_from_pid(e.attrib['id'])
 
         return None
     
@@ -420,12 +856,25 @@ class TextInfoModel:
         
         if '-pm' in uid:
             # This is a patimokkha text
+            rules = []
             for h4 in root.select('h4'):
                 a = h4.select_one('a[id]')
                 if not a:
                     continue
-                
-                volpage = self._get_volpage(h4, lang_uid, uid)
+                rules.append((h4, a))
+            
+            if lang_uid == 'pi':
+                # Resolve the page numbers of all the rules in one go.
+                anchors = [self._get_volpage_anchor(h4, lang_uid)
+                           for h4, a in rules]
+                refs = iter(self.get_palipagenumbinator().get_pts_refs_from_pids(
+                    [e.attrib['id'] for e in anchors if e is not None]))
+                volpages = [None if e is None else next(refs) for e in anchors]
+            else:
+                volpages = [self._get_volpage(h4, lang_uid, uid)
+                            for h4, a in rules]
+            
+            for (h4, a), volpage in zip(rules, volpages):
                 out.append(TextInfo(
                     uid='{}#{}'.format(uid, a.attrib['id']),
                     bookmark=a.attrib['id'],
@@ -492,13 +941,181 @@ class TextInfoModel:
             finally:
                 TextInfoModel._build_lock.release()
 
+class SqliteBackedTIM(TextInfoModel):
+    """ A TextInfoModel stored in an indexed SQLite database
+
+    Entries are looked up as needed rather than held in memory, so
+    loading is instant and, since the database file is shared, the OS
+    page cache is shared between server processes. The file records
+    are kept in the mtimes table, with the pickled FileRecord, so the
+    model is updated incrementally in the same way.
+
+    The data table is keyed by (uid, lang), the uid and lang of the
+    TextInfo entry itself (which differ for range entries) are stored as
+    text_uid and text_lang.
+
+    """
+    columns = ('uid', 'lang', 'text_uid', 'text_lang') + TextInfo.__slots__[2:]
+
+    def __init__(self, db_path=None):
+        super().__init__()
+        if db_path is None:
+            db_path = sc.db_dir / TIMManager.sqlite_name_tmpl.format(
+                tim_manager.get_db_key())
+        self._db_path = db_path
+        self._tlocal = threading.local()
+        with self._con as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('CREATE TABLE IF NOT EXISTS data ({}, '
+                        'PRIMARY KEY (uid, lang))'.format(', '.join(self.columns)))
+            con.execute('CREATE INDEX IF NOT EXISTS data_lang ON data (lang)')
+            con.execute('CREATE TABLE IF NOT EXISTS mtimes (path PRIMARY KEY, '
+                        'lang, mtime INTEGER, size INTEGER, record BLOB)')
+            con.execute('CREATE INDEX IF NOT EXISTS mtimes_lang ON mtimes (lang)')
+
+    @property
+    def _con(self):
+        # SQLite connections can't be shared between threads.
+        try:
+            return self._tlocal.con
+        except AttributeError:
+            con = sqlite3.connect(str(self._db_path))
+            self._tlocal.con = con
+            return con
+
+    def _textinfo(self, row):
+        return TextInfo(**dict(zip(TextInfo.__slots__, row[2:])))
+
+    def _row(self, uid, lang_uid, textinfo):
+        values = [uid, lang_uid]
+        values.extend(getattr(textinfo, key) for key in TextInfo.__slots__)
+        if textinfo.path is not None:
+            values[4] = str(textinfo.path)
+        return values
+
+    def _select(self, where, args):
+        return self._con.execute('SELECT {} FROM data WHERE {}'.format(
+            ', '.join(self.columns), where), args)
+
+    def is_happy(self):
+        return self._con.execute('SELECT 1 FROM data LIMIT 1').fetchone() is not None
+
+    def get_db_state(self):
+        """ Returns the (mtime_ns, size) of the database and its WAL file
+
+        This changes whenever any connection, in any process, commits a
+        change to the database.
+
+        """
+        out = []
+        for path in (str(self._db_path), str(self._db_path) + '-wal'):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                out.append(None)
+                continue
+            out.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(out)
+
+    def get(self, uid=None, lang_uid=None):
+        if uid and lang_uid:
+            row = self._select('uid = ? AND lang = ?', (uid, lang_uid)).fetchone()
+            return self._textinfo(row) if row else None
+        elif uid:
+            return {row[1]: self._textinfo(row)
+                    for row in self._select('uid = ?', (uid,))}
+        elif lang_uid:
+            return {row[0]: self._textinfo(row)
+                    for row in self._select('lang = ?', (lang_uid,))}
+        else:
+            raise ValueError('At least one of uid or lang_uid must be set')
+
+    def exists(self, uid=None, lang_uid=None):
+        if uid is None and lang_uid is None:
+            raise ValueError
+        if uid is None:
+            sql, args = 'SELECT 1 FROM data WHERE lang = ? LIMIT 1', (lang_uid,)
+        else:
+            sql, args = 'SELECT 1 FROM data WHERE uid = ? LIMIT 1', (uid,)
+        return self._con.execute(sql, args).fetchone() is not None
+
+    def get_langs(self):
+        return [row[0] for row in self._con.execute('SELECT DISTINCT lang FROM data')]
+
+    def get_nav_entries(self, lang_uid):
+        return {row[0]: TextInfo(uid=row[1], lang=row[2], bookmark=row[3],
+                                 name=row[4], prev_uid=row[5], next_uid=row[6])
+                for row in self._con.execute('SELECT uid, text_uid, text_lang, '
+                    'bookmark, name, prev_uid, next_uid FROM data WHERE lang = ?',
+                    (lang_uid,))}
+
+    def add_text_info(self, lang_uid, uid, textinfo):
+        with self._con:
+            self._insert_entries([self._row(uid, lang_uid, textinfo)])
+
+    def apply_changes(self, changes):
+        # Other connections see all of the changes or none of them.
+        with self._con:
+            super().apply_changes(changes)
+
+    def _insert_entries(self, rows):
+        self._con.executemany('INSERT OR REPLACE INTO data ({}) VALUES ({})'.format(
+            ', '.join(self.columns), ', '.join('?' * len(self.columns))), rows)
+
+    def _get_file_paths(self):
+        return [row[0] for row in self._con.execute('SELECT path FROM mtimes')]
+
+    def _get_file_record(self, path):
+        row = self._con.execute('SELECT record FROM mtimes WHERE path = ?', (path,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _get_file_fingerprint(self, path):
+        # From the columns, so that the record needn't be unpickled.
+        row = self._con.execute('SELECT mtime, size FROM mtimes WHERE path = ?', (path,)).fetchone()
+        return tuple(row) if row else None
+
+    def _get_lang_file_records(self, lang_uid):
+        return [(path, pickle.loads(record)) for path, record in self._con.execute(
+            'SELECT path, record FROM mtimes WHERE lang = ?', (lang_uid,))]
+
+    def _set_file_record(self, path, record):
+        self._con.execute('INSERT OR REPLACE INTO mtimes VALUES (?, ?, ?, ?, ?)',
+            (path, record.textinfo.lang, record.mtime_ns, record.size,
+             pickle.dumps(record, pickle.HIGHEST_PROTOCOL)))
+
+    def _remove_file_record(self, path):
+        row = self._con.execute('SELECT lang FROM mtimes WHERE path = ?', (path,)).fetchone()
+        if not row:
+            return None
+        self._con.execute('DELETE FROM mtimes WHERE path = ?', (path,))
+        return row[0]
+
+    def _set_lang_entries(self, lang_uid, entries):
+        # Only the rows which differ are written, usually a change to a
+        # file changes a few of the entries of its language.
+        rows = {uid: tuple(self._row(uid, lang_uid, textinfo))
+                for uid, textinfo in entries.items()}
+        old_rows = {row[0]: tuple(row) for row in self._select('lang = ?', (lang_uid,))}
+        self._con.executemany('DELETE FROM data WHERE uid = ? AND lang = ?',
+            [(uid, lang_uid) for uid in old_rows.keys() - rows.keys()])
+        self._insert_entries(row for uid, row in rows.items()
+                             if old_rows.get(uid) != row)
+
+def _extract_chunk(chunk):
+    # Runs in a worker process of the TIM build pool.
+    lang_uid, files, text_dir = chunk
+    start = time.time()
+    lang_uid, records = TextInfoModel().extract_chunk(lang_uid, files, text_dir)
+    return lang_uid, records, os.getpid(), time.time() - start
+
 tim_manager = TIMManager()
 
 def tim():
     return tim_manager.get()
     
 def periodic_update(i):
-    tim_manager.load()
+    if i == 0 or not tim_manager.up_to_date:
+        tim_manager.load()
         
 
 def rebuild_tim():
@@ -539,48 +1156,141 @@ class PaliPageNumbinator:
         'y': 'Ya'}
 
     default_attempts = [0,-1,-2,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,-14,-15,1,2,3,4,5]
-    def __init__(self):
-        self.load()
+    # The default attempts as a window, searching down from msnum
+    # then up from msnum.
+    default_below = 15
+    default_above = 5
+    
+    # (table stat, books) shared by all instances, so that it is not
+    # reloaded for every TIM build.
+    _cache = None
+    
+    def __init__(self, rows=None):
+        """ rows are (msbook, msnum, edition, book, page), by default
+        those of the pali_concord table.
+        """
+        if rows is None:
+            self.load()
+        else:
+            self.books = self.make_books(rows)
 
     def load(self):
+        """ Load the concordance table, see make_books """
         from sc.scimm import table_reader
 
-        reader = table_reader('pali_concord')
+        table_file = sc.table_dir / 'pali_concord.csv'
+        fstat = table_file.stat()
+        key = (fstat.st_mtime_ns, fstat.st_size)
+        cache = PaliPageNumbinator._cache
+        if cache and cache[0] == key:
+            self.books = cache[1]
+            return
+
+        self.books = self.make_books(table_reader('pali_concord'))
+        PaliPageNumbinator._cache = (key, self.books)
 
-        mapping = {(msbook, int(msnum), edition): (book, page)
-                for msbook, msnum, edition, book, page in reader}
-        self.mapping = mapping
+    @staticmethod
+    def make_books(rows):
+        """ Returns the concordance rows as per-book sorted arrays
+
+        For each msbook there is a sorted array of msnums and a list of
+        the (book, page) for each msnum, from the pts1 edition if it has
+        one otherwise from the pts2 edition.
+
+        """
+        entries = {}
+        for msbook, msnum, edition, book, page in rows:
+            if edition not in ('pts1', 'pts2'):
+                continue
+            entries[(msbook, int(msnum), edition)] = (book, page)
+        
+        books = {}
+        for (msbook, msnum, edition), value in entries.items():
+            if edition == 'pts2' and (msbook, msnum, 'pts1') in entries:
+                continue
+            books.setdefault(msbook, []).append((msnum, value))
+        for msbook, items in books.items():
+            items.sort(key=lambda t: t[0])
+            books[msbook] = (array('l', (t[0] for t in items)),
+                             [t[1] for t in items])
+        return books
 
     def msbook_to_ptsbook(self, msbook):
         m = regex.match(r'\d+([A-Za-z]+(?:(?<=th)[12])?)', msbook)
         return self.msbook_to_ptsbook_mapping[m[1]]
 
-    def get_pts_ref_from_pid(self, pid):
+    def parse_pid(self, pid):
         m = regex.match(r'p_(\w+)_(\d+)', pid)
+        return m[1].lower(), int(m[2])
 
-        msbook = m[1].lower()
-        msnum = int(m[2])
+    def get_pts_ref_from_pid(self, pid):
+        msbook, msnum = self.parse_pid(pid)
         return self.get_pts_ref(msbook, msnum)
-        
+    
+    def get_pts_refs_from_pids(self, pids):
+        """ Returns the pts refs for many pids, in the same order
+
+        The pids are resolved a book at a time in msnum order, so that
+        each search only needs to look beyond the previous one.
+
+        """
+        out = [None] * len(pids)
+        by_book = {}
+        for i, pid in enumerate(pids):
+            msbook, msnum = self.parse_pid(pid)
+            by_book.setdefault(msbook, []).append((msnum, i))
+        for msbook, items in by_book.items():
+            items.sort()
+            lo = 0
+            for msnum, i in items:
+                out[i], lo = self._find(msbook, msnum, lo)
+        return out
         
     def get_pts_ref(self, msbook, msnum, attempts=None):
         if not attempts:
-            attempts = self.default_attempts
+            return self._find(msbook, msnum)[0]
         for i in attempts:
             n = msnum + i
             if n < 1:
                 continue
-            key1 = (msbook, n, 'pts1')
-            key2 = (msbook, n, 'pts2')
-            key = None
-            if key1 in self.mapping:
-                key = key1
-            elif key2 in self.mapping:
-                key = key2
-            if key:
-                book, num = self.mapping[key]
-                ptsbook = self.msbook_to_ptsbook(msbook)
-                return self.format_book(ptsbook, book, num)
+            value = self._lookup(msbook, n)
+            if value:
+                return self._format(msbook, value)
+    
+    def _lookup(self, msbook, msnum):
+        try:
+            nums, values = self.books[msbook]
+        except KeyError:
+            return None
+        i = bisect_left(nums, msnum)
+        if i < len(nums) and nums[i] == msnum:
+            return values[i]
+        return None
+    
+    def _find(self, msbook, msnum, lo=0):
+        """ Search as the default attempts do, returns (ref, index)
+
+        That is the greatest msnum no more than default_below less than
+        msnum, or failing that the least msnum no more than
+        default_above greater. The index can be passed as lo to
+        subsequent searches for greater msnums.
+
+        """
+        try:
+            nums, values = self.books[msbook]
+        except KeyError:
+            return None, lo
+        i = bisect_right(nums, msnum, lo)
+        if i > 0 and nums[i - 1] >= max(1, msnum - self.default_below):
+            return self._format(msbook, values[i - 1]), i - 1
+        if i < len(nums) and nums[i] <= msnum + self.default_above:
+            return self._format(msbook, values[i]), i
+        return None, max(i - 1, 0)
+    
+    def _format(self, msbook, value):
+        book, num = value
+        ptsbook = self.msbook_to_ptsbook(msbook)
+        return self.format_book(ptsbook, book, num)
 
     def format_book(self, ptsbook, book, num):
         if not book:
@@ -356,6 +356,78 @@ def mc4(word1, word2):
 def mc4_boost(freq, factor=100):
     return _math.log(factor) / _math.log(factor + freq)
 
+def edit_distance(word1, word2, max_distance=None):
+    """ Returns the number of edits between two words
+
+    An edit is the insertion, deletion or substitution of a letter or the
+    transposition of two adjacent letters (optimal string alignment). If
+    the distance is greater than max_distance, max_distance + 1 is returned
+    as soon as that is known.
+
+    """
+    if max_distance is None:
+        max_distance = max(len(word1), len(word2))
+    if abs(len(word1) - len(word2)) > max_distance:
+        return max_distance + 1
+    before = None
+    previous = list(range(len(word2) + 1))
+    for i, c1 in enumerate(word1, 1):
+        row = [i]
+        for j, c2 in enumerate(word2, 1):
+            distance = min(previous[j] + 1, row[j - 1] + 1,
+                           previous[j - 1] + (c1 != c2))
+            if (i > 1 and j > 1 and c1 != c2 and c1 == word2[j - 2]
+                    and word1[i - 2] == c2):
+                distance = min(distance, before[j - 2] + 1)
+            row.append(distance)
+        if min(row) > max_distance:
+            return max_distance + 1
+        before, previous = previous, row
+    return min(previous[-1], max_distance + 1)
+
+class DeletionIndex:
+    """ Finds the words within one edit of a word
+
+    This is a deletion dictionary (as in SymSpell): every word is indexed
+    by its prefix and by the prefix with each letter in turn deleted, and
+    two words within one edit of each other share at least one such key.
+    Only prefixes are indexed because inflected forms share prefixes,
+    which keeps the index small, the candidates under the keys are then
+    checked with edit_distance.
+
+    """
+
+    def __init__(self, words, prefix_length=7):
+        self.prefix_length = prefix_length
+        prefixes = {}
+        for word in words:
+            prefixes.setdefault(word[:prefix_length], []).append(word)
+        self.words = list(prefixes.values())
+        self.index = {}
+        for i, prefix in enumerate(prefixes):
+            for key in self.keys(prefix):
+                self.index.setdefault(key, []).append(i)
+
+    @staticmethod
+    def keys(prefix):
+        return {prefix} | {prefix[:i] + prefix[i+1:] for i in range(len(prefix))}
+
+    def lookup(self, word):
+        "Returns a list of (distance, word) within one edit of word, closest first"
+        seen = set()
+        out = []
+        for key in self.keys(word[:self.prefix_length]):
+            for i in self.index.get(key, ()):
+                if i in seen:
+                    continue
+                seen.add(i)
+                for candidate in self.words[i]:
+                    distance = edit_distance(word, candidate, 1)
+                    if distance <= 1:
+                        out.append((distance, candidate))
+        out.sort()
+        return out
+
 _unused = set(range(1, 31))
 _unused.remove(1)
 _unused = sorted(_unused)
@@ -1,18 +1,28 @@
 import os
+import time
+import shutil
+import hashlib
+import logging
 import threading
 import sqlite3
 import regex
 import lxml.html
 import functools
 from array import array
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from html import escape
 
 import sc
+import sc.changes
+import sc.textfunctions
+import sc.util
 from sc import declensions
 from sc.classes import FulltextResultsCategory, HTMLRow
 from sc.textfunctions import *
 
+logger = logging.getLogger(__name__)
+
 class PrettyRow(sqlite3.Row):
     def __repr__(self):
         out = []
@@ -25,6 +35,8 @@ class PrettyRow(sqlite3.Row):
 tlocals = threading.local()
 tlocals.con = {}
 
+uidfind = regex.compile(r'.*/([\w-]+(?:\.[\d-]+)?)').findall
+
 def rank(data):
     "Taken from SQLite3 fts3/4 documentation c -> python"
     aMatchInfo = array('i', data)
@@ -42,6 +54,79 @@ def rank(data):
                 score += nHitCount / nGlobalHitCount
     return score
 
+@functools.lru_cache()
+def fts5_available():
+    "Returns whether SQLite has the fts5 extension"
+    con = sqlite3.connect(':memory:')
+    try:
+        con.execute('CREATE VIRTUAL TABLE t USING fts5(text)')
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        con.close()
+    return True
+
+# fts5 tokenizers equivalent to the fts4 tokenizers.
+fts5_tokenizers = {'porter': 'porter ascii', 'simple': 'ascii'}
+
+fts4_query_tokens = regex.compile(r'"[^"]*"\*?|NEAR/\d+|[^\s,"]+').findall
+
+@functools.lru_cache(200)
+def fts5_query(query):
+    """ Translate a query in the fts4 standard syntax to fts5 syntax
+
+    In the fts4 standard syntax OR binds more tightly than the implicit
+    AND, -term excludes a term and NEAR/n sits between terms, none of
+    which is so for fts5. fts5 also doesn't allow an implicit AND next
+    to parentheses, so AND is always explicit. Every term is quoted,
+    because fts5 only allows letters and digits in barewords. Returns ''
+    if nothing is to be matched.
+
+    """
+    def quote(term):
+        prefix = term.rstrip('"').endswith('*')
+        term = term.strip('"*')
+        return '"{}"{}'.format(term.replace('"', '""'), '*' if prefix else '')
+
+    # Groups are ANDed, each group is a list of alternatives to be ORed,
+    # each alternative a list of terms NEAR each other and their distance.
+    groups = []
+    excluded = []
+    operator = None
+    for token in fts4_query_tokens(query):
+        if token == 'OR' or token == 'NEAR' or token.startswith('NEAR/'):
+            operator = token
+            continue
+        if token.startswith('-') and len(token) > 1:
+            excluded.append(quote(token[1:]))
+        elif operator == 'OR' and groups:
+            groups[-1].append(([quote(token)], None))
+        elif operator and groups:
+            # fts5 has one distance for all the terms.
+            terms, distance = groups[-1][-1]
+            pair = 10 if operator == 'NEAR' else int(operator[5:])
+            groups[-1][-1] = (terms + [quote(token)],
+                              pair if distance is None else max(distance, pair))
+        else:
+            groups.append([([quote(token)], None)])
+        operator = None
+
+    out = []
+    for alternatives in groups:
+        alternatives = ['NEAR({}, {})'.format(' '.join(terms), distance)
+                        if len(terms) > 1 else terms[0]
+                        for terms, distance in alternatives]
+        if len(alternatives) > 1:
+            out.append('({})'.format(' OR '.join(alternatives)))
+        else:
+            out.append(alternatives[0])
+    if not out:
+        return ''
+    if excluded:
+        return '({}){}'.format(' AND '.join(out),
+                               ''.join(' NOT ' + term for term in excluded))
+    return ' AND '.join(out)
+
 def fileiter(path, ext=None, rex=None):
     """Iterate over files starting at src.
 
@@ -110,6 +195,11 @@ class SectionSearch:
     In an ideal world we would implemented a custom fts3 tokenizer, but
     these hacks are not particulary ardious and are less work.
 
+    Where SQLite has the fts5 extension it is used instead, the same
+    hacks apply. fts5 ranks results with its built-in bm25 function while
+    fts4 ranks them with the rank function, which is called back for every
+    matching row. Queries are written in the fts4 syntax and translated.
+
     This search implementation is reasonably fast, and as a near
     approximation uses no memory at all.
 
@@ -126,9 +216,12 @@ class SectionSearch:
         self.extensions = extensions
         self.tags = tags
         self.path = sc.text_dir / lang_code
-        if not self.path.exists():
-            raise Exception("Path {} does not exist".format(self.path))
         self.db_path = sc.db_dir / 'search_{}.sqlite'.format(lang_code)
+        # The full text search extension databases are generated with.
+        self.fts = 'fts5' if fts5_available() else 'fts4'
+        # (database stat, DeletionIndex of the ascii forms of the terms)
+        self._fuzzy_index = (None, None)
+        self._fuzzy_lock = threading.Lock()
         self.alias_map = {}
         for group in self.aliases:
             stemmed = [self.stemmer(t) for t in group]
@@ -149,14 +242,20 @@ class SectionSearch:
             tlocals.con
         except AttributeError:
             tlocals.con = {}
+        # A generated database replaces the file, connections to the
+        # old file are not reused.
+        ino = os.stat(str(self.db_path)).st_ino
         try:
-            con = tlocals.con[self.db_path]
+            con, con_ino, fts = tlocals.con[self.db_path]
+            if con_ino != ino:
+                con.close()
+                raise KeyError
         except KeyError:
             con = sqlite3.connect(str(self.db_path))
             con.row_factory=PrettyRow
             con.create_function('rank', 1, rank)
             con.create_function('demangle', 1, demangle)
-            tlocals.con[self.db_path] = con
+            tlocals.con[self.db_path] = (con, ino, self.get_db_fts(con))
         try:
             yield con
         except:
@@ -165,6 +264,26 @@ class SectionSearch:
         finally:
             pass
 
+    @staticmethod
+    def get_db_fts(con):
+        "Returns the full text search extension of a database"
+        try:
+            row = con.execute("SELECT value FROM meta WHERE key = 'fts'").fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        return row[0] if row else 'fts4'
+
+    def db_fts(self):
+        "Returns the full text search extension of the database searched"
+        with self.getcon():
+            return tlocals.con[self.db_path][2]
+
+    def match_query(self, query):
+        "Returns the query in the syntax of the database searched"
+        if self.db_fts() == 'fts5':
+            return fts5_query(query)
+        return query
+
     def execute(self, sql, args=()):
         with self.getcon() as con:
             return con.execute(sql, args)
@@ -172,105 +291,167 @@ class SectionSearch:
         with self.getcon() as con:
             return con.executemany(sql, args)
 
+    def file_stats(self):
+        "Returns a dict of path (relative to the text dir) to FileStat for the files to be indexed"
+        extensions = regex.split(r'[, ]+', self.extensions)
+        prefix = self.lang_code + os.sep
+        out = {}
+        for path, stat in sc.changes.text_watcher.stats().items():
+            if not path.startswith(prefix):
+                continue
+            name, dot, ext = os.path.basename(path).rpartition('.')
+            if dot and ext in extensions:
+                out[path] = stat
+        return out
+
     def files(self):
         "Returns a sorted list of all files to be indexed"
-        return sorted(fileiter(self.path, self.extensions), key=numsortkey)
+        return sorted((str(sc.text_dir / path) for path in self.file_stats()),
+                      key=numsortkey)
 
     def checksum(self):
         "Returns an integer which can be compared to see if the files have changed"
-        return sum(os.stat(f).st_mtime_ns & 4294967295 for f in self.files())
+        return sum(stat.mtime_ns & 4294967295 for stat in self.file_stats().values())
 
     def sanitize(self, string):
         return regex.sub(r'[\u200b]', '', string)
     
     def parse_entries(self):
-        uidfind = regex.compile(r'.*/([\w-]+(?:\.[\d-]+)?)').findall
         entries = []
         stemmed_entries = []
         original_entries = []
         entry_id = 0
         for filename in self.files():
+            for row in self.parse_file(filename):
+                entry_id += 1
+                file_uid, sutta_uid, title, best_id, mang_text, orig_text, stem_text = row
+                entries.append( (entry_id, file_uid, sutta_uid, title, best_id, mang_text) )
+                stemmed_entries.append( (entry_id, stem_text) )
+                original_entries.append( (entry_id, orig_text) )
+        return (entries, original_entries, stemmed_entries)
 
-            file_uid = uidfind(filename)[0]
+    def parse_file(self, filename):
+        """ Returns the entries of one file
 
-            dom = lxml.html.fromstring(open(filename, 'r', encoding='utf-8').read())
-            self.dom = dom
-            for e in dom.cssselect('#metaarea, .hidden'):
-                e.drop_tree()
-                
-            elements = dom.cssselect(self.tags)
-            elements.append(dom.makeelement('SENTINEL'))
-            lasttag = 'p'
-            text_l = []
-            best_id = title = sutta_uid = None
-
-            for i, e in enumerate(elements):
-                if e.tag != 'p' and lasttag == 'p':
-                    if text_l:
-                        # Add this entry.
-
-                        entry_id += 1
-                        mang_text = " «br» ".join(text_l)
-                        orig_text = mang_text.casefold().replace('\xad','')
-                        stem_text = self.stemmer(mang_text)
-
-                        entries.append( (entry_id, file_uid, sutta_uid, title, best_id, mang_text) )
-                        stemmed_entries.append( (entry_id, stem_text) )
-                        original_entries.append( (entry_id, orig_text) )
-
-                        text_l = []
-                        best_id = title = sutta_uid = None
-                if e.tag == 'SENTINEL':
-                    continue
-                if sutta_uid is None:
-                    # Attempt to discover true sutta_uid
-                    # This really needs improvement in the source texts
-                    # but the below bodge works in practise.
-                    try:
-                        
-                        section = next(e.iterancestors('section'))
-                        if 'id' in section.attrib:
-                            t_uid = section.attrib['id']
-                            if t_uid[0].isalpha():
-                                sutta_uid = t_uid
-                        if sutta_uid is None:
-                            hgroup = next(section.iter('hgroup'))
-                            sutta_uid = hgroup.cssselect('[id]')[0].attrib['id']
-                    except (StopIteration, IndexError):
-                        sutta_uid = file_uid
-
-                if e.tag.startswith('h'):
-                    # Choose the best title (prefer shorter, no numbers)
-                    htext = e.text_content()
-                    if not title:
+        Each entry is (file_uid, sutta_uid, title, best_id, mang_text,
+        orig_text, stem_text).
+
+        """
+        file_uid = uidfind(filename)[0]
+        entries = []
+
+        with open(filename, 'r', encoding='utf-8') as f:
+            dom = lxml.html.fromstring(f.read())
+        for e in dom.cssselect('#metaarea, .hidden'):
+            e.drop_tree()
+
+        elements = dom.cssselect(self.tags)
+        elements.append(dom.makeelement('SENTINEL'))
+        lasttag = 'p'
+        text_l = []
+        best_id = title = sutta_uid = None
+
+        for i, e in enumerate(elements):
+            if e.tag != 'p' and lasttag == 'p':
+                if text_l:
+                    # Add this entry.
+                    mang_text = " «br» ".join(text_l)
+                    orig_text, stem_text = self.index_texts(mang_text)
+
+                    entries.append( (file_uid, sutta_uid, title, best_id, mang_text, orig_text, stem_text) )
+
+                    text_l = []
+                    best_id = title = sutta_uid = None
+            if e.tag == 'SENTINEL':
+                continue
+            if sutta_uid is None:
+                # Attempt to discover true sutta_uid
+                # This really needs improvement in the source texts
+                # but the below bodge works in practise.
+                try:
+
+                    section = next(e.iterancestors('section'))
+                    if 'id' in section.attrib:
+                        t_uid = section.attrib['id']
+                        if t_uid[0].isalpha():
+                            sutta_uid = t_uid
+                    if sutta_uid is None:
+                        hgroup = next(section.iter('hgroup'))
+                        sutta_uid = hgroup.cssselect('[id]')[0].attrib['id']
+                except (StopIteration, IndexError):
+                    sutta_uid = file_uid
+
+            if e.tag.startswith('h'):
+                # Choose the best title (prefer shorter, no numbers)
+                htext = e.text_content()
+                if not title:
+                    title = htext
+                else:
+                    if not regex.search(r'\d', htext) and regex.search(r'\d', title):
                         title = htext
-                    else:
-                        if not regex.search(r'\d', htext) and regex.search(r'\d', title):
+                    elif len(title) > len(htext):
                             title = htext
-                        elif len(title) > len(htext):
-                                title = htext
-                    if not best_id:
-                        node = e
-                        if e.getparent() is not None and e.getparent().tag in ('a', 'hgroup'):
-                            node = e.getparent()
-                        for a in node.iter():
-                            try:
-                                best_id = a.attrib['id']
-                                break
-                            except KeyError:
-                                pass
-
-                for a in e.iter('a'):
-                    if a.text is None or regex.search('\d', a.text):
-                        a.drop_tree()
-                text = e.text_content()
-                text = self.sanitize(text)
-                text = mangle(text)
-                text_l.append(text)
-                lasttag = e.tag
-        return (entries, original_entries, stemmed_entries)
-    
-    def generate_search_db(self):
+                if not best_id:
+                    node = e
+                    if e.getparent() is not None and e.getparent().tag in ('a', 'hgroup'):
+                        node = e.getparent()
+                    for a in node.iter():
+                        try:
+                            best_id = a.attrib['id']
+                            break
+                        except KeyError:
+                            pass
+
+            for a in e.iter('a'):
+                if a.text is None or regex.search('\d', a.text):
+                    a.drop_tree()
+            text = e.text_content()
+            text = self.sanitize(text)
+            text = mangle(text)
+            text_l.append(text)
+            lasttag = e.tag
+        return entries
+
+    def index_texts(self, mang_text):
+        """ Returns the (original, stemmed) texts indexed for an entry
+
+        External content fts4 tables need the indexed texts again to
+        delete an entry, so they must be derivable from the entry.
+
+        """
+        return mang_text.casefold().replace('\xad',''), self.stemmer(mang_text)
+
+    def parse_files(self, paths, pool=None):
+        """ Yields (path, entries) for paths relative to the text dir
+
+        The files are parsed in the pool, if one is given.
+
+        """
+        args = [(self.lang_code, str(sc.text_dir / path)) for path in paths]
+        if pool is None:
+            results = map(_parse_file, args)
+        else:
+            results = pool.imap(_parse_file, args, chunksize=8)
+        return zip(paths, results)
+
+    # The modules what is indexed depends on: this one, the endings the
+    # pali stemmer removes and the mangling and asciifying of the texts.
+    # Updates remove the rows of a file by indexing its text again, so
+    # the database must be generated afresh whenever any of them change.
+    db_key_modules = (__file__, declensions.__file__, sc.textfunctions.__file__)
+
+    def get_db_key(self):
+        md5 = hashlib.md5()
+        for path in self.db_key_modules:
+            with open(path, 'rb') as f:
+                md5.update(f.read())
+        return md5.hexdigest()
+
+    def generate_search_db(self, pool=None):
+        # Checked here rather than on creation, so the module can be
+        # imported (by tests, for instance) without the texts.
+        if not self.path.exists():
+            raise Exception("Path {} does not exist".format(self.path))
         tmp_db_path = self.db_path.with_suffix('.sqlite.tmp')
         try:
             tmp_db_path.unlink()
@@ -285,31 +466,157 @@ class SectionSearch:
             uid TEXT,
             heading TEXT,
             bookmark TEXT,
-            text TEXT)''')
-        con.execute('''CREATE VIRTUAL TABLE stemmed
-            USING fts4(content=entries, tokenize={}, file, uid, heading, bookmark, text)'''.format(self.fts_tokenizer))
-        con.execute('''CREATE VIRTUAL TABLE original
-            USING fts4(content=entries, tokenize=simple, file, uid, heading, bookmark, text)''')
+            text TEXT,
+            file_id INT)''')
+        con.execute('CREATE INDEX entries_file_x ON entries(file_id)')
+        if self.fts == 'fts5':
+            con.execute('''CREATE VIRTUAL TABLE stemmed
+                USING fts5(file, uid, heading, bookmark, text, content=entries,
+                content_rowid=entry_id, tokenize='{}')'''.format(fts5_tokenizers[self.fts_tokenizer]))
+            con.execute('''CREATE VIRTUAL TABLE original
+                USING fts5(file, uid, heading, bookmark, text, content=entries,
+                content_rowid=entry_id, tokenize='{}')'''.format(fts5_tokenizers['simple']))
+        else:
+            con.execute('''CREATE VIRTUAL TABLE stemmed
+                USING fts4(content=entries, tokenize={}, file, uid, heading, bookmark, text)'''.format(self.fts_tokenizer))
+            con.execute('''CREATE VIRTUAL TABLE original
+                USING fts4(content=entries, tokenize=simple, file, uid, heading, bookmark, text)''')
+        # The state of the files indexed, for incremental updates. Entries
+        # refer to their file by file_id, file_uid isn't unique.
+        con.execute('CREATE TABLE files(file_id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime_ns INT, size INT)')
+        con.execute('CREATE TABLE meta(key TEXT PRIMARY KEY, value TEXT)')
+        con.executemany('INSERT INTO meta VALUES (?, ?)',
+            [('db_key', self.get_db_key()), ('fts', self.fts)])
+
+        file_stats = self.file_stats()
+        paths = sorted(file_stats, key=numsortkey)
+        entry_id = 0
+        for path, entries in self.parse_files(paths, pool):
+            entry_id = self.insert_file(con, path, file_stats[path], entries, entry_id)
+
+        self.optimize(con)
+        con.close()
+        tmp_db_path.replace(self.db_path)
+
+    def update_search_db(self, pool=None):
+        """ Update the database for the files which changed
+
+        The rows of changed and removed files are deleted, then changed
+        files are parsed again and their rows inserted. As when it is
+        generated, this is done to a copy which then replaces the
+        database, so searches never see a partial update. Returns the
+        number of files updated, or None if the database is missing or
+        was built by a different version of this module and must be
+        generated.
+
+        """
+        if not self.db_path.exists():
+            return None
+        con = sqlite3.connect(str(self.db_path))
+        try:
+            try:
+                db_key = con.execute('SELECT value FROM meta WHERE key = ?',
+                                     ('db_key',)).fetchone()
+            except sqlite3.OperationalError:
+                db_key = None
+            if (db_key is None or db_key[0] != self.get_db_key()
+                    or self.get_db_fts(con) != self.fts):
+                return None
+            indexed = {path: (file_id, (mtime_ns, size)) for file_id, path, mtime_ns, size
+                       in con.execute('SELECT file_id, path, mtime_ns, size FROM files')}
+        finally:
+            con.close()
+
+        file_stats = self.file_stats()
+        changed = sorted((path for path, stat in file_stats.items()
+                          if path not in indexed or indexed[path][1] != tuple(stat)),
+                         key=numsortkey)
+        removed = sorted(indexed.keys() - file_stats.keys())
+        if not changed and not removed:
+            return 0
+
+        tmp_db_path = self.db_path.with_suffix('.sqlite.update')
+        shutil.copyfile(str(self.db_path), str(tmp_db_path))
+        try:
+            con = sqlite3.connect(str(tmp_db_path))
+            try:
+                con.execute('PRAGMA synchronous = 0')
+                for path in removed + changed:
+                    if path in indexed:
+                        self.delete_file(con, indexed[path][0])
+                entry_id = con.execute('SELECT MAX(entry_id) FROM entries').fetchone()[0] or 0
+                for path, entries in self.parse_files(changed, pool):
+                    entry_id = self.insert_file(con, path, file_stats[path], entries, entry_id)
+                self.optimize(con)
+            finally:
+                con.close()
+            tmp_db_path.replace(self.db_path)
+        except:
+            tmp_db_path.unlink()
+            raise
+        return len(changed) + len(removed)
 
-        entries, original_entries, stemmed_entries = self.parse_entries()
+    def insert_file(self, con, path, stat, entries, entry_id):
+        """ Insert a file and its entries, with ids following entry_id
 
-        self.last = (entries, original_entries, stemmed_entries)
+        Returns the last entry id.
 
-        con.executemany('INSERT INTO entries values(?, ?, ?, ?, ?, ?)',
-            entries)
-        con.executemany('INSERT INTO stemmed (docid, text) values (?, ?)',
-            stemmed_entries)
-        con.executemany('INSERT INTO original (docid, text) values (?, ?)',
-            original_entries)
+        """
+        file_id = con.execute('INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)',
+            (path,) + tuple(stat)).lastrowid
+        rows = []
+        for entry in entries:
+            entry_id += 1
+            rows.append((entry_id,) + entry)
+        con.executemany('INSERT INTO entries values(?, ?, ?, ?, ?, ?, ?)',
+            [row[:6] + (file_id,) for row in rows])
+        con.executemany('INSERT INTO stemmed (rowid, text) values (?, ?)',
+            [(row[0], row[7]) for row in rows])
+        con.executemany('INSERT INTO original (rowid, text) values (?, ?)',
+            [(row[0], row[6]) for row in rows])
+        return entry_id
+
+    def delete_file(self, con, file_id):
+        """ Delete a file and its entries
+
+        Deleting from an external content fts4 table tokenizes the row in
+        the content table to find what to remove from the index, but what
+        was indexed is the massaged text alone. So before deleting from
+        each table the row is made to hold exactly what was indexed. fts5
+        is given what was indexed by its delete command.
 
+        """
+        rows = con.execute('SELECT entry_id, text FROM entries WHERE file_id = ?',
+                           (file_id,)).fetchall()
+        for entry_id, mang_text in rows:
+            orig_text, stem_text = self.index_texts(mang_text)
+            for table, text in (('stemmed', stem_text), ('original', orig_text)):
+                if self.fts == 'fts5':
+                    con.execute("INSERT INTO {0}({0}, rowid, text) VALUES('delete', ?, ?)".format(table),
+                        (entry_id, text))
+                    continue
+                con.execute('UPDATE entries SET file = NULL, uid = NULL, heading = NULL, '
+                            'bookmark = NULL, text = ? WHERE entry_id = ?', (text, entry_id))
+                con.execute('DELETE FROM {} WHERE docid = ?'.format(table), (entry_id,))
+        con.execute('DELETE FROM entries WHERE file_id = ?', (file_id,))
+        con.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+
+    def optimize(self, con):
+        "Optimize the full text tables and build the terms table from them"
         con.commit() # Optimize requires commit beforehand.
-        
+
         con.execute("INSERT INTO stemmed(stemmed) VALUES('optimize')")
         con.execute("INSERT INTO original(original) VALUES('optimize')")
 
-        con.execute("CREATE VIRTUAL TABLE ft_terms USING fts4aux(original)")
-        # We create a real table which can be indexed.
-        terms = con.execute('SELECT term, occurrences FROM ft_terms WHERE col="*"').fetchall()
+        con.execute('DROP TABLE IF EXISTS terms')
+        if self.fts == 'fts5':
+            con.execute("CREATE VIRTUAL TABLE ft_terms USING fts5vocab(original, 'row')")
+            # We create a real table which can be indexed.
+            terms = con.execute('SELECT term, cnt FROM ft_terms').fetchall()
+        else:
+            con.execute("CREATE VIRTUAL TABLE ft_terms USING fts4aux(original)")
+            # We create a real table which can be indexed.
+            terms = con.execute('SELECT term, occurrences FROM ft_terms WHERE col="*"').fetchall()
 
         con.execute('CREATE TABLE terms(ascii TEXT, simplified TEXT, phonetic TEXT, original TEXT, freq INT)')
         con.execute('DROP TABLE ft_terms')
@@ -326,9 +633,8 @@ class SectionSearch:
         con.execute('CREATE INDEX terms_simp_x ON terms(simplified)')
         con.execute('CREATE INDEX terms_phon_x ON terms(phonetic)')
         con.execute('CREATE UNIQUE INDEX terms_orig_x ON terms(original)')
-        
+
         con.commit()
-        tmp_db_path.replace(self.db_path)
 
     def stemmer(self, string, query=False):
         """stemmer should pre-stem text before passing it to fts4
@@ -389,6 +695,14 @@ class SectionSearch:
                 rows = self.execute('''SELECT original, freq FROM terms
                     WHERE simplified=? ORDER BY freq DESC''',
                         (s_term,)).fetchall()
+
+            if not rows and len(term) > 3:
+                # Perhaps a typo, try the terms within one edit.
+                words = [word for distance, word in self.get_fuzzy_index().lookup(term)]
+                if words:
+                    rows = self.execute('''SELECT original, freq FROM terms
+                        WHERE ascii IN ({}) ORDER BY freq DESC'''.format(
+                            ','.join('?' * len(words))), words).fetchall()
         if not rows:
             return (None,None)
 
@@ -412,9 +726,31 @@ class SectionSearch:
 
         return (exact_query, stemmed_query)
 
-    @functools.lru_cache(50)
+    def db_stat(self):
+        "Identifies the generation of the database, which is replaced on updates"
+        stat = os.stat(str(self.db_path))
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def get_fuzzy_index(self):
+        """ Returns a DeletionIndex of the ascii forms of the terms
+
+        It is built once for each generation of the database.
+
+        """
+        db_stat = self.db_stat()
+        with self._fuzzy_lock:
+            if self._fuzzy_index[0] != db_stat:
+                words = [row[0] for row in self.execute('SELECT DISTINCT ascii FROM terms')]
+                self._fuzzy_index = (db_stat, DeletionIndex(words))
+            return self._fuzzy_index[1]
+
     def prepare_query(self, query):
         "Prepare the query in a way which preserves control words"
+        return self._prepare_query(query, self.db_stat())
+
+    # Cached for each generation of the database, the terms may change.
+    @functools.lru_cache(50)
+    def _prepare_query(self, query, db_stat):
         terms = regex.split(r'((?:\s+(?:OR|NEAR(?:/\d+)?)\s+|[,\s]+|"[^"]*")+)', query)
         exact_out = []
         stemmed_out = []
@@ -460,16 +796,31 @@ class SectionSearch:
                 
         return (exact_query, stemmed_query)
 
-    @functools.lru_cache(50)
     def get_match_count(self, e_query, s_query):
-        exacts = set(t[0] for t in self.execute('SELECT docid FROM original WHERE original MATCH ?', (e_query,)).fetchall()) if e_query else set()
-        stemmed = set(t[0] for t in self.execute('SELECT docid FROM stemmed WHERE stemmed MATCH ?', (s_query,))) if s_query else frozenset()
-        #assert not stemmed or stemmed.issuperset(exacts), "Exact results not contained within stemmed results"
-        stemmed -= exacts
-        
-        return (len(exacts), len(stemmed))
+        "Returns the number of exact matches and of stemmed matches which aren't exact"
+        return self._get_match_count(e_query, s_query, self.db_stat())
+
+    @functools.lru_cache(50)
+    def _get_match_count(self, e_query, s_query, db_stat):
+        # Counted by SQLite, broad queries match tens of thousands of rows.
+        e_query, s_query = self.match_query(e_query), self.match_query(s_query)
+        exacts = self.execute('SELECT count(*) FROM original WHERE original MATCH ?', (e_query,)).fetchone()[0] if e_query else 0
+        if not s_query:
+            stemmed = 0
+        elif e_query:
+            stemmed = self.execute('''SELECT count(*) FROM stemmed
+                WHERE stemmed MATCH :squery
+                AND rowid NOT IN (SELECT rowid FROM original WHERE original MATCH :query)''',
+                {'query':e_query, 'squery':s_query}).fetchone()[0]
+        else:
+            stemmed = self.execute('SELECT count(*) FROM stemmed WHERE stemmed MATCH ?', (s_query,)).fetchone()[0]
+
+        return (exacts, stemmed)
 
     def search_stemmed(self, e_query, s_query, limit=10, offset=0):
+        if self.db_fts() == 'fts5':
+            return self.search_stemmed_fts5(fts5_query(e_query),
+                fts5_query(s_query), limit, offset)
 
         rows = self.execute('''
             SELECT file, uid, heading, bookmark, demangle(snippet(stemmed, "<b>", "</b> ", " … ", -1, 40)) as snippet FROM stemmed JOIN (
@@ -488,6 +839,9 @@ class SectionSearch:
         return rows
     
     def search_exact(self, query, limit=10, offset=0):
+        if self.db_fts() == 'fts5':
+            return self.search_exact_fts5(fts5_query(query), limit, offset)
+
         rows = self.execute('''
             SELECT file, uid, heading, bookmark, demangle(snippet(original, "<b>", "</b>", " … ", -1, 40)) as snippet FROM original JOIN (
                 SELECT docid, rank(matchinfo(original)) AS rank
@@ -502,6 +856,35 @@ class SectionSearch:
 
         return rows
 
+    # Snippets are only made for the rows within the limit. fts5 sorts by
+    # rank itself, but it ranks every match first, for stemmed searches
+    # most matches are excluded so they are sorted by bm25 after that.
+
+    def search_stemmed_fts5(self, e_query, s_query, limit=10, offset=0):
+        if not s_query:
+            return []
+        exclude = ''
+        if e_query:
+            exclude = 'AND rowid NOT IN (SELECT rowid FROM original WHERE original MATCH :query)'
+        return self.execute('''
+            SELECT file, uid, heading, bookmark, demangle(snippet(stemmed, -1, '<b>', '</b> ', ' … ', 40)) as snippet
+            FROM stemmed
+            WHERE stemmed MATCH :squery {}
+            ORDER BY bm25(stemmed)
+            LIMIT :limit OFFSET :offset'''.format(exclude),
+            {'query':e_query, 'squery':s_query, 'limit':limit, 'offset':offset}).fetchall()
+
+    def search_exact_fts5(self, query, limit=10, offset=0):
+        if not query:
+            return []
+        return self.execute('''
+            SELECT file, uid, heading, bookmark, demangle(snippet(original, -1, '<b>', '</b>', ' … ', 40)) as snippet
+            FROM original
+            WHERE original MATCH :query
+            ORDER BY rank
+            LIMIT :limit OFFSET :offset''',
+            {'query':query, 'limit':limit, 'offset':offset}).fetchall()
+
     def search(self, query, limit=10, offset=0):
         if limit == 0:
             return None
@@ -554,6 +937,11 @@ class PaliStemFilter:
     qsuffixes = set()
     qindeclineables = set()
 
+    # Suffixes longer than this are not removed.
+    max_suffix_len = 7
+    # The number of stems of tokens remembered.
+    memo_size = 65536
+
     def __init__(self):
         if len(self.qsuffixes) == 0:
             self.qsuffixes.update(self.suffixes)
@@ -562,32 +950,64 @@ class PaliStemFilter:
             self.qindeclineables.update(self.indeclineables)
             self.qindeclineables.update(asciify(t) for t in self.indeclineables)
 
+        # A token always has the same stem, and most tokens are common.
+        self.stem_token = functools.lru_cache(self.memo_size)(
+            self.compile(self.indeclineables, self.suffixes))
+        self.stem_qtoken = functools.lru_cache(self.memo_size)(
+            self.compile(self.qindeclineables, self.qsuffixes))
+
+    @staticmethod
+    def build_suffix_trie(suffixes):
+        """ Returns a trie of the suffixes read backwards
+
+        Each node is a dict of letter to node, the key None marks the end
+        of a suffix.
+
+        """
+        trie = {}
+        for suffix in suffixes:
+            node = trie
+            for char in reversed(suffix):
+                node = node.setdefault(char, {})
+            node[None] = True
+        return trie
+
+    def compile(self, indeclineables, suffixes):
+        "Returns a function which stems one token"
+        trie = self.build_suffix_trie(suffixes)
+        sanskrit_to_pali = self.sanskrit_to_pali
+        max_suffix_len = self.max_suffix_len
+
+        def stem_token(token):
+            if token in indeclineables:
+                return token
+            for skt, pli in sanskrit_to_pali:
+                token = token.replace(skt, pli)
+            if token[:-1] == 'n':
+                token = token[:-1] + 'ṃ'
+            # Remove the longest suffix which is less than half the token.
+            node = trie
+            cut = 0
+            for i in range(1, min(max_suffix_len, int(len(token)/2 - 0.5)) + 1):
+                node = node.get(token[-i])
+                if node is None:
+                    break
+                if None in node:
+                    cut = i
+            return token[:-cut] if cut else token
+
+        return stem_token
+
+    def stem_tokens(self, tokens, query=False):
+        "Returns a list of the stems of the tokens"
+        stem_token = self.stem_qtoken if query else self.stem_token
+        return [stem_token(token) if token and token[0].isalpha() else token
+                for token in tokens]
+
     def __call__(self, text, query=False):
-        if query:
-            indeclineables = self.qindeclineables
-            suffixes = self.qsuffixes
-        else:
-            indeclineables = self.indeclineables
-            suffixes = self.suffixes
-        # Simplify the pali
-        
         pieces = self.tokenizer.split(text)
-        for place, token in enumerate(pieces):
-            if place % 2 == 1 or not token or not token[0].isalpha():
-                continue
-            if token not in indeclineables:
-                for skt, pli in self.sanskrit_to_pali:
-                    token = token.replace(skt, pli)
-                if token[:-1] == 'n':
-                    token = token[:-1] + 'ṃ'
-                for i in range(min(7, int(len(token)/2 - 0.5)), 0, -1):
-                    sfx = token[-i:]
-                    if sfx in suffixes:
-                        token = token[:-i]
-                        break
-            
-            #token = asciify(token)
-            pieces[place] = token
+        # Tokens and the separators between them alternate.
+        pieces[::2] = self.stem_tokens(pieces[::2], query)
         return "".join(pieces)
     
 class PaliTextSearch(SectionSearch):
@@ -638,9 +1058,111 @@ vn = VietnameseTextSearch('vn')
 
 all_searchers = {pi.lang_code:pi, en.lang_code:en, vn.lang_code:vn}
 
-def build(all_searchers=all_searchers):
-    for lang in sorted(all_searchers):
-        all_searchers[lang].generate_search_db()
+def _parse_file(args):
+    "Process pool worker, returns the entries of a file"
+    lang_code, filename = args
+    return all_searchers[lang_code].parse_file(filename)
+
+def get_build_processes(processes=None):
+    if processes is None:
+        processes = sc.config.textsearch_build_processes or 1
+    if processes <= 0:
+        processes = sc.util.cpu_count()
+    return processes
+
+def build(all_searchers=all_searchers, incremental=False, processes=None):
+    """ Build the search databases of all languages concurrently
+
+    The files of every language are parsed in one shared process pool.
+    If incremental is true only the files which have changed since a
+    database was built are indexed again, where possible. processes
+    defaults to textsearch_build_processes, 0 means one per CPU.
+
+    """
+    processes = get_build_processes(processes)
+    pool = None
+    if processes > 1:
+        pool = sc.util.process_pool(processes)
+
+    def build_one(searcher):
+        start = time.time()
+        count = searcher.update_search_db(pool) if incremental else None
+        if count is None:
+            searcher.generate_search_db(pool)
+            logger.info('Generated {} in {:.1f} seconds'.format(
+                searcher.db_path.name, time.time() - start))
+        elif count:
+            logger.info('Updated {} files in {} in {:.1f} seconds'.format(
+                count, searcher.db_path.name, time.time() - start))
+
+    try:
+        with ThreadPoolExecutor(len(all_searchers) or 1) as executor:
+            futures = [executor.submit(build_one, all_searchers[lang])
+                       for lang in sorted(all_searchers)]
+            for future in futures:
+                future.result()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def periodic_update(i):
+    # Generating the databases is left to deployment, only those which
+    # exist are kept up to date. Usually only a few files have changed,
+    # which doesn't justify starting a process pool.
+    existing = {lang: searcher for lang, searcher in all_searchers.items()
+                if searcher.db_path.exists()}
+    if existing:
+        build(existing, incremental=True, processes=1)
+
+# Queries for benchmark, common terms are the slowest to rank.
+benchmark_queries = {
+    'pi': ['dhamma', 'bhikkhu', 'bhagavā', 'nibbāna', 'anicca', 'evaṃ me sutaṃ', 'sati*'],
+    'en': ['the', 'monk', 'suffering', 'mind', 'noble eightfold path', 'medit*'],
+    'vn': ['pháp', 'tỳ kheo', 'khổ'],
+}
+
+def benchmark(lang, queries=None, repeat=5, limit=25, processes=None):
+    """ Compare searching with fts5 and bm25 to fts4 and the rank function
+
+    A database of each kind is generated for the language, each query is
+    then run repeat times against both. Returns a dict of fts extension to
+    a list of (query, (exact count, stemmed count), mean seconds).
+
+    """
+    import copy
+    if queries is None:
+        queries = benchmark_queries.get(lang, [])
+    searcher = all_searchers[lang]
+    processes = get_build_processes(processes)
+    pool = None
+    if processes > 1:
+        pool = sc.util.process_pool(processes)
+    results = {}
+    try:
+        for fts in ['fts4'] + (['fts5'] if fts5_available() else []):
+            bench = copy.copy(searcher)
+            bench.fts = fts
+            bench.db_path = searcher.db_path.with_name(
+                'benchmark_{}_{}.sqlite'.format(lang, fts))
+            bench.generate_search_db(pool)
+            timings = []
+            for query in queries:
+                e_query, s_query = bench.prepare_query(query)
+                counts = bench.get_match_count(e_query, s_query)
+                start = time.perf_counter()
+                for i in range(repeat):
+                    bench.search_exact(e_query, limit=limit)
+                    bench.search_stemmed(e_query, s_query, limit=limit)
+                timings.append((query, counts, (time.perf_counter() - start) / repeat))
+            results[fts] = timings
+            tlocals.con.pop(bench.db_path)[0].close()
+            bench.db_path.unlink()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return results
 
 def count_all(query):
     out = {}
@@ -298,6 +298,22 @@ def get_parser(encoding='utf-8'):
     parser.set_element_class_lookup(CustomLookup(mixins=[('*', HtHtmlElementMixin)]))
     return parser
 
+_custom_lookup = CustomLookup(mixins=[('*', HtHtmlElementMixin)])
+
+# HTMLPullParser was added in lxml 3.3.
+has_pull_parser = hasattr(_etree, 'HTMLPullParser')
+
+def get_pull_parser(events=('end',), encoding='utf-8'):
+    """ Returns a parser which is fed a document a piece at a time
+
+    Events are read with read_events as the document is fed, close
+    returns the root of the (possibly partial) document.
+
+    """
+    parser = _etree.HTMLPullParser(events=events, encoding=encoding)
+    parser.set_element_class_lookup(_custom_lookup)
+    return parser
+
 utf8parser = get_parser('utf-8')
 
 def fromstring(string):
@@ -19,8 +19,11 @@ def run_updaters():
     # Import here to delay intialization code.
     import sc
     import sc.scm
+    import sc.changes
     import sc.scimm
     import sc.textdata
+    import sc.textcontent
+    import sc.textsearch
     import sc.text_image
     import sc.search.dicts
     import sc.search.texts
@@ -29,8 +32,10 @@ def run_updaters():
     from sc.util import filelock
     # name, function, lock needed?
     functions = [
+        ('sc.changes.periodic_update', sc.changes.periodic_update, False),
         ('sc.textdata.periodic_update', sc.textdata.periodic_update, False),
         ('sc.scimm.periodic_update', sc.scimm.periodic_update, False),
+        ('sc.textcontent.periodic_update', sc.textcontent.periodic_update, False),
         ('sc.text_image.update_symlinks', sc.text_image.update_symlinks, False)
     ]
     if sc.config.app['update_search']:
@@ -38,6 +43,7 @@ def run_updaters():
             ('sc.search.dicts.periodic_update', sc.search.dicts.periodic_update, True),
             ('sc.search.suttas.periodic_update', sc.search.suttas.periodic_update, True),
             ('sc.search.texts.periodic_update', sc.search.texts.periodic_update, True),
+            ('sc.textsearch.periodic_update', sc.textsearch.periodic_update, True),
             ('sc.search.autocomplete.periodic_update', sc.search.autocomplete.periodic_update, True)
         ])
     
@@ -8,6 +8,7 @@ import time
 import regex
 from collections import deque
 import itertools
+import multiprocessing
 from contextlib import contextmanager
 from datetime import datetime
 
@@ -70,6 +71,28 @@ def wrap(text, width=80, indent=0):
     ])
     return textwrap.indent(text.strip(), ' ' * indent)
 
+def strip_indentation(text, _rex=regex.compile(r'\n[ \n\t]+')):
+    """Returns text with the whitespace following each newline removed."""
+    return _rex.sub('\n', text)
+
+def strip_indentation_chunks(chunks):
+    """Yields the chunks with the whitespace following each newline removed.
+
+    Joined, the chunks are the same as strip_indentation of the chunks
+    joined, whitespace which follows a newline in an earlier chunk is
+    removed too. Chunks without indentation are only searched.
+    """
+    line_start = False
+    for chunk in chunks:
+        if line_start:
+            chunk = chunk.lstrip(' \n\t')
+            if not chunk:
+                continue
+        if '\n ' in chunk or '\n\n' in chunk or '\n\t' in chunk:
+            chunk = strip_indentation(chunk)
+        line_start = chunk.endswith('\n')
+        yield chunk
+
 def numericsortkey(string, _rex=regex.compile(r'(\d+)')):
     """ Intelligently sorts most kinds of data.
     
@@ -233,6 +256,27 @@ def recursive_merge(dict1, dict2):
 
     return dict1
     
+def process_pool(processes):
+    """Return a multiprocessing Pool of processes worker processes.
+
+    A processes value of 0 or less means one per CPU. The workers are
+    spawned rather than forked where possible (Python 3.4+), it isn't
+    safe to fork a multi-threaded process.
+    """
+    if processes <= 0:
+        processes = cpu_count()
+    try:
+        context = multiprocessing.get_context('spawn')
+    except AttributeError:
+        context = multiprocessing
+    return context.Pool(processes)
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
 def grouper(n, iterable, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
     # grouper(3, 'ABCDEFG', 'x') --> ABC DEF Gxx"
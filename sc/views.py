@@ -1,21 +1,30 @@
 import cherrypy
 import datetime
+import gzip
+import hashlib
 import http.client
 import jinja2
+import jinja2.ext
+import jinja2.lexer
 import newrelic.agent
+import os
 import regex
 import socket
+import tempfile
 import time
 import json
 import urllib.parse
+import zlib
 
 from uuid import uuid4
 
 from webassets.ext.jinja2 import AssetsExtension
 
 import sc
-from sc import assets, config, data_repo, scimm, util
-from sc.menu import get_menu
+from sc import assets, changes, config, data_repo, scimm, textcontent, util
+from sc.cache import text_page_cache
+from sc.textcontent import text_content_store
+from sc.menu import get_menu, get_menu_html
 from sc.scm import scm, data_scm
 from sc.classes import Parallel, Sutta
 import sc.search.query
@@ -23,6 +32,47 @@ import sc.search.query
 import logging
 logger = logging.getLogger(__name__)
 
+class StripIndentationExtension(jinja2.ext.Extension):
+    """Strips indentation from the literal text of HTML templates.
+
+    This is done once when a template is compiled, rather than to every
+    rendered page. Text templates are left alone. Whitespace at the start
+    of literal text can only be removed once it is known what was output
+    before it, ViewBase.strip_indentation does that as the page is
+    rendered.
+    """
+
+    def filter_stream(self, stream):
+        if stream.name and stream.name.endswith('.txt'):
+            yield from stream
+            return
+        for token in stream:
+            if token.type == 'data':
+                token = jinja2.lexer.Token(token.lineno, token.type,
+                    util.strip_indentation(token.value))
+            yield token
+
+class AtomicFileSystemBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """A bytecode cache which replaces cache files atomically.
+
+    Several processes can compile the same template at once, so a cache
+    file is written to a temporary file which then replaces it, rather
+    than in place where another process could load it half written.
+    """
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(filename),
+                prefix=os.path.basename(filename) + '.', suffix='.tmp',
+                delete=False) as f:
+            try:
+                bucket.write_bytecode(f)
+            except:
+                f.close()
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, filename)
+
 __jinja2_environment = None
 def jinja2_environment():
     """Return the Jinja2 environment singleton used by all views.
@@ -35,9 +85,16 @@ def jinja2_environment():
     if __jinja2_environment:
         return __jinja2_environment
 
+    if not sc.jinja2_bytecode_cache_dir.exists():
+        sc.jinja2_bytecode_cache_dir.mkdir(parents=True)
+
     env = jinja2.Environment(
         loader=jinja2.FileSystemLoader(str(sc.templates_dir)),
-        extensions=[AssetsExtension],
+        # The cached bytecode depends on the extensions as well as the
+        # template source, the pattern must change when they do.
+        bytecode_cache=AtomicFileSystemBytecodeCache(
+            str(sc.jinja2_bytecode_cache_dir), pattern='stripped_%s.cache'),
+        extensions=[AssetsExtension, StripIndentationExtension],
         trim_blocks=True,
         lstrip_blocks=True,
     )
@@ -81,6 +138,51 @@ def jinja2_environment():
     __jinja2_environment = env
     return env
 
+def precompile_templates():
+    """Compile every template so that requests don't have to.
+
+    Templates missing from the bytecode cache are compiled and added to
+    it. Returns a list of (template name, seconds) in order of time
+    taken, slowest first.
+    """
+    env = jinja2_environment()
+    timings = []
+    for name in env.list_templates(extensions=('html', 'txt')):
+        start = time.perf_counter()
+        try:
+            env.get_template(name)
+        except jinja2.TemplateSyntaxError as e:
+            logger.error('Failed to compile template {} ({})'.format(name, e))
+            continue
+        except Exception:
+            logger.exception('Failed to compile template {}'.format(name))
+            continue
+        timings.append((name, time.perf_counter() - start))
+    timings.sort(key=lambda t: t[1], reverse=True)
+    logger.info('Compiled {} templates in {:.3f} seconds'.format(
+        len(timings), sum(t[1] for t in timings)))
+    return timings
+
+__templates_version = (0, None)
+def templates_version(timeout=10):
+    """Return (digest, last modified timestamp) of the template files.
+
+    The result is recomputed at most every timeout seconds.
+    """
+    global __templates_version
+    checked, version = __templates_version
+    if version is None or checked < time.time() - timeout:
+        md5 = hashlib.md5()
+        last_modified = 0
+        for path in sorted(sc.templates_dir.glob('**/*')):
+            stat = path.stat()
+            md5.update('{}:{}:{}\n'.format(path, stat.st_mtime_ns,
+                                           stat.st_size).encode())
+            last_modified = max(last_modified, stat.st_mtime)
+        version = (md5.hexdigest(), int(last_modified))
+        __templates_version = (time.time(), version)
+    return version
+
 class NewRelicBrowserTimingProxy:
     """New Relic real user monitoring proxy.
     
@@ -101,6 +203,32 @@ class NewRelicBrowserTimingProxy:
         else:
             return ''
 
+__generation_context = (None, None)
+def generation_context():
+    """Return the template variables which only change with the IMM.
+
+    They are computed once per IMM generation, the menu and its HTML are
+    built by sc.menu when the IMM changes.
+    """
+    global __generation_context
+    imm = scimm.imm()
+    generation, context = __generation_context
+    if generation != imm.generation:
+        context = {
+            'menu': get_menu(),
+            'menu_html': get_menu_html(),
+            'config': config,
+            'development_bar': config.development_bar,
+            'newrelic_browser_timing': NewRelicBrowserTimingProxy(),
+            'page_lang': 'en',
+            'scm': scm,
+            'search_query': '',
+            'no_index': False,
+            'imm': imm,
+        }
+        __generation_context = (imm.generation, context)
+    return context
+
 class ViewContext(dict):
     """A dictionary with easy object-style setters/getters.
 
@@ -131,10 +259,6 @@ class ViewBase:
 
     env = jinja2_environment()
     
-    @property
-    def should_fix_whitespace(self):
-        return not self.template_name.endswith('.txt')
-    
     @property
     def template_name(self):
         """Return the template name for this view."""
@@ -155,41 +279,77 @@ class ViewBase:
         pass
 
     def get_global_context(self):
-        """Return a dictionary of variables accessible by all templates."""
-        nonfree_fonts = config.nonfree_fonts
-        offline = True
-        try:
-            offline = cherrypy.request.offline
-        except AttributeError:
-            offline = True
+        """Return a dictionary of variables accessible by all templates.
 
+        This is the generation context with the variables which depend on
+        the request added.
+        """
+        request = cherrypy.request
+        nonfree_fonts = config.nonfree_fonts
+        offline = getattr(request, 'offline', True)
         if offline:
             if not config.always_nonfree_fonts:
                 nonfree_fonts = False
-                
-        return ViewContext({
-            'menu': get_menu(),
-            'config': config,
+
+        context = ViewContext(generation_context())
+        context.update({
             'current_datetime': datetime.datetime.now(),
-            'development_bar': config.development_bar,
-            'newrelic_browser_timing': NewRelicBrowserTimingProxy(),
             'nonfree_fonts': nonfree_fonts,
             'offline': offline,
-            'page_lang': 'en',
-            'scm': scm,
-            'embed': 'embed' in cherrypy.request.params,
-            'search_query': '',
-            'no_index': False,
-            'imm': sc.scimm.imm(),
-            'ajax': 'ajax' in cherrypy.request.params,
-            'cookies': {m.key: m.value for m in cherrypy.request.cookie.values()}
+            'embed': 'embed' in request.params,
+            'ajax': 'ajax' in request.params,
         })
+        return context
 
-    def massage_whitespace(self, text):
-        return regex.sub(r'\n[ \n\t]+', r'\n', text)
+    # Whether the view answers conditional GETs, see validate().
+    conditional = False
 
-    def render(self):
-        """Return the HTML for this view."""
+    def get_validators(self):
+        """Return (etag parts, last modified timestamp) for this page.
+
+        Everything the page depends on, other than the url, the IMM, the
+        texts and the templates, must be part of the etag parts.
+        """
+        return (), 0
+
+    def validate(self):
+        """Set the ETag and Last-Modified headers of a conditional view.
+
+        If the request's If-None-Match or If-Modified-Since header matches,
+        a 304 is raised, this should be called before any other work.
+        """
+        if not self.conditional or getattr(self, '_validated', False):
+            return
+        self._validated = True
+        # Real user monitoring inserts per request code into the page.
+        if config.newrelic_real_user_monitoring:
+            return
+        request = cherrypy.request
+        response = cherrypy.response
+        parts, last_modified = self.get_validators()
+        # Cached pages are sent gzipped to clients which accept it.
+        if self.use_cache:
+            parts = (parts, self.accepts_gzip())
+        imm = scimm.imm()
+        text_mtime = changes.text_watcher.max_mtime_ns()
+        templates_digest, templates_mtime = templates_version()
+        etag = hashlib.md5(repr((
+            parts, request.path_info, request.query_string,
+            getattr(request, 'offline', True), imm.timestamp, text_mtime,
+            templates_digest, scm.last_commit_revision)).encode()).hexdigest()
+        last_modified = max(last_modified, imm.timestamp,
+                            text_mtime // 1000000000, templates_mtime)
+        response.headers['ETag'] = '"{}"'.format(etag)
+        response.headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(
+            last_modified)
+        cherrypy.lib.cptools.validate_etags()
+        # If-None-Match takes precedence over If-Modified-Since.
+        if 'If-None-Match' not in request.headers:
+            cherrypy.lib.cptools.validate_since()
+
+    def prepare(self):
+        """Return the template and the set up context for this view."""
+        self.validate()
         try:
             template = self.get_template()
         except jinja2.exceptions.TemplateSyntaxError as e:
@@ -204,10 +364,167 @@ class ViewBase:
             raise cherrypy.HTTPError(500, message)
         context = self.get_global_context()
         self.setup_context(context)
-        string = template.render(dict(context))
-        if self.should_fix_whitespace:
-            string = self.massage_whitespace(string)
-        return string
+        return template, dict(context)
+
+    # Whether rendered pages are kept, gzipped, in the page cache.
+    cacheable = False
+
+    def get_cache_key(self):
+        """Return the key of this page variant in the page cache.
+
+        Everything which the page depends on other than what is checked
+        by the validator must be part of the key.
+        """
+        request = cherrypy.request
+        return (type(self).__name__, request.path_info, request.query_string,
+                getattr(request, 'offline', True))
+
+    def get_cache_validator(self):
+        return scimm.imm().generation
+
+    @property
+    def use_cache(self):
+        # Real user monitoring inserts per request code into the page.
+        return self.cacheable and not config.newrelic_real_user_monitoring
+
+    @staticmethod
+    def accepts_gzip():
+        for coding in cherrypy.request.headers.elements('Accept-Encoding'):
+            if coding.value in ('gzip', 'x-gzip', '*') and coding.qvalue > 0:
+                return True
+        return False
+
+    @staticmethod
+    def compress(page):
+        return gzip.compress(page.encode('utf-8'), compresslevel=9)
+
+    def render(self):
+        """Return the HTML for this view."""
+        self.validate()
+        if not self.use_cache:
+            return self.render_uncached()
+        key = self.get_cache_key()
+        validator = self.get_cache_validator()
+        data = text_page_cache.get(key, validator)
+        if data is not None:
+            return gzip.decompress(data).decode('utf-8')
+        page = self.render_uncached()
+        text_page_cache.put(key, validator, self.compress(page))
+        return page
+
+    def render_uncached(self):
+        template, context = self.prepare()
+        return ''.join(self.strip_indentation(template,
+                                              [template.render(context)]))
+
+    @staticmethod
+    def strip_indentation(template, chunks):
+        """Strip the indentation StripIndentationExtension could not.
+
+        That is whitespace following a newline output by an expression
+        or by literal text elsewhere in the template. Since the literal
+        text is already stripped there is seldom anything to remove.
+        """
+        if template.name and template.name.endswith('.txt'):
+            return chunks
+        return util.strip_indentation_chunks(chunks)
+
+    def stream(self):
+        """Return the response body for this view.
+
+        Clients which accept gzip are sent cached pages as they are
+        stored, and pages which aren't cached are gzipped as they are
+        streamed to them. The context is set up before anything is sent,
+        so that errors still result in an error page, and the template is
+        then rendered as the response is written. If stream_responses is
+        off the HTML is returned as a string as by render().
+        """
+        response = cherrypy.response
+        if self.use_cache:
+            response.headers['Vary'] = 'Accept-Encoding'
+        self.validate()
+        if not self.use_cache:
+            if not config.stream_responses:
+                return self.render_uncached()
+            return self.stream_uncached()
+        key = self.get_cache_key()
+        validator = self.get_cache_validator()
+        data = text_page_cache.get(key, validator)
+        gzipped = self.accepts_gzip()
+        if data is None and config.stream_responses:
+            chunks = self.stream_uncached()
+            if gzipped:
+                response.headers['Content-Encoding'] = 'gzip'
+            return self._stream_into_cache(chunks, key, validator, gzipped)
+        if data is None:
+            page = self.render_uncached()
+            data = self.compress(page)
+            text_page_cache.put(key, validator, data)
+            if not gzipped:
+                return page
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+            return data
+        return gzip.decompress(data).decode('utf-8')
+
+    def stream_uncached(self):
+        template, context = self.prepare()
+        cherrypy.response.stream = True
+        return self.strip_indentation(template,
+                                      self.coalesce(template.generate(context)))
+
+    def _stream_into_cache(self, chunks, key, validator, gzipped):
+        """Yield the chunks, then cache the page if it was all sent.
+
+        The page is gzipped as it is sent, if gzipped is true the gzipped
+        data is what is yielded. Pages which get too big for the cache
+        are not kept.
+        """
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        parts = []
+        size = 0
+        for chunk in chunks:
+            if gzipped or parts is not None:
+                data = compressor.compress(chunk.encode('utf-8'))
+                if gzipped:
+                    # Flush, so that the client isn't kept waiting for data
+                    # the compressor is holding on to.
+                    data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield data if gzipped else chunk
+            if parts is not None:
+                parts.append(data)
+                size += len(data)
+                # Don't hold on to pages too big for the cache.
+                if size > text_page_cache.max_bytes:
+                    parts = None
+        if gzipped or parts is not None:
+            data = compressor.flush()
+            if gzipped:
+                yield data
+            if parts is not None:
+                parts.append(data)
+                text_page_cache.put(key, validator, b''.join(parts))
+
+    STREAM_CHUNK_SIZE = 16384
+
+    @classmethod
+    def coalesce(cls, chunks):
+        """Yield the chunks joined into strings of STREAM_CHUNK_SIZE or so.
+
+        Jinja2 generates a chunk for every bit of template data and every
+        expression, which are far too small to write individually.
+        """
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= cls.STREAM_CHUNK_SIZE:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield ''.join(buffer)
 """
 ['__cause__', '__class__', '__context__', '__delattr__', '__dict__',
 '__dir__', '__doc__', '__eq__', '__format__', '__ge__', '__getattribute__',
@@ -291,10 +608,16 @@ class ParallelView(ViewBase):
     """The view for the sutta parallels page."""
 
     template_name = 'parallel'
+    conditional = True
 
     def __init__(self, sutta):
         self.sutta = sutta
 
+    def get_validators(self):
+        # The citation includes the date it was retrieved.
+        today = datetime.date.today()
+        return (today.isoformat(),), int(time.mktime(today.timetuple()))
+
     def setup_context(self, context):
         context.title = "{}: {}".format(
             self.sutta.acronym, self.sutta.name)
@@ -331,26 +654,50 @@ class TextView(ViewBase):
 
     template_name = 'text'
 
-    # Extract the (non-nestable) hgroup element using regex, DOTALL
-    # and non-greedy matching makes this straightforward.
-    content_regex = regex.compile(r'''
-        <body[^>]*>
-        (?<content>.*)
-        </body>
-        ''', flags=regex.DOTALL | regex.VERBOSE)
+    content_regex = textcontent.content_regex
     
     # Note: Links come after section
     links_regex = regex.compile(r'class="(?:next|previous)"')
     
+    cacheable = True
+    conditional = True
+    
     def __init__(self, uid, lang_code, canonical=True):
         self.uid = uid
         self.lang_code = lang_code
         self.canonical = canonical
 
+    def get_cache_key(self):
+        """ Returns the key of this page variant in the page cache
+
+        Everything which the page depends on other than the text file
+        and the IMM (which are checked by the validator) must be part of
+        the key.
+
+        """
+        request = cherrypy.request
+        return (type(self).__name__, self.uid, self.lang_code, self.canonical,
+                'embed' in request.params, 'ajax' in request.params,
+                getattr(request, 'offline', True))
+
+    def stat(self):
+        """Return the stat of the text file or raise cherrypy.NotFound"""
+        if getattr(self, '_stat', None) is None:
+            path = self.path
+            if not path:
+                raise cherrypy.NotFound()
+            self._stat = path.stat()
+        return self._stat
+
+    def get_cache_validator(self):
+        return (self.stat().st_mtime_ns, scimm.imm().generation)
+
+    def get_validators(self):
+        fstat = self.stat()
+        return (fstat.st_mtime_ns, fstat.st_size), int(fstat.st_mtime)
+
     def setup_context(self, context):
-        from sc.tools import html
-        m = self.content_regex.search(self.get_html())
-        m.detach_string() # Free up memory now.
+        content = self.get_content()
         imm = scimm.imm()
 
         context.uid = self.uid
@@ -360,20 +707,21 @@ class TextView(ViewBase):
         
         context.textdata = textdata = imm.get_text_data(self.uid, self.lang_code)
         context.title = textdata.name if textdata else '?'
-        context.text = m['content']
         if context.embed:
-            context.text = self.shorter_text(context.text)
-        context.has_quotes = '‘' in context.text or '“' in context.text
-        try:
-            context.snippet = self.get_snippet(context.text)
-        except Exception as e:
-            logger.error('Failed to generated snippet for {} ({})'.format(self.uid, str(e)))
-            context.snippet = ''
-        # Eliminate newlines from Full-width-glyph languages like Chinese
-        # because they convert into spaces when rendered.
-        # TODO: This check should use 'language' table
-        if self.lang_code in {'zh'}:
-            context.text = self.massage_cjk(context.text)
+            context.text = self.shorter_text(content.text)
+            context.has_quotes = textcontent.has_quotes(context.text)
+            try:
+                context.snippet = util.strip_indentation(
+                    self.get_snippet(context.text))
+            except Exception as e:
+                logger.error('Failed to generated snippet for {} ({})'.format(self.uid, str(e)))
+                context.snippet = ''
+            if content.cjk_text is not None:
+                context.text = self.massage_cjk(context.text)
+        else:
+            context.text = content.cjk_text if content.cjk_text is not None else content.text
+            context.has_quotes = content.has_quotes
+            context.snippet = content.snippet
         context.lang_code = self.lang_code
 
         context.text_refs = []
@@ -416,26 +764,7 @@ class TextView(ViewBase):
                     self.lang_code, self.uid, bookmark))))
         return sc.tools.html.tostring(root, encoding='unicode')
     
-    def get_snippet(self, html, target_len=500):
-        root = sc.tools.html.fromstring(html[:target_len + 2000])
-        for e in root.cssselect('.hgroup'):
-            e.drop_tree()
-        article = root.cssselect('article')[0]
-        parts = []
-        total_len = 0
-        for e in article:
-            if e.tag not in {'p', 'blockquote'}:
-                continue
-            text = e.text_content()
-            parts.append(text)
-            total_len += len(text)
-            if total_len > target_len:
-                break
-
-        text = '   '.join(parts)
-        if len(text) > target_len:
-            text = text[:target_len] + ' …'
-        return text
+    get_snippet = staticmethod(textcontent.get_snippet)
         
     @property
     def path(self):
@@ -452,31 +781,43 @@ class TextView(ViewBase):
         else:
             raise cherrypy.NotFound()
     
-    @staticmethod
-    def massage_cjk(text):
-        def deline(string):
-            return string.replace('\n', '').replace('<p', '\n<p')
-        
-        m = regex.match(r'(?s)(.*?)(<aside[^>]+id="metaarea".*?</aside>)(.*)', text)
-        if m or not m:
-            pre, meta, post = m[1:]
-            return ''.join([deline(pre), meta, deline(post)])
-        return deline(text)
+    def get_content(self):
+        """Return the TextContent of the text
+
+        The pre-extracted content is used if the store has it for the
+        text file as it is now, otherwise the file is read and processed.
+
+        """
+        relative_path = scimm.imm().text_path(self.uid, self.lang_code)
+        fstat = self.stat()
+        content = text_content_store.get(str(relative_path),
+                                         fstat.st_mtime_ns, fstat.st_size)
+        if content is None:
+            content = textcontent.extract_content(self.get_html(),
+                                                  self.lang_code, self.uid)
+        return content
+    
+    massage_cjk = staticmethod(textcontent.massage_cjk)
 
 class TextRawView(TextView):
     def setup_context(self):
         return
     def render(self):
         return self.get_html()
+    def stream(self):
+        return self.render()
 
 class EditView(TextView):
     template_name = 'editor'
+    cacheable = False
+    conditional = False
     def setup_context(self, context):
         context.filename = self.path
         return
 
 class TextSelectionView(TextView):
     template_name = 'paragraph'
+    cacheable = False
     
     def __init__(self, uid, lang_code, targets):
         self.uid = uid
@@ -486,54 +827,51 @@ class TextSelectionView(TextView):
     def setup_context(self, context):
         context.selection = self.extract_selection()
     
+    # Non-whitespace characters of the text are counted for highlighting,
+    # tags are skipped and an entity is one character.
+    highlight_regex = regex.compile(r'<[^>]*>|&[^;\s]*;|\S')
+
+    def get_paragraphs(self, ordinals):
+        """Return the HTML of the paragraphs with the ordinals."""
+        relative_path = scimm.imm().text_path(self.uid, self.lang_code)
+        fstat = self.stat()
+        paragraphs = text_content_store.get_paragraphs(str(relative_path),
+            fstat.st_mtime_ns, fstat.st_size, ordinals)
+        if paragraphs is None:
+            paragraphs = textcontent.extract_paragraphs(self.get_html())
+            paragraphs = [paragraphs[i] for i in ordinals]
+        return paragraphs
+
     def extract_selection(self):
-        from sc.tools import html
-        targets = self.targets
-        root = html.fromstring(self.get_html())
-        id_map = root.id_map()
-        elements = root.cssselect('article > *:not(div), article > div.hgroup, article > div:not(.hgroup) > *');
-        results = []
-        for target in targets.split('+'):
-            
+        targets = []
+        for target in self.targets.split('+'):
             m = regex.match(r'(\d+)(?:\.(\d+)-(\d+))?', target)
-            
-            target_id = int(m[1])
-            char_start = None if m[2] is None else int(m[2])
-            char_end = None if m[3] is None else int(m[3])
-            
-            target_element = elements[target_id]
+            targets.append((int(m[1]),
+                            None if m[2] is None else int(m[2]),
+                            None if m[3] is None else int(m[3])))
+        paragraphs = self.get_paragraphs([t[0] for t in targets])
+        results = []
+        for paragraph, (_, char_start, char_end) in zip(paragraphs, targets):
             if char_start is not None:
-                pos = 0
-                char_rex = regex.compile(r'\S')
-                def inner_callback(m):
-                    nonlocal pos, char_start, char_end
-                    result = m[0]
-                    pos += 1
-                    if pos == char_end:
-                        result = result + '__HLEND__'
-                    if pos == char_start:
-                        result = '__HLSTART__' + result
-                    return result
-                    
-                def callback(text):
-                    nonlocal pos
-                    if pos > char_end:
-                        return text
-                    return char_rex.sub(inner_callback, text)
-
-                target_element.each_text(callback)
-
-            results.append(target_element)
-        result_strings = []
-        last = None
-        for i, element in enumerate(results):
-            if i > 0:
-                if results[i - 1] != last:
-                    result_strings.append('<p>…</p>')
-            result_strings.append(str(element))
-            last = element
-
-        return '\n'.join(result_strings).replace('__HLSTART__', '<span class="marked">').replace('__HLEND__', '</span>')
+                paragraph = self.highlight(paragraph, char_start, char_end)
+            results.append(paragraph)
+        return '\n'.join(results)
+
+    def highlight(self, html, char_start, char_end):
+        """Mark characters char_start to char_end (counting from 1)."""
+        pos = 0
+        def callback(m):
+            nonlocal pos
+            result = m[0]
+            if result[0] == '<' or pos > char_end:
+                return result
+            pos += 1
+            if pos == char_end:
+                result = result + '</span>'
+            if pos == char_start:
+                result = '<span class="marked">' + result
+            return result
+        return self.highlight_regex.sub(callback, html)
         
     
 class SuttaView(TextView):
@@ -561,6 +899,8 @@ class SuttaView(TextView):
 
 class PitakaView(ViewBase):
     template_name = 'pitaka'
+    cacheable = True
+    conditional = True
 
     def __init__(self, pitaka):
         self.pitaka = pitaka
@@ -573,6 +913,8 @@ class DivisionView(ViewBase):
     """Thew view for a division."""
 
     template_name = 'division'
+    cacheable = True
+    conditional = True
 
     def __init__(self, division):
         self.division = division
@@ -601,6 +943,8 @@ class SubdivisionView(ViewBase):
         self.subdivision = subdivision
 
     template_name = 'subdivision'
+    cacheable = True
+    conditional = True
 
     def setup_context(self, context):
         context.title = "{} {}: {} - {}".format(
@@ -620,6 +964,8 @@ class SubdivisionHeadingsView(ViewBase):
     """The view for the list of subdivisions for a division."""
 
     template_name = 'subdivision_headings'
+    cacheable = True
+    conditional = True
 
     def __init__(self, division):
         self.division = division
@@ -724,8 +1070,6 @@ class ShtLookupView(ViewBase):
             raise cherrypy.HTTPRedirect(self.redir_url, 302)
 
 class SuttaCitationView(ViewBase):
-    
-    should_fix_whitespace = False
 
     def __init__(self, sutta):
         self.sutta = sutta
@@ -822,6 +1166,7 @@ class AdminIndexView(InfoView):
         context.data_last_update_request = data_repo.last_update()
         context.data_scm = data_scm
         context.imm_build_time = scimm.imm().build_time
+        context.text_page_cache_stats = text_page_cache.stats()
 
 class UidsView(InfoView):
     
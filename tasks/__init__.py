@@ -17,6 +17,7 @@ collections = [
     'log',
     'newrelic',
     'search',
+    'templates',
     'test',
     'textdata',
     'tmp',
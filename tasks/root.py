@@ -19,6 +19,7 @@ def clean(aggressive=False):
         tasks.dictionary.clean()
         tasks.exports.offline.clean(older=False)
         tasks.search.clean()
+        tasks.templates.clean()
     else:
         tasks.assets.clean(older=True)
         tasks.exports.offline.clean(older=True)
@@ -12,8 +12,27 @@ def delete(index='_all'):
 
 
 @task
-def index():
-    """Create the search index SQLite databases."""
+def index(incremental=False, processes=0):
+    """Create the search index SQLite databases.
+
+    With --incremental only changed files are indexed again. Files are
+    parsed by --processes worker processes, by default one per CPU.
+    """
     blurb(index)
-    import sc.search.texts
-    textsearch.build()
+    from sc import textsearch
+    textsearch.build(incremental=incremental, processes=int(processes))
+
+
+@task
+def benchmark(lang='pi', queries='', repeat=5, processes=0):
+    """Compare fts5 (bm25) and fts4 (rank function) search times."""
+    blurb(benchmark)
+    from sc import textsearch
+    queries = [query.strip() for query in queries.split(',') if query.strip()]
+    results = textsearch.benchmark(lang, queries or None, int(repeat),
+                                   processes=int(processes))
+    for fts, timings in sorted(results.items()):
+        notice(fts)
+        for query, counts, seconds in timings:
+            print('{:>8.1f} ms  {:>6} {:>6}  {}'.format(seconds * 1000,
+                counts[0], counts[1], query))
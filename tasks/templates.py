@@ -0,0 +1,23 @@
+"""Template tasks."""
+
+from tasks.helpers import *
+
+
+@task
+def precompile(verbose=False):
+    """Compile the templates into the bytecode cache."""
+    blurb(precompile)
+    from sc import views
+    timings = views.precompile_templates()
+    if verbose:
+        for name, seconds in timings:
+            print('{:>8.1f} ms  {}'.format(seconds * 1000, name))
+    notice('Compiled {} templates in {:.1f} ms'.format(len(timings),
+        sum(seconds for name, seconds in timings) * 1000))
+
+
+@task
+def clean():
+    """Delete the template bytecode cache."""
+    blurb(clean)
+    rm_rf('db/jinja2/*')
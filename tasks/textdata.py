@@ -1,14 +1,13 @@
 from tasks.helpers import *
 
 @task
-def rebuild():
+def rebuild(processes=0):
     """ Rebuild Text Info Model without causing downtime """
     # This is useful after changes to TextData that require every
-    # entry be updated.
+    # entry be updated. By default one worker process per CPU is used.
     blurb(rebuild)
     import sc.textdata
-    tim = sc.textdata.tim_no_update()
-    tim.build(force=True)
+    sc.textdata.tim_manager.rebuild(processes=int(processes))
 
 @task
 def deletelang(lang):
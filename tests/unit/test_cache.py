@@ -0,0 +1,43 @@
+import sys
+import unittest
+
+from sc.cache import TextPageCache
+
+class TextPageCacheTest(unittest.TestCase):
+
+    page_size = sys.getsizeof('x' * 1000)
+
+    def make_cache(self, pages):
+        return TextPageCache(self.page_size * pages)
+
+    def test_get_put(self):
+        cache = self.make_cache(4)
+        self.assertIsNone(cache.get('a', 1))
+        cache.put('a', 1, 'a' * 1000)
+        self.assertEqual(cache.get('a', 1), 'a' * 1000)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_validator_mismatch(self):
+        cache = self.make_cache(4)
+        cache.put('a', 1, 'a' * 1000)
+        self.assertIsNone(cache.get('a', 2))
+        # The stale page is dropped.
+        self.assertIsNone(cache.get('a', 1))
+
+    def test_byte_budget(self):
+        cache = self.make_cache(3)
+        for key in 'abcd':
+            cache.put(key, 1, key * 1000)
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 3)
+        self.assertLessEqual(stats['bytes'], stats['max_bytes'])
+        self.assertIsNone(cache.get('a', 1))
+
+    def test_scan_does_not_evict_hot_pages(self):
+        cache = self.make_cache(5)
+        cache.put('hot', 1, 'h' * 1000)
+        cache.get('hot', 1)
+        for i in range(20):
+            cache.put(i, 1, str(i % 10) * 1000)
+        self.assertEqual(cache.get('hot', 1), 'h' * 1000)
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sc.changes import Changeset, DirectoryWatcher
+
+class DirectoryWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write('a.html', 'a')
+        self.write(os.path.join('sub', 'b.html'), 'b')
+        self.watcher = DirectoryWatcher(self.root)
+        self.changesets = []
+        self.watcher.subscribe(self.changesets.append)
+        self.watcher.poll()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, relpath, text, mtime=None):
+        path = os.path.join(self.root, relpath)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_initial(self):
+        b = os.path.join('sub', 'b.html')
+        self.assertEqual(self.changesets,
+                         [Changeset({'a.html', b}, set(), set())])
+        self.assertEqual(sorted(self.watcher.stats()), ['a.html', b])
+        self.assertEqual(self.watcher.poll(), Changeset(set(), set(), set()))
+        self.assertEqual(len(self.changesets), 1)
+
+    def test_add(self):
+        c = os.path.join('sub', 'new', 'c.html')
+        self.write(c, 'c')
+        self.assertEqual(self.watcher.poll(), Changeset({c}, set(), set()))
+
+    def test_modify_in_place(self):
+        # Keep the directory mtime, as an in place edit does.
+        dir_mtime_ns = os.stat(self.root).st_mtime_ns
+        self.write('a.html', 'aa', mtime=1000000000)
+        os.utime(self.root, ns=(dir_mtime_ns, dir_mtime_ns))
+        self.assertEqual(self.watcher.poll(),
+                         Changeset(set(), {'a.html'}, set()))
+        self.assertEqual(self.watcher.stats()['a.html'].size, 2)
+        self.assertEqual(self.watcher.max_mtime_ns(),
+                         max(stat.mtime_ns for stat in
+                             self.watcher.stats().values()))
+
+    def test_delete(self):
+        os.unlink(os.path.join(self.root, 'a.html'))
+        shutil.rmtree(os.path.join(self.root, 'sub'))
+        self.assertEqual(self.watcher.poll(), Changeset(
+            set(), set(), {'a.html', os.path.join('sub', 'b.html')}))
+        self.assertEqual(self.watcher.stats(), {})
+        self.assertEqual(self.watcher.max_mtime_ns(), 0)
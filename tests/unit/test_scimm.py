@@ -0,0 +1,404 @@
+import pathlib
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter, defaultdict
+from itertools import chain
+from unittest import mock
+
+import sc
+from sc import scimm, textdata
+from sc.classes import Parallel
+from sc.csv_loader import table_reader
+from sc.textdata import TextInfo, TextInfoModel
+
+tables = {
+    'uid_expansion': ['uid,acro,name',
+                      'sn,SN,Saṃyutta Nikāya',
+                      'dn,DN,Dīgha Nikāya',
+                      'sa,SA,Saṃyukta Āgama'],
+    'pitaka': ['uid,name,always_full',
+               'su,Sutta,'],
+    'sect': ['uid,name',
+             'th,Theravāda'],
+    'language': ['uid,name,iso_code,isroot,priority,search_priority',
+                 'pi,Pali,pi,1,1,1',
+                 'zh,Chinese,zh,1,2,1',
+                 'en,English,en,,10,1'],
+    'external_text': ['sutta_uid,language,abstract,url,priority'],
+    'collection': ['uid,name,abbrev_name,language,sect_uid,pitaka_uid',
+                   'pi-su,Pali Suttas,Pali,pi,th,su',
+                   'zh-su,Chinese Suttas,Chinese,zh,,su'],
+    'division': ['uid,collection_uid,name,alt_name,acronym,subdiv_ind,menu_gwn_ind',
+                 'dn,pi-su,Dīgha Nikāya,,DN,,',
+                 'sn,pi-su,Saṃyutta Nikāya,,SN,,',
+                 'sa,zh-su,Saṃyukta Āgama,,SA,,'],
+    'subdivision': ['uid,division_uid,acronym,name,vagga_numbering_ind',
+                    'sn1,sn,SN 1,Devatā Saṃyutta,',
+                    'sn2,sn,SN 2,Devaputta Saṃyutta,'],
+    'vagga': ['subdivision_uid,number,name'],
+    'sutta': ['uid,acronym,name,language,subdivision_uid,vagga_number,'
+              'number_in_vagga,volpage,biblio_uid',
+              'dn1,DN 1,Brahmajāla,pi,dn,,1,DN i 1,',
+              'dn2,DN 2,Sāmaññaphala,pi,dn,,2,DN i 47,',
+              'sn1.1,SN 1.1,Oghataraṇa,pi,sn1,,1,SN i 1,',
+              'sn1.2,SN 1.2,Nimokkha,pi,sn1,,2,SN i 2,',
+              'sn2.1,SN 2.1,Kassapa,pi,sn2,,1,SN i 45,',
+              'sn2.2,SN 2.2,Dutiyakassapa,pi,sn2,,2,SN i 46,',
+              'sa1,SA 1,無常,zh,sa,,1,T ii 1,',
+              'sa2,SA 2,正思惟,zh,sa,,2,T ii 1,',
+              'sa3,SA 3,無知,zh,sa,,3,T ii 1,'],
+    'biblio': ['uid,name,text'],
+    # sn1.1, dn1 and sa1 are a clique, sa2 links sn1.2 and sn2.1
+    # without them being parallels of each other.
+    'correspondence': ['sutta_uid,other_sutta_uid,partial,footnote',
+                       'sn1.1,dn1,,',
+                       'sn1.1,sa1,,',
+                       'dn1,sa1,,cf. DN 1',
+                       'sn1.2,sa2,,',
+                       'sa2,sn2.1,,',
+                       'sn2.2,sa3,1,partial'],
+    'vinaya_rules': ['uid,volpage_info'],
+    'vinaya_pm': ['name'],
+    'vinaya_kd': ['name'],
+}
+
+epigraphs_xml = ('<epigraphs><epigraph id="1"><uid>sn1.1</uid>'
+                 '<content>How did you cross the flood?</content>'
+                 '<href>/en/sn1.1</href></epigraph></epigraphs>')
+
+def make_tim():
+    tim = TextInfoModel()
+    texts = [
+        ('pi', 'dn1', None, None),
+        ('pi', 'dn2', None, None),
+        ('pi', 'sn1.1', None, None),
+        ('pi', 'sn1.2', None, None),
+        ('pi', 'sn2.1', None, None),
+        # The guesses of the TIM go past the end of the division.
+        ('pi', 'sn2.2', 'sn2.1', 'dn1'),
+        ('en', 'sn1.1', None, 'sn1.2'),
+        ('en', 'sn2.1', 'sn1.1', 'sn2.2'),
+        ('en', 'sn2.2', 'sn2.1', None),
+        # Texts which aren't suttas of the IMM.
+        ('en', 'pi-x1', None, 'pi-x2'),
+        ('en', 'pi-x2', 'pi-x1', None),
+        ('zh', 'sa1', None, 'sa2'),
+        ('zh', 'sa2', 'sa1', None),
+    ]
+    for lang_uid, uid, prev_uid, next_uid in texts:
+        tim.add_text_info(lang_uid, uid, TextInfo(
+            uid=uid, lang=lang_uid, name='{} {}'.format(uid, lang_uid),
+            path='{}/{}.html'.format(lang_uid, uid),
+            prev_uid=prev_uid, next_uid=next_uid))
+    return tim
+
+def reference_parallels(imm):
+    "The parallels of each sutta as they were before the graph, for parity"
+    fulls = defaultdict(set)
+    partials = defaultdict(set)
+    indirects = defaultdict(set)
+    for row in table_reader('correspondence'):
+        if row.partial:
+            partials[row.sutta_uid].add((row.other_sutta_uid, row.footnote))
+            partials[row.other_sutta_uid].add((row.sutta_uid, row.footnote))
+        else:
+            fulls[row.sutta_uid].add((row.other_sutta_uid, row.footnote))
+            fulls[row.other_sutta_uid].add((row.sutta_uid, row.footnote))
+    for uid, parallels in fulls.items():
+        for pid, footnote in parallels:
+            if pid in fulls:
+                indirects[uid].update(fulls[pid])
+    for uid in indirects:
+        indirects[uid] -= set(a for a in indirects[uid] if a[0] == uid)
+
+    out = defaultdict(list)
+    for mapping, partial, indirect in ((fulls, False, False),
+                                       (indirects, False, True),
+                                       (partials, True, False)):
+        for uid, parallels in mapping.items():
+            for p_uid, note in parallels:
+                out[uid].append(Parallel(imm.suttas[p_uid], partial, indirect, note))
+    for parallels in out.values():
+        parallels.sort(key=Parallel.sort_key)
+    return out
+
+def reference_next_prev(imm, tim, uid, lang_uid):
+    "The next and previous texts as they were before the table, for parity"
+    soc = defaultdict(dict)
+    for division in imm.divisions.values():
+        prev = None
+        for sutta in chain(*(sd.suttas for sd in division.subdivisions)):
+            if prev:
+                soc[sutta.uid]['prev'] = prev.uid
+                soc[prev.uid]['next'] = sutta.uid
+            prev = sutta
+    nextdata = None
+    prevdata = None
+    nextprev = soc.get(uid)
+    if nextprev:
+        nextdata = (tim.get(uid=nextprev.get('next'), lang_uid=lang_uid)
+                    if 'next' in nextprev else False)
+        prevdata = (tim.get(uid=nextprev.get('prev'), lang_uid=lang_uid)
+                    if 'prev' in nextprev else False)
+    textdata = tim.get(uid=uid, lang_uid=lang_uid)
+    if textdata:
+        if nextdata is None and textdata.next_uid:
+            nextdata = tim.get(uid=textdata.next_uid, lang_uid=lang_uid)
+        if prevdata is None and textdata.prev_uid:
+            prevdata = tim.get(uid=textdata.prev_uid, lang_uid=lang_uid)
+    return {'next': nextdata, 'prev': prevdata}
+
+class ImmTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = pathlib.Path(tempfile.mkdtemp())
+        (self.root / 'table').mkdir()
+        (self.root / 'db').mkdir()
+        for name, lines in tables.items():
+            self.write_table(name, lines)
+        with (self.root / 'table' / 'epigraphs.xml').open('w', encoding='utf-8') as f:
+            f.write(epigraphs_xml)
+        self.tim = make_tim()
+        for patch in (mock.patch.object(sc, 'data_dir', self.root),
+                      mock.patch.object(sc, 'table_dir', self.root / 'table'),
+                      mock.patch.object(sc, 'db_dir', self.root / 'db'),
+                      mock.patch.object(textdata, 'tim', return_value=self.tim)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.digests = dict({name: 'digest' for name in tables},
+                            epigraphs='digest', __source__='source')
+        self.imm = scimm._Imm(1000, self.digests)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.root))
+
+    def write_table(self, name, lines):
+        with (self.root / 'table' / (name + '.csv')).open('w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def changed(self, **digests):
+        return dict(self.digests, **digests)
+
+    def parallels(self, imm, uid):
+        return [(p.sutta.uid, p.partial, p.indirect, p.footnote)
+                for p in imm.suttas[uid].parallels]
+
+    def assertParallelsParity(self, imm):
+        expected = reference_parallels(imm)
+        for uid, sutta in imm.suttas.items():
+            parallels = list(sutta.parallels)
+            self.assertEqual(len(sutta.parallels), len(expected[uid]), uid)
+            # Parallels which sort the same may be in any order.
+            self.assertEqual([Parallel.sort_key(p) for p in parallels],
+                             [Parallel.sort_key(p) for p in expected[uid]], uid)
+            self.assertEqual(Counter(parallels), Counter(expected[uid]), uid)
+
+class SnapshotTest(ImmTestCase):
+
+    def snapshot_files(self):
+        return sorted((self.root / 'db').glob(scimm.snapshot_name_tmpl.format('*')))
+
+    def test_round_trip(self):
+        scimm.save_snapshot(self.imm)
+        self.assertEqual(self.snapshot_files(), [
+            self.root / 'db' / scimm.snapshot_name_tmpl.format(self.imm.key)])
+        loaded = scimm.load_snapshot(self.imm.key, 'source')
+        self.assertIsNot(loaded, self.imm)
+        self.assertEqual(list(loaded.suttas), list(self.imm.suttas))
+        self.assertEqual(list(loaded.divisions), list(self.imm.divisions))
+        for uid in self.imm.suttas:
+            self.assertEqual(self.parallels(loaded, uid), self.parallels(self.imm, uid))
+            self.assertIs(loaded.suttas[uid].imm, loaded)
+        self.assertEqual((loaded.key, loaded.timestamp, loaded.table_digests),
+                         (self.imm.key, self.imm.timestamp, self.imm.table_digests))
+        # The TIM isn't saved, the loaded IMM is given the current one.
+        self.assertIs(loaded.tim, self.tim)
+        self.assertEqual(loaded.next_prev, self.imm.next_prev)
+        self.assertGreater(loaded.generation, self.imm.generation)
+
+    def test_other_key(self):
+        scimm.save_snapshot(self.imm)
+        # Served while an IMM for the new tables is built.
+        loaded = scimm.load_snapshot('newer tables', 'source')
+        self.assertEqual(loaded.key, self.imm.key)
+
+    def test_replaces_older(self):
+        scimm.save_snapshot(self.imm)
+        imm = scimm._Imm(2000, self.changed(sutta='changed'))
+        scimm.save_snapshot(imm)
+        self.assertEqual(self.snapshot_files(), [
+            self.root / 'db' / scimm.snapshot_name_tmpl.format(imm.key)])
+        self.assertEqual(scimm.load_snapshot(imm.key, 'source').timestamp, 2000)
+
+    def test_stale_source(self):
+        scimm.save_snapshot(self.imm)
+        self.assertIsNone(scimm.load_snapshot(self.imm.key, 'changed source'))
+        self.assertEqual(self.snapshot_files(), [])
+
+    def check_rejected(self, data):
+        file = self.root / 'db' / scimm.snapshot_name_tmpl.format(self.imm.key)
+        with file.open('wb') as f:
+            f.write(data)
+        self.assertIsNone(scimm.load_snapshot(self.imm.key, 'source'))
+        self.assertEqual(self.snapshot_files(), [])
+
+    def test_wrong_format(self):
+        self.check_rejected(pickle.dumps((scimm.snapshot_format + 1, 'source'))
+                            + pickle.dumps(None))
+
+    def test_no_header(self):
+        self.check_rejected(pickle.dumps(self.imm))
+
+    def test_truncated(self):
+        scimm.save_snapshot(self.imm)
+        file = self.snapshot_files()[0]
+        with file.open('rb') as f:
+            data = f.read()
+        self.check_rejected(data[:len(data) // 2])
+
+class PhasesTest(ImmTestCase):
+
+    def test_affected_phases(self):
+        imm = self.imm
+        self.assertEqual(imm.get_affected_phases(self.digests), [])
+        self.assertEqual(imm.get_affected_phases(self.changed(correspondence='x')),
+                         ['build_parallels'])
+        self.assertEqual(imm.get_affected_phases(self.changed(biblio='x')),
+                         ['load_biblios'])
+        self.assertEqual(imm.get_affected_phases(self.changed(vinaya_kd='x')),
+                         ['build_parallel_sutta_groups'])
+        self.assertEqual(imm.get_affected_phases(self.changed(biblio='x', epigraphs='y')),
+                         ['load_biblios', 'load_epigraphs'])
+        # A table which appears or disappears is a change.
+        self.assertEqual(imm.get_affected_phases(self.changed(biblio=None)),
+                         ['load_biblios'])
+        digests = self.changed()
+        del digests['epigraphs']
+        self.assertEqual(imm.get_affected_phases(digests), ['load_epigraphs'])
+        # Phases which can't be rerun, or which depend on those.
+        for name in ('sutta', 'division', 'vinaya_rules', '__source__'):
+            self.assertIsNone(imm.get_affected_phases(self.changed(**{name: 'x'})), name)
+
+    def test_update(self):
+        imm = self.imm
+        generation = imm.generation
+        self.write_table('correspondence', tables['correspondence'] + ['sn1.2,dn2,,'])
+        digests = self.changed(correspondence='x')
+        imm.update(imm.get_affected_phases(digests), 2000, digests)
+        self.assertIn(('dn2', False, False, ''), self.parallels(imm, 'sn1.2'))
+        self.assertParallelsParity(imm)
+        self.assertEqual((imm.timestamp, imm.table_digests), (2000, digests))
+        self.assertEqual(imm.key, scimm.table_digests_key(digests))
+        self.assertGreater(imm.generation, generation)
+
+    def test_update_rolled_back(self):
+        imm = self.imm
+        before = dict(imm.__dict__)
+        sn1_2 = self.parallels(imm, 'sn1.2')
+        self.write_table('correspondence', tables['correspondence'] + ['sn1.2,dn2,,'])
+        digests = self.changed(correspondence='x', epigraphs='x')
+        phases = imm.get_affected_phases(digests)
+        self.assertEqual(phases, ['build_parallels', 'load_epigraphs'])
+        with mock.patch.object(scimm._Imm, 'load_epigraphs',
+                               side_effect=ValueError('bad epigraph')):
+            with self.assertRaises(ValueError):
+                imm.update(phases, 2000, digests)
+        # The parallels built by the first phase are undone.
+        self.assertEqual(imm.__dict__, before)
+        self.assertIs(imm.parallel_graph, before['parallel_graph'])
+        self.assertEqual(self.parallels(imm, 'sn1.2'), sn1_2)
+
+class ParallelGraphTest(ImmTestCase):
+
+    def test_parallels(self):
+        imm = self.imm
+        self.assertParallelsParity(imm)
+        # The clique, every member is a full and an indirect parallel of
+        # the others, through the third.
+        self.assertEqual(sorted(self.parallels(imm, 'sn1.1')), [
+            ('dn1', False, False, ''), ('dn1', False, True, 'cf. DN 1'),
+            ('sa1', False, False, ''), ('sa1', False, True, 'cf. DN 1')])
+        # Through sa2, which isn't an indirect parallel of itself.
+        self.assertEqual(sorted(self.parallels(imm, 'sn1.2')), [
+            ('sa2', False, False, ''), ('sn2.1', False, True, '')])
+        self.assertEqual(self.parallels(imm, 'sa2'), [
+            ('sn1.2', False, False, ''), ('sn2.1', False, False, '')])
+        self.assertEqual(self.parallels(imm, 'sn2.2'), [('sa3', True, False, 'partial')])
+        self.assertEqual(self.parallels(imm, 'dn2'), [])
+
+    def test_view(self):
+        parallels = self.imm.suttas['sn1.1'].parallels
+        self.assertEqual(len(parallels), 4)
+        self.assertEqual(self.imm.suttas['sn1.1'].parallels_count, 4)
+        self.assertEqual(parallels[-1], parallels[3])
+        self.assertEqual(parallels[1:3], list(parallels)[1:3])
+        with self.assertRaises(IndexError):
+            parallels[4]
+        with self.assertRaises(IndexError):
+            parallels[-5]
+        # Full before indirect, pali before chinese.
+        self.assertEqual([p.sutta.lang.uid for p in parallels], ['pi', 'pi', 'zh', 'zh'])
+        self.assertEqual(len(self.imm.suttas['dn2'].parallels), 0)
+
+    def test_random_tables(self):
+        rng = random.Random(0)
+        uids = list(self.imm.suttas)
+        for i in range(50):
+            rows = set()
+            for j in range(rng.randint(0, 3)):
+                clique = rng.sample(uids, rng.randint(2, 5))
+                for a in clique:
+                    for b in clique:
+                        if a < b:
+                            rows.add((a, b, '', rng.choice(['', '', 'n1'])))
+            for j in range(rng.randint(0, 6)):
+                a, b = rng.sample(uids, 2)
+                rows.add((a, b, rng.choice(['', '1']), rng.choice(['', 'n2'])))
+            self.write_table('correspondence', tables['correspondence'][:1] +
+                             [','.join(row) for row in sorted(rows)])
+            self.imm.build_parallels()
+            self.assertParallelsParity(self.imm)
+
+class NextPrevTest(ImmTestCase):
+
+    def next_prev(self, uid, lang_uid):
+        out = self.imm.get_next_prev(uid, lang_uid)
+        return tuple(out[key].uid if out[key] else None for key in ('prev', 'next'))
+
+    def test_boundaries(self):
+        # From one subdivision into the next.
+        self.assertEqual(self.next_prev('sn1.2', 'pi'), ('sn1.1', 'sn2.1'))
+        self.assertEqual(self.next_prev('sn2.1', 'pi'), ('sn1.2', 'sn2.2'))
+        # But not beyond the division, whatever the TIM guessed.
+        self.assertEqual(self.next_prev('sn2.2', 'pi'), ('sn2.1', None))
+        self.assertEqual(self.next_prev('dn1', 'pi'), (None, 'dn2'))
+        self.assertEqual(self.next_prev('dn2', 'pi'), ('dn1', None))
+        self.assertEqual(self.next_prev('sa1', 'zh'), (None, 'sa2'))
+        # A missing translation falls back on the TIM's guesses.
+        self.assertEqual(self.next_prev('sn1.1', 'en'), (None, None))
+        self.assertEqual(self.next_prev('sn2.1', 'en'), ('sn1.1', 'sn2.2'))
+        # Texts which aren't suttas use the TIM's order.
+        self.assertEqual(self.next_prev('pi-x1', 'en'), (None, 'pi-x2'))
+        self.assertEqual(self.next_prev('pi-x2', 'en'), ('pi-x1', None))
+        self.assertEqual(self.next_prev('sn1.1', 'de'), (None, None))
+
+    def test_same_as_reference(self):
+        for lang_uid in self.tim.get_langs():
+            for uid in self.tim.get(lang_uid=lang_uid):
+                expected = reference_next_prev(self.imm, self.tim, uid, lang_uid)
+                self.assertEqual(self.next_prev(uid, lang_uid),
+                                 tuple(expected[key].uid if expected[key] else None
+                                       for key in ('prev', 'next')), (uid, lang_uid))
+
+    def test_set_tim(self):
+        tim = make_tim()
+        tim.add_text_info('en', 'sn1.2', TextInfo(uid='sn1.2', lang='en', name='sn1.2'))
+        generation = self.imm.generation
+        self.imm.set_tim(tim)
+        self.assertIs(self.imm.tim, tim)
+        self.assertGreater(self.imm.generation, generation)
+        self.assertEqual(self.next_prev('sn1.2', 'en'), ('sn1.1', 'sn2.1'))
+        self.assertEqual(self.next_prev('sn1.1', 'en'), (None, 'sn1.2'))
@@ -0,0 +1,190 @@
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import sc
+from sc.changes import DirectoryWatcher
+from sc.textcontent import (TextContentStore, extract_content,
+                            extract_paragraphs)
+
+class TextContentStoreTest(unittest.TestCase):
+
+    texts = {
+        'en/sn1.1': ['Crossing the Flood', '“How did you cross the flood?”',
+                     'Not halting, not straining.'],
+        'en/sn1.2': ['Emancipation', 'Do you know emancipation?'],
+        'zh/sa1': ['無常', '如是我聞\n一時佛住',
+                   '<aside id="metaarea">\nTranslated\n</aside>'],
+    }
+
+    def setUp(self):
+        self.root = pathlib.Path(tempfile.mkdtemp())
+        (self.root / 'db').mkdir()
+        # Changed by the tests.
+        self.texts = dict(self.texts)
+        for name, paragraphs in self.texts.items():
+            self.write(name, paragraphs)
+        self.watcher = DirectoryWatcher(self.root / 'text')
+        for patch in (mock.patch.object(sc, 'text_dir', self.root / 'text'),
+                      mock.patch.object(sc.changes, 'text_watcher', self.watcher)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.watcher.poll()
+        self.store = TextContentStore(self.root / 'db')
+
+    def tearDown(self):
+        shutil.rmtree(str(self.root))
+
+    def write(self, name, paragraphs):
+        path = self.root / 'text' / (name + '.html')
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        title, *paragraphs = paragraphs
+        with path.open('w', encoding='utf-8') as f:
+            f.write('<html><head></head><body><article>'
+                    '<div class="hgroup"><h1>{}</h1></div>\n{}\n'
+                    '</article></body></html>'.format(title, '\n'.join(
+                        '<p>{}</p>'.format(p) for p in paragraphs)))
+
+    def relpath(self, name):
+        return os.path.join(*name.split('/')) + '.html'
+
+    def read(self, store, name):
+        relpath = self.relpath(name)
+        fstat = self.watcher.stats()[relpath]
+        return (store.get(relpath, fstat.mtime_ns, fstat.size),
+                store.get_paragraphs(relpath, fstat.mtime_ns, fstat.size,
+                                     range(len(self.texts[name]))))
+
+    def expected(self, name):
+        with (self.root / 'text' / self.relpath(name)).open(encoding='utf-8') as f:
+            html = f.read()
+        return (extract_content(html, name.split('/')[0]),
+                extract_paragraphs(html))
+
+    def assertCurrent(self, store):
+        self.assertEqual(len(store), len(self.texts))
+        for name in self.texts:
+            self.assertEqual(self.read(store, name), self.expected(name))
+
+    def change(self, name, paragraphs):
+        self.texts[name] = paragraphs
+        self.write(name, paragraphs)
+        self.watcher.poll()
+
+    def test_round_trip(self):
+        self.assertEqual(self.store.update(), 3)
+        self.assertCurrent(self.store)
+        content, paragraphs = self.read(self.store, 'zh/sa1')
+        self.assertIsNotNone(content.cjk_text)
+        self.assertIn('如是我聞一時佛住', content.cjk_text)
+        self.assertIn('\nTranslated\n', content.cjk_text)
+        content, paragraphs = self.read(self.store, 'en/sn1.1')
+        self.assertTrue(content.has_quotes)
+        self.assertIsNone(content.cjk_text)
+        self.assertIn('How did you cross the flood?', content.snippet)
+        self.assertEqual(self.store.update(), 0)
+
+    def test_paragraphs(self):
+        self.store.update()
+        relpath = self.relpath('en/sn1.1')
+        fstat = self.watcher.stats()[relpath]
+        paragraphs = self.expected('en/sn1.1')[1]
+        self.assertEqual(len(paragraphs), 3)
+        get = lambda ordinals: self.store.get_paragraphs(
+            relpath, fstat.mtime_ns, fstat.size, ordinals)
+        self.assertEqual(get([2, 0]), [paragraphs[2], paragraphs[0]])
+        self.assertEqual(get([-1]), [paragraphs[-1]])
+        self.assertEqual(get([]), [])
+        with self.assertRaises(IndexError):
+            get([3])
+        with self.assertRaises(IndexError):
+            get([-4])
+
+    def test_stale(self):
+        self.store.update()
+        relpath = self.relpath('en/sn1.2')
+        fstat = self.watcher.stats()[relpath]
+        self.assertIsNone(self.store.get(relpath, fstat.mtime_ns + 1, fstat.size))
+        self.assertIsNone(self.store.get_paragraphs(relpath, fstat.mtime_ns,
+                                                    fstat.size + 1, [0]))
+        self.assertIsNone(self.store.get(self.relpath('en/sn1.3'), 0, 0))
+
+    def test_update(self):
+        self.store.update()
+        self.change('en/sn1.2', ['Liberation', 'Do you know liberation?',
+                                 'I know it, friend.'])
+        self.texts['en/sn1.3'] = ['Reaching an End', 'Life is swept along.']
+        self.write('en/sn1.3', self.texts['en/sn1.3'])
+        del self.texts['zh/sa1']
+        (self.root / 'text' / self.relpath('zh/sa1')).unlink()
+        self.watcher.poll()
+        self.assertEqual(self.store.update(), 2)
+        self.assertCurrent(self.store)
+        self.assertIsNone(self.store.get(self.relpath('zh/sa1'), 0, 0))
+        # Reloaded from disk by a fresh store.
+        store = TextContentStore(self.root / 'db')
+        self.assertTrue(store.reload())
+        self.assertCurrent(store)
+
+    def test_compaction(self):
+        self.store.update()
+        data_ino = self.store.data_path.stat().st_ino
+        sizes = []
+        # Each change leaves a dead record, until more than half of the
+        # data file is dead and it is rewritten.
+        for i in range(1, 10):
+            self.change('en/sn1.1', ['Crossing the Flood',
+                                     'Not halting {}.'.format('x' * 100 * i)])
+            self.store.update()
+            self.assertCurrent(self.store)
+            sizes.append(self.store.data_path.stat().st_size)
+            if len(sizes) > 1 and sizes[-1] < sizes[-2]:
+                break
+        else:
+            self.fail('The data file was never rewritten')
+        self.assertNotEqual(self.store.data_path.stat().st_ino, data_ino)
+        live = sum(entry[1] + entry[2] for entry in self.store._state[1].values())
+        self.assertEqual(sizes[-1], live)
+        # And is appended to again afterwards.
+        self.change('en/sn1.2', ['Emancipation', 'Do you know it?'])
+        self.store.update()
+        self.assertGreater(self.store.data_path.stat().st_size, live)
+        self.assertCurrent(self.store)
+
+    def test_reload_after_replace(self):
+        self.store.update()
+        # Another process, which only reads the store.
+        reader = TextContentStore(self.root / 'db')
+        self.assertTrue(reader.reload())
+        self.assertFalse(reader.reload())
+        old_texts = dict(self.texts)
+        old = {name: self.expected(name) for name in old_texts}
+        old_stats = dict(self.watcher.stats())
+        data_ino = self.store.data_path.stat().st_ino
+        for i in range(1, 10):
+            self.change('en/sn1.2', ['Emancipation',
+                                     'Do you know {}?'.format('y' * 200 * i)])
+            self.store.update()
+            if self.store.data_path.stat().st_ino != data_ino:
+                break
+        else:
+            self.fail('The data file was never rewritten')
+        # Until it reloads the reader keeps reading its old data file.
+        for name in old_texts:
+            relpath = self.relpath(name)
+            fstat = old_stats[relpath]
+            self.assertEqual(reader.get(relpath, fstat.mtime_ns, fstat.size),
+                             old[name][0])
+        self.assertTrue(reader.reload())
+        self.assertCurrent(reader)
+
+    def test_obsolete_removed(self):
+        obsolete = self.root / 'db' / TextContentStore.data_name_tmpl.format('old')
+        obsolete.touch()
+        self.store.update()
+        self.assertFalse(obsolete.exists())
+        self.assertCurrent(self.store)
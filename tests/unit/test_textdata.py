@@ -0,0 +1,338 @@
+import pathlib
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import sc
+import sc.util
+from sc.changes import DirectoryWatcher
+from sc.tools import html
+from sc.textdata import (PaliPageNumbinator, SqliteBackedTIM, TextInfo,
+                         TextInfoModel, TIMManager)
+
+def reference_pts_ref(rows, pid):
+    "The lookup as it was before the concordance was bisected, for parity"
+    ppn = PaliPageNumbinator([])
+    mapping = {(msbook, int(msnum), edition): (book, page)
+               for msbook, msnum, edition, book, page in rows}
+    msbook, msnum = ppn.parse_pid(pid)
+    for i in PaliPageNumbinator.default_attempts:
+        n = msnum + i
+        if n < 1:
+            continue
+        for edition in ('pts1', 'pts2'):
+            if (msbook, n, edition) in mapping:
+                book, page = mapping[(msbook, n, edition)]
+                return ppn.format_book(ppn.msbook_to_ptsbook(msbook), book, page)
+    return None
+
+class PaliPageNumbinatorTest(unittest.TestCase):
+
+    def assertParity(self, rows, pids):
+        ppn = PaliPageNumbinator(rows)
+        expected = [reference_pts_ref(rows, pid) for pid in pids]
+        self.assertEqual([ppn.get_pts_ref_from_pid(pid) for pid in pids],
+                         expected)
+        self.assertEqual(ppn.get_pts_refs_from_pids(pids), expected)
+        shuffled = list(zip(pids, expected))
+        random.Random(1).shuffle(shuffled)
+        self.assertEqual(ppn.get_pts_refs_from_pids([t[0] for t in shuffled]),
+                         [t[1] for t in shuffled])
+
+    def test_synthetic(self):
+        rng = random.Random(0)
+        rows = []
+        for msbook in ('1d', '2m', '3a', '5kh'):
+            for msnum in rng.sample(range(0, 400), 60):
+                for edition in rng.sample(['pts1', 'pts2', 'vri'], rng.randint(1, 3)):
+                    rows.append((msbook, str(msnum), edition,
+                                 rng.choice(['', '1', '2', '3']),
+                                 str(rng.randint(1, 500))))
+        pids = ['p_{}_{}'.format(msbook, msnum)
+                for msbook in ('1D', '2m', '3a', '5kh', '4s')
+                for msnum in range(0, 420)]
+        self.assertParity(rows, pids)
+
+    @unittest.skipUnless((sc.table_dir / 'pali_concord.csv').exists(),
+                         'No pali concordance')
+    def test_concord(self):
+        from sc.scimm import table_reader
+        rows = list(table_reader('pali_concord'))
+        msbooks = sorted({row[0] for row in rows})
+        pids = ['p_{}_{}'.format(msbook, msnum)
+                for msbook in msbooks for msnum in range(0, 2000, 7)]
+        self.assertParity(rows, pids)
+
+class UnpublishedTIMManager(TIMManager):
+    set_count = 0
+
+    def _set_instance(self, instance):
+        # Without handing it to the IMM, which isn't loaded.
+        self.instance = instance
+        self.set_count += 1
+        self.ready.set()
+
+class TextsTestCase(unittest.TestCase):
+
+    texts = {
+        'en/sn/sn1.1': 'Crossing the Flood',
+        'en/sn/sn1.2': 'Emancipation',
+        'en/sn/sn1.3': 'Reaching an End',
+        'de/sn/sn1.1': 'Die Flut',
+    }
+
+    def setUp(self):
+        self.root = pathlib.Path(tempfile.mkdtemp())
+        (self.root / 'db').mkdir()
+        for name, title in self.texts.items():
+            self.write(name, title)
+        watcher = DirectoryWatcher(self.root / 'text')
+        for patch in (mock.patch.object(sc, 'text_dir', self.root / 'text'),
+                      mock.patch.object(sc, 'db_dir', self.root / 'db'),
+                      mock.patch.object(sc.changes, 'text_watcher', watcher)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        watcher.poll()
+
+    def tearDown(self):
+        shutil.rmtree(str(self.root))
+
+    def write(self, name, title):
+        path = self.root / 'text' / (name + '.html')
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        uid = name.split('/')[-1]
+        with path.open('w', encoding='utf-8') as f:
+            f.write('<html><head><meta author="Someone"></head><body>'
+                    '<section class="sutta" id="{0}"><div class="hgroup">'
+                    '<h1>{1}</h1></div><p>Text of {0}.</p></section>'
+                    '</body></html>'.format(uid, title))
+
+    def path(self, name):
+        return self.root / 'text' / (name + '.html')
+
+    def entries(self, tim):
+        return {lang_uid: {uid: repr(textinfo) for uid, textinfo
+                           in tim.get(lang_uid=lang_uid).items()}
+                for lang_uid in tim.get_langs()}
+
+    def fresh(self):
+        tim = TextInfoModel()
+        tim.build()
+        return tim
+
+class TIMManagerTest(TextsTestCase):
+
+    def update(self, manager):
+        sc.changes.text_watcher.poll()
+        manager._load_pickle(False)
+
+    def load(self):
+        manager = UnpublishedTIMManager()
+        manager._load_pickle(True)
+        return manager
+
+    def db_files(self):
+        return sorted(file.suffix for file in (self.root / 'db').iterdir())
+
+    def test_journal_replay(self):
+        manager = UnpublishedTIMManager()
+        manager._load_pickle(False)
+        self.assertEqual(self.db_files(), ['.pickle'])
+        self.write('en/sn/sn1.2', 'Liberation')
+        self.update(manager)
+        # Renamed
+        self.path('en/sn/sn1.3').rename(self.path('en/sn/sn1.4'))
+        self.write('en/sn/sn1.4', 'Reaching an End')
+        self.path('de/sn/sn1.1').unlink()
+        self.update(manager)
+        self.assertEqual(manager.journal_length, 4)
+        self.assertEqual(self.db_files(), ['.journal', '.pickle'])
+
+        expected = self.entries(self.fresh())
+        self.assertEqual(self.entries(manager.instance), expected)
+        self.assertNotIn('sn1.3', expected['en'])
+        self.assertNotIn('de', expected)
+        self.assertEqual(expected['en']['sn1.2'],
+                         repr(manager.instance.get('sn1.2', 'en')))
+        self.assertEqual(manager.instance.get('sn1.2', 'en').name, 'Liberation')
+
+        loaded = self.load()
+        self.assertEqual(loaded.journal_length, 4)
+        self.assertEqual(self.entries(loaded.instance), expected)
+        loaded._load_pickle(False)
+        self.assertEqual(loaded.journal_length, 4)
+
+    def test_partial_journal_entry(self):
+        manager = UnpublishedTIMManager()
+        manager._load_pickle(False)
+        self.path('en/sn/sn1.2').unlink()
+        self.update(manager)
+        journal_file = next((self.root / 'db').glob('*.journal'))
+        with journal_file.open('ab') as f:
+            f.write(pickle.dumps([('delete', 'en/sn/sn1.1.html')])[:-3])
+        loaded = self.load()
+        self.assertEqual(loaded.journal_length, 1)
+        self.assertEqual(self.entries(loaded.instance), self.entries(self.fresh()))
+
+    def test_snapshot_rewritten(self):
+        manager = UnpublishedTIMManager()
+        manager.JOURNAL_MAX = 1
+        manager._load_pickle(False)
+        self.path('en/sn/sn1.2').unlink()
+        self.update(manager)
+        self.assertEqual(manager.journal_length, 1)
+        self.path('en/sn/sn1.3').rename(self.path('en/sn/sn1.5'))
+        self.update(manager)
+        self.assertEqual(manager.journal_length, 0)
+        self.assertEqual(self.db_files(), ['.pickle'])
+        loaded = self.load()
+        self.assertEqual(self.entries(loaded.instance), self.entries(self.fresh()))
+        self.assertEqual(sorted(loaded.instance.get(lang_uid='en')),
+                         ['sn1.1', 'sn1.5'])
+
+class SqliteBackedTIMTest(TextsTestCase):
+
+    texts = dict(TextsTestCase.texts, **{
+        'en/sn/sn1.4': 'Time Flies By',
+        'en/sn/sn1.8-10': 'Three Suttas',
+        'en/dn/dn1': 'The All-embracing Net of Views',
+        'de/sn/sn1.2': 'Befreiung',
+    })
+
+    def assertSame(self, tim, expected):
+        self.assertEqual(self.entries(tim), self.entries(expected))
+        self.assertEqual(sorted(tim.get_langs()), sorted(expected.get_langs()))
+        for lang_uid in expected.get_langs():
+            self.assertEqual(
+                {uid: repr(textinfo) for uid, textinfo
+                 in tim.get_nav_entries(lang_uid).items()},
+                {uid: repr(TextInfo(uid=textinfo.uid, lang=textinfo.lang,
+                                    bookmark=textinfo.bookmark, name=textinfo.name,
+                                    prev_uid=textinfo.prev_uid, next_uid=textinfo.next_uid))
+                 for uid, textinfo in expected.get_nav_entries(lang_uid).items()})
+            for uid in expected.get(lang_uid=lang_uid):
+                self.assertEqual(repr(tim.get(uid, lang_uid)),
+                                 repr(expected.get(uid, lang_uid)))
+                self.assertEqual({lang: repr(textinfo) for lang, textinfo
+                                  in tim.get(uid=uid).items()},
+                                 {lang: repr(textinfo) for lang, textinfo
+                                  in expected.get(uid=uid).items()})
+
+    def test_same_as_dict(self):
+        tim = SqliteBackedTIM(self.root / 'db' / 'tim.sqlite')
+        tim.build()
+        expected = self.fresh()
+        self.assertIn('sn1.9', expected.get(lang_uid='en'))
+        self.assertSame(tim, expected)
+
+        self.write('en/sn/sn1.2', 'Liberation')
+        self.path('en/sn/sn1.3').rename(self.path('en/sn/sn1.5'))
+        self.write('en/sn/sn1.5', 'Reaching an End')
+        self.path('de/sn/sn1.1').unlink()
+        self.write('en/sn/sn1.6', 'Old Age')
+        sc.changes.text_watcher.poll()
+        self.assertEqual(len(tim.build()), 5)
+        self.assertSame(tim, self.fresh())
+        self.assertEqual(tim.build(), [])
+
+    def test_other_process_changes(self):
+        db_file = self.root / 'db' / TIMManager.sqlite_name_tmpl.format(
+            TIMManager().get_db_key())
+        updater = UnpublishedTIMManager()
+        updater._load_sqlite(False)
+        other = UnpublishedTIMManager()
+        other._load_sqlite(False)
+        self.assertEqual((updater.set_count, other.set_count), (1, 1))
+        other._load_sqlite(False)
+        self.assertEqual(other.set_count, 1)
+
+        self.write('en/sn/sn1.2', 'Liberation')
+        sc.changes.text_watcher.poll()
+        updater._load_sqlite(False)
+        self.assertEqual(updater.set_count, 2)
+        # While the database is locked, as if being updated.
+        with sc.util.filelock(str(db_file) + '.lock'):
+            other._load_sqlite(False)
+        self.assertEqual(other.set_count, 2)
+        self.assertEqual(other.instance.get('sn1.2', 'en').name, 'Liberation')
+        updater._load_sqlite(False)
+        other._load_sqlite(False)
+        self.assertEqual((updater.set_count, other.set_count), (2, 2))
+
+class ExtractFileTest(TextsTestCase):
+
+    def write_long(self, name, *parts):
+        """ Write a text of several chunks, with parts at the offsets """
+        head = ('<html><head><meta author="Someone"></head><body>'
+                '<section class="sutta" id="x"><div class="hgroup">'
+                '<h1>1. Long</h1></div>')
+        chunks = [head]
+        for offset, part in sorted(parts):
+            size = offset - len(''.join(chunks)) - len('<p></p>')
+            chunks.append('<p>{}</p>'.format('x' * size))
+            chunks.append(part)
+        chunks.append('<p>{}</p></section></body></html>'.format(
+            'x' * TextInfoModel.HEAD_CHUNK_SIZE))
+        path = self.path(name)
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        with path.open('w', encoding='ascii') as f:
+            f.write(''.join(chunks))
+
+    def extract(self, name):
+        tim = TextInfoModel()
+        lang_uid = name.split('/')[0]
+        record = tim.extract_file(self.path(name), lang_uid)
+        return (repr(record.textinfo), [repr(t) for t in record.embedded])
+
+    def assertFullParse(self, name, expected):
+        """ Check the extract matches a full parse, which is needed or not """
+        with mock.patch.object(html, 'parse', wraps=html.parse) as parse:
+            extract = self.extract(name)
+        self.assertEqual(parse.called, expected, name)
+        with mock.patch.object(html, 'has_pull_parser', False):
+            self.assertEqual(extract, self.extract(name), name)
+
+    @unittest.skipUnless(html.has_pull_parser, 'No pull parser')
+    def test_same_as_full_parse(self):
+        chunk = TextInfoModel.HEAD_CHUNK_SIZE
+        self.write_long('en/sn/sn9.1')
+        self.assertFullParse('en/sn/sn9.1', False)
+        # The volpage anchor is past the first chunk.
+        self.write_long('zh/sa/sa9', (chunk * 2, '<a class="t" id="ii1a1"></a>'))
+        self.assertFullParse('zh/sa/sa9', False)
+        self.write_long('en/sn/sn9.2', (chunk * 3, '<p data-uid="sn9.2a" id="a">A</p>'))
+        self.assertFullParse('en/sn/sn9.2', True)
+        # Split between two chunks.
+        self.write_long('en/sn/sn9.3', (chunk * 2 - 20,
+                        '<div class="embeddedparallel" id="b">B</div>'))
+        self.assertFullParse('en/sn/sn9.3', True)
+        self.write_long('en/sn/sn9.4', (chunk + 100, '</section>'),
+                        (chunk * 3 - 10, '<section class="sutta" id="c">'))
+        self.assertFullParse('en/sn/sn9.4', True)
+        self.write('en/sn/sn9.5', 'Short')
+        self.assertFullParse('en/sn/sn9.5', True)
+
+class RebuildTaskTest(TextsTestCase):
+
+    def rebuild(self, tim_backend):
+        from tasks import textdata
+        with mock.patch.dict(sc.config['app'], {'tim_backend': tim_backend}):
+            # As given on the command line.
+            textdata.rebuild(processes='2')
+
+    def test_pickle(self):
+        self.rebuild('pickle')
+        manager = UnpublishedTIMManager()
+        manager._load_pickle(True)
+        self.assertEqual(self.entries(manager.instance), self.entries(self.fresh()))
+
+    def test_sqlite(self):
+        self.rebuild('sqlite')
+        tim = SqliteBackedTIM(self.root / 'db' / TIMManager.sqlite_name_tmpl.format(
+            TIMManager().get_db_key()))
+        self.assertEqual(self.entries(tim), self.entries(self.fresh()))
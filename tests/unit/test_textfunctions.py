@@ -0,0 +1,32 @@
+import unittest
+
+from sc.textfunctions import DeletionIndex, edit_distance
+
+class EditDistanceTest(unittest.TestCase):
+
+    def test_edits(self):
+        self.assertEqual(edit_distance('nibbana', 'nibbana'), 0)
+        self.assertEqual(edit_distance('nibbana', 'nibana'), 1)
+        self.assertEqual(edit_distance('nibbana', 'nibbanna'), 1)
+        self.assertEqual(edit_distance('nibbana', 'nibbona'), 1)
+        self.assertEqual(edit_distance('nibbana', 'nibbnaa'), 1)
+        self.assertEqual(edit_distance('dhamma', 'damam'), 2)
+
+    def test_max_distance(self):
+        self.assertEqual(edit_distance('dhamma', 'bhikkhu', 1), 2)
+        self.assertEqual(edit_distance('a', 'abcdef', 2), 3)
+
+class DeletionIndexTest(unittest.TestCase):
+
+    words = ['nibbana', 'nibbanam', 'nibbanasukha', 'dhamma', 'dhammo',
+             'damma', 'bhikkhu', 'bhikkhave', 'anicca']
+
+    def test_lookup_matches_brute_force(self):
+        index = DeletionIndex(self.words)
+        for query in ['nibana', 'nibbanasukah', 'nibbanasukhaa', 'dhama',
+                      'dhamam', 'bikkhu', 'bhikkhve', 'anica', 'xyz',
+                      'nibbaan', 'ibbana']:
+            expected = sorted((edit_distance(query, word, 1), word)
+                              for word in self.words
+                              if edit_distance(query, word, 1) <= 1)
+            self.assertEqual(index.lookup(query), expected, query)
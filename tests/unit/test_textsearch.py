@@ -0,0 +1,267 @@
+import os
+import pathlib
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import lxml.html
+
+import sc
+import sc.textfunctions
+from sc import declensions
+from sc.changes import DirectoryWatcher
+from sc.textfunctions import mangle
+from sc.textsearch import (EnglishTextSearch, PaliStemFilter, PaliTextSearch,
+                           fts5_available, fts5_query)
+
+def reference_stem(stemmer, text, query=False):
+    "The stemmer as it was before it was compiled, for parity"
+    if query:
+        indeclineables = stemmer.qindeclineables
+        suffixes = stemmer.qsuffixes
+    else:
+        indeclineables = stemmer.indeclineables
+        suffixes = stemmer.suffixes
+
+    pieces = stemmer.tokenizer.split(text)
+    for place, token in enumerate(pieces):
+        if place % 2 == 1 or not token or not token[0].isalpha():
+            continue
+        if token not in indeclineables:
+            for skt, pli in stemmer.sanskrit_to_pali:
+                token = token.replace(skt, pli)
+            if token[:-1] == 'n':
+                token = token[:-1] + 'ṃ'
+            for i in range(min(7, int(len(token)/2 - 0.5)), 0, -1):
+                sfx = token[-i:]
+                if sfx in suffixes:
+                    token = token[:-i]
+                    break
+        pieces[place] = token
+    return "".join(pieces)
+
+def reference_match_count(searcher, e_query, s_query):
+    "The match count as it was before it was counted in SQL, for parity"
+    e_query, s_query = searcher.match_query(e_query), searcher.match_query(s_query)
+    exacts = set(t[0] for t in searcher.execute('SELECT rowid FROM original WHERE original MATCH ?', (e_query,)).fetchall()) if e_query else set()
+    stemmed = set(t[0] for t in searcher.execute('SELECT rowid FROM stemmed WHERE stemmed MATCH ?', (s_query,))) if s_query else frozenset()
+    stemmed -= exacts
+    return (len(exacts), len(stemmed))
+
+class PaliStemFilterTest(unittest.TestCase):
+
+    stemmer = PaliStemFilter()
+    stemmer.tokenizer = PaliTextSearch.rex_tokenizer
+
+    def assertParity(self, text):
+        for query in (False, True):
+            self.assertEqual(self.stemmer(text, query),
+                             reference_stem(self.stemmer, text, query))
+
+    def test_endings(self):
+        stems = ['dhamm', 'bhikkh', 'nibbān', 'nirv', 'karm', 'n', 'sā',
+                 'gacch', 'buddh', 'a']
+        for stem in stems:
+            for ending in sorted(declensions.endings):
+                self.assertParity('{0}{1} {0}{1}, 1{1}'.format(stem, ending))
+        self.assertParity(' '.join(declensions.indeclineables))
+
+    def test_stem_tokens(self):
+        tokens = ['dhammo', '', '1a', 'bhikkhave', 'ca']
+        self.assertEqual(self.stemmer.stem_tokens(tokens),
+                         [self.stemmer(token) for token in tokens])
+
+    @unittest.skipUnless((sc.text_dir / 'pi').exists(), 'No pali texts')
+    def test_corpus(self):
+        files = sorted((sc.text_dir / 'pi').glob('**/*.html'))
+        for file in files:
+            with file.open('r', encoding='utf-8') as f:
+                text = lxml.html.fromstring(f.read()).text_content()
+            self.assertParity(mangle(text))
+
+@unittest.skipUnless(fts5_available(), 'SQLite has no fts5')
+class Fts5QueryTest(unittest.TestCase):
+
+    texts = ['dhamma samana', 'dhammā samana bhikkhu', 'dhamma bhikkhu',
+             'samana x y z dhamma', 'bhikkhu y', 'dhammo']
+
+    def setUp(self):
+        self.con = sqlite3.connect(':memory:')
+        self.con.execute("CREATE VIRTUAL TABLE t5 USING fts5(text, tokenize='ascii')")
+        self.con.execute('CREATE VIRTUAL TABLE t4 USING fts4(text, tokenize=simple)')
+        for i, text in enumerate(self.texts, 1):
+            self.con.execute('INSERT INTO t5 (rowid, text) VALUES (?, ?)', (i, text))
+            self.con.execute('INSERT INTO t4 (docid, text) VALUES (?, ?)', (i, text))
+
+    def tearDown(self):
+        self.con.close()
+
+    def match(self, query):
+        return {row[0] for row in self.con.execute(
+            'SELECT rowid FROM t5 WHERE t5 MATCH ?', (fts5_query(query),))}
+
+    def match_fts4(self, query):
+        return {row[0] for row in self.con.execute(
+            'SELECT docid FROM t4 WHERE t4 MATCH ?', (query,))}
+
+    def test_same_as_fts4(self):
+        for query in ['dhamma', 'dhamma samana', 'dhamma OR dhammo',
+                      'dhamma NEAR samana', 'dhamma NEAR/1 bhikkhu',
+                      'samana NEAR/3 dhamma', 'x NEAR/1 y NEAR/1 z',
+                      '"dhamma samana"', 'dham*', 'dhamma, samana']:
+            self.assertEqual(self.match(query), self.match_fts4(query), query)
+
+    def test_or_groups(self):
+        # OR binds more tightly than the implicit AND, as in the fts4
+        # standard syntax (the enhanced syntax sqlite may be built with
+        # differs, so fts4 isn't asked).
+        self.assertEqual(self.match('dhamma OR dhammā samana'), {1, 2, 4})
+        self.assertEqual(self.match('samana dhamma OR dhammā'), {1, 2, 4})
+        self.assertEqual(self.match('dhamma OR dhammo bhikkhu OR y'), {3, 4})
+        self.assertEqual(self.match('bhikkhu dhamma OR dhammā OR dhammo samana'),
+                         {2})
+        self.assertEqual(self.match('samana dhamma NEAR/1 bhikkhu OR z'), {4})
+
+    def test_excluded(self):
+        self.assertEqual(self.match('samana -bhikkhu'), {1, 4})
+        self.assertEqual(self.match('dhamma OR dhammā samana -x'), {1, 2})
+        self.assertEqual(self.match('samana -x -bhikkhu'), {1})
+
+    def test_nothing_to_match(self):
+        self.assertEqual(fts5_query('-dhamma'), '')
+        self.assertEqual(fts5_query('-dhamma -samana'), '')
+        self.assertEqual(fts5_query(''), '')
+
+class SearchDbTest(unittest.TestCase):
+
+    texts = {
+        'a/x1': 'The monk went for alms. Suffering arises.',
+        # The same file uid as a/x1.
+        'b/x1': 'A nun listened to the teaching on suffering.',
+        'a/x2': 'The monks rejoiced in what the Buddha said.',
+        'a/x3': 'Mindfulness of breathing, when developed, is of great fruit.',
+    }
+
+    queries = ['monk', 'suffering', 'teaching', 'buddha', 'breathing',
+               '"great fruit"', 'mindful*', 'nun']
+
+    def setUp(self):
+        self.root = pathlib.Path(tempfile.mkdtemp())
+        for name, text in self.texts.items():
+            self.write(name, text)
+        watcher = DirectoryWatcher(self.root / 'text')
+        for patch in (mock.patch.object(sc, 'text_dir', self.root / 'text'),
+                      mock.patch.object(sc, 'db_dir', self.root),
+                      mock.patch.object(sc.changes, 'text_watcher', watcher)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.root))
+
+    def write(self, name, text):
+        path = self.root / 'text' / 'en' / (name + '.html')
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        uid = name.split('/')[-1]
+        with path.open('w', encoding='utf-8') as f:
+            f.write('<html><body><section class="sutta" id="{0}">'
+                    '<div class="hgroup"><h1 id="{0}">{0}</h1></div>'
+                    '<p>{1}</p></section></body></html>'.format(uid, text))
+
+    def remove(self, name):
+        (self.root / 'text' / 'en' / (name + '.html')).unlink()
+
+    def searcher(self, fts, name):
+        searcher = EnglishTextSearch('en')
+        searcher.fts = fts
+        searcher.db_path = self.root / '{}_{}.sqlite'.format(name, fts)
+        return searcher
+
+    def contents(self, searcher):
+        con = sqlite3.connect(str(searcher.db_path))
+        try:
+            out = {table: con.execute('SELECT count(*) FROM {}'.format(table)).fetchone()[0]
+                   for table in ('entries', 'files', 'stemmed', 'original')}
+            out['terms'] = con.execute('SELECT original, freq FROM terms ORDER BY original').fetchall()
+            out['files'] = con.execute('SELECT path FROM files ORDER BY path').fetchall()
+            out['entries'] = con.execute('SELECT file, uid, heading, text FROM entries '
+                                         'ORDER BY file, uid, text').fetchall()
+        finally:
+            con.close()
+        return out
+
+    def results(self, searcher, query):
+        e_query, s_query = searcher.prepare_query(query)
+        return (searcher.get_match_count(e_query, s_query),
+                sorted(tuple(row)[:4] for row in searcher.search_exact(e_query, limit=100)),
+                sorted(tuple(row)[:4] for row in searcher.search_stemmed(e_query, s_query, limit=100)))
+
+    def check_update(self, fts):
+        updated = self.searcher(fts, 'updated')
+        updated.generate_search_db()
+        self.remove('b/x1')
+        self.write('a/x2', 'The monks were delighted with what the Buddha said.')
+        sc.changes.text_watcher.poll()
+        self.assertEqual(updated.update_search_db(), 2)
+        self.write('b/x1', 'A nun listened again to the teaching.')
+        sc.changes.text_watcher.poll()
+        self.assertEqual(updated.update_search_db(), 1)
+        self.assertEqual(updated.update_search_db(), 0)
+        generated = self.searcher(fts, 'generated')
+        generated.generate_search_db()
+        self.assertEqual(self.contents(updated), self.contents(generated))
+        for query in self.queries:
+            self.assertEqual(self.results(updated, query),
+                             self.results(generated, query), query)
+
+    def test_update_fts4(self):
+        self.check_update('fts4')
+
+    @unittest.skipUnless(fts5_available(), 'SQLite has no fts5')
+    def test_update_fts5(self):
+        self.check_update('fts5')
+
+    @unittest.skipUnless(fts5_available(), 'SQLite has no fts5')
+    def test_fts4_same_as_fts5(self):
+        fts4 = self.searcher('fts4', 'generated')
+        fts4.generate_search_db()
+        fts5 = self.searcher('fts5', 'generated')
+        fts5.generate_search_db()
+        for query in self.queries:
+            self.assertEqual(self.results(fts4, query), self.results(fts5, query), query)
+
+    def check_match_count(self, fts):
+        searcher = self.searcher(fts, 'generated')
+        searcher.generate_search_db()
+        queries = self.queries + ['monk buddha', 'monk OR nun', 'suffering -nun',
+                                  '"what the buddha"', '"monks rejoiced" teaching',
+                                  'nothing']
+        for query in queries:
+            e_query, s_query = searcher.prepare_query(query)
+            for args in ((e_query, s_query), ('', s_query), (e_query, '')):
+                self.assertEqual(searcher.get_match_count(*args),
+                                 reference_match_count(searcher, *args), (query, args))
+
+    def test_match_count_fts4(self):
+        self.check_match_count('fts4')
+
+    @unittest.skipUnless(fts5_available(), 'SQLite has no fts5')
+    def test_match_count_fts5(self):
+        self.check_match_count('fts5')
+
+    def test_regenerated_when_stems_change(self):
+        searcher = self.searcher('fts4', 'updated')
+        searcher.generate_search_db()
+        self.assertEqual(searcher.update_search_db(), 0)
+        self.assertIn(declensions.__file__, searcher.db_key_modules)
+        self.assertIn(sc.textfunctions.__file__, searcher.db_key_modules)
+        changed = self.root / 'declensions.py'
+        shutil.copyfile(declensions.__file__, str(changed))
+        with changed.open('a') as f:
+            f.write('\n# Changed\n')
+        searcher.db_key_modules = tuple(str(changed) if path == declensions.__file__
+                                        else path for path in searcher.db_key_modules)
+        self.assertIsNone(searcher.update_search_db())
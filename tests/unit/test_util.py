@@ -1,5 +1,6 @@
 import datetime
 import pytz
+import random
 import unittest
 
 from sc import util
@@ -66,6 +67,16 @@ class UnitsTest(unittest.TestCase):
         data2 = self.sortdata2
         self.assertEqual(data2, sorted(data2, key=util.humansortkey))
 
+    def test_strip_indentation_chunks(self):
+        rng = random.Random(0)
+        for i in range(200):
+            text = ''.join(rng.choice(['a', ' ', '\n', '\t', '<p>'])
+                           for j in range(rng.randint(0, 40)))
+            cuts = sorted(rng.randint(0, len(text)) for j in range(rng.randint(0, 5)))
+            chunks = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+            self.assertEqual(''.join(util.strip_indentation_chunks(chunks)),
+                             util.strip_indentation(text), repr(chunks))
+
     def test_recursive_merge(self):
         from copy import deepcopy
         
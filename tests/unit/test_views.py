@@ -0,0 +1,396 @@
+import gzip
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import cherrypy
+import jinja2
+import jinja2.ext
+import jinja2.nodes
+import regex
+from cherrypy._cprequest import Request, Response
+from cherrypy.lib import httputil
+
+import sc
+from sc import menu, views
+from sc.cache import TextPageCache
+
+class ConditionalView(views.ViewBase):
+    conditional = True
+    validators = (('part',), 0)
+
+    def get_validators(self):
+        return self.validators
+
+class CachedConditionalView(ConditionalView):
+    cacheable = True
+
+def reference_massage_whitespace(text):
+    "The whitespace removal as it was applied to every page, for parity"
+    return regex.sub(r'\n[ \n\t]+', r'\n', text)
+
+class AnyUndefined(jinja2.Undefined):
+    """ A value for every variable, which renders as a word """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self
+
+    def __getitem__(self, key):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __str__(self):
+        return 'value'
+
+class TruthyUndefined(AnyUndefined):
+    """ Like AnyUndefined but true, and a sequence of one """
+    __slots__ = ()
+
+    def __bool__(self):
+        return True
+
+    def __iter__(self):
+        yield self
+
+    def __len__(self):
+        return 1
+
+class AssetsStubExtension(jinja2.ext.Extension):
+    """ Renders the body of {% assets %} blocks, without webassets """
+    tags = {'assets'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        while parser.stream.current.type != 'block_end':
+            parser.parse_expression()
+            parser.stream.skip_if('comma')
+        body = parser.parse_statements(['name:endassets'], drop_needle=True)
+        return jinja2.nodes.CallBlock(self.call_method('_render'),
+            [jinja2.nodes.Name('ASSET_URL', 'param')], [], body).set_lineno(lineno)
+
+    def _render(self, caller):
+        return caller('/asset')
+
+class ViewTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.imm = mock.Mock(timestamp=1000000000, generation=1)
+        self.text_watcher = mock.Mock()
+        self.text_watcher.max_mtime_ns.return_value = 1100000000 * 10**9
+        self.config = mock.Mock(newrelic_real_user_monitoring=False)
+        self.scm = mock.Mock(last_commit_revision='abc')
+        for patch in (mock.patch.object(views.scimm, 'imm', return_value=self.imm),
+                      mock.patch.object(views.changes, 'text_watcher', self.text_watcher),
+                      mock.patch.object(views, 'templates_version',
+                                        return_value=('digest', 1050000000)),
+                      mock.patch.object(views, 'config', self.config),
+                      mock.patch.object(views, 'scm', self.scm)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def request(self, headers={}, method='GET', path='/sn1.1', query_string=''):
+        request = Request(httputil.Host('127.0.0.1', 80),
+                          httputil.Host('127.0.0.1', 10000))
+        request.method = method
+        request.path_info = path
+        request.query_string = query_string
+        request.headers = httputil.HeaderMap()
+        request.headers.update(headers)
+        cherrypy.serving.request = request
+        cherrypy.serving.response = Response()
+
+class ValidateTest(ViewTestCase):
+
+    def validate(self, view=None, **kwargs):
+        """ Validate a request, returns the response headers """
+        self.request(**kwargs)
+        (view or ConditionalView()).validate()
+        return cherrypy.serving.response.headers
+
+    def assertNotModified(self, **kwargs):
+        with self.assertRaises(cherrypy.HTTPRedirect) as cm:
+            self.validate(**kwargs)
+        self.assertEqual(cm.exception.status, 304)
+
+    def test_headers(self):
+        headers = self.validate()
+        self.assertRegex(headers['ETag'], r'^"[0-9a-f]{32}"$')
+        # The newest of the IMM, texts, templates and the view's own.
+        self.assertEqual(headers['Last-Modified'], httputil.HTTPDate(1100000000))
+        view = ConditionalView()
+        view.validators = ((), 1200000000)
+        self.assertEqual(self.validate(view)['Last-Modified'],
+                         httputil.HTTPDate(1200000000))
+        self.assertEqual(self.validate()['ETag'], headers['ETag'])
+
+    def test_not_conditional(self):
+        headers = self.validate(views.ViewBase())
+        self.assertNotIn('ETag', headers)
+        self.assertNotIn('Last-Modified', headers)
+
+    def test_real_user_monitoring(self):
+        self.config.newrelic_real_user_monitoring = True
+        headers = self.validate()
+        self.assertNotIn('ETag', headers)
+        self.assertNotIn('Last-Modified', headers)
+
+    def test_if_none_match(self):
+        etag = self.validate()['ETag']
+        self.assertNotModified(headers={'If-None-Match': etag})
+        self.assertNotModified(headers={'If-None-Match': '"other", ' + etag})
+        self.assertNotModified(headers={'If-None-Match': etag}, method='HEAD')
+        self.validate(headers={'If-None-Match': '"other"'})
+
+    def test_etag_changes(self):
+        etag = self.validate()['ETag']
+        changes = [
+            lambda: setattr(self.imm, 'timestamp', self.imm.timestamp + 1),
+            lambda: self.text_watcher.max_mtime_ns.configure_mock(
+                return_value=self.text_watcher.max_mtime_ns() + 1),
+            lambda: views.templates_version.configure_mock(
+                return_value=('other digest', 1050000000)),
+            lambda: setattr(self.scm, 'last_commit_revision', 'def'),
+        ]
+        for change in changes:
+            change()
+            headers = self.validate(headers={'If-None-Match': etag})
+            self.assertNotEqual(headers['ETag'], etag)
+            etag = headers['ETag']
+        for kwargs in ({'path': '/sn1.2'}, {'query_string': 'lang=de'}):
+            self.assertNotEqual(self.validate(**kwargs)['ETag'], etag)
+        view = ConditionalView()
+        view.validators = (('other part',), 0)
+        self.assertNotEqual(self.validate(view)['ETag'], etag)
+
+    def test_etag_varies_with_gzip(self):
+        gzip_headers = {'Accept-Encoding': 'gzip, deflate'}
+        etag = self.validate(CachedConditionalView())['ETag']
+        gzip_etag = self.validate(CachedConditionalView(), headers=gzip_headers)['ETag']
+        self.assertNotEqual(etag, gzip_etag)
+        self.assertNotModified(view=CachedConditionalView(),
+            headers=dict(gzip_headers, **{'If-None-Match': gzip_etag}))
+        self.validate(CachedConditionalView(), headers={'If-None-Match': gzip_etag})
+
+    def test_if_modified_since(self):
+        last_modified = self.validate()['Last-Modified']
+        self.assertNotModified(headers={'If-Modified-Since': last_modified})
+        self.validate(headers={'If-Modified-Since': httputil.HTTPDate(1000000000)})
+        # If-None-Match takes precedence.
+        self.validate(headers={'If-Modified-Since': last_modified,
+                               'If-None-Match': '"other"'})
+
+    def test_validated_once(self):
+        view = ConditionalView()
+        etag = self.validate(view)['ETag']
+        self.validate(view, headers={'If-None-Match': etag})
+
+    def test_not_modified_before_rendering(self):
+        etag = self.validate(CachedConditionalView())['ETag']
+        for method in ('render', 'stream'):
+            view = CachedConditionalView()
+            view.get_template = mock.Mock()
+            view.get_cache_key = mock.Mock()
+            self.request(headers={'If-None-Match': etag})
+            with self.assertRaises(cherrypy.HTTPRedirect):
+                getattr(view, method)()
+            self.assertFalse(view.get_template.called)
+            self.assertFalse(view.get_cache_key.called)
+
+class PageView(views.ViewBase):
+    cacheable = True
+    env = jinja2.Environment(extensions=[views.StripIndentationExtension])
+    source = """
+        <ul>
+        {% for i in range(count) %}
+            <li>
+                {{ i }}{% if i % 7 %}
+                    odd{% endif %}
+            </li>
+        {% endfor %}
+        </ul>"""
+
+    def get_template(self):
+        return self.env.from_string(self.source)
+
+    def get_global_context(self):
+        return views.ViewContext(count=3000)
+
+class UncachedPageView(PageView):
+    cacheable = False
+
+class StreamTest(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config.stream_responses = True
+        self.cache = TextPageCache(10 * 1024 * 1024)
+        patch = mock.patch.object(views, 'text_page_cache', self.cache)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.request()
+        self.page = UncachedPageView().render()
+        self.assertGreater(len(self.page), views.ViewBase.STREAM_CHUNK_SIZE * 3)
+        self.assertNotIn('\n ', self.page)
+
+    def stream(self, view, gzipped):
+        self.request(headers={'Accept-Encoding': 'gzip'} if gzipped else {})
+        body = view.stream()
+        if not isinstance(body, (str, bytes)):
+            body = list(body)
+            self.assertTrue(cherrypy.serving.response.stream)
+            self.assertGreater(len(body), 1)
+            body = body[0][:0].join(body)
+        encoding = cherrypy.serving.response.headers.get('Content-Encoding')
+        self.assertEqual(encoding, 'gzip' if gzipped else None)
+        return gzip.decompress(body).decode('utf-8') if gzipped else body
+
+    def test_gzipped(self):
+        self.assertEqual(self.stream(PageView(), True), self.page)
+        self.assertEqual(self.cache.stats()['entries'], 1)
+        # From the cache.
+        self.assertEqual(self.stream(PageView(), True), self.page)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.stream(PageView(), False), self.page)
+        self.request()
+        self.assertEqual(PageView().render(), self.page)
+
+    def test_not_gzipped(self):
+        self.assertEqual(self.stream(PageView(), False), self.page)
+        # Gzipped as it was streamed.
+        data = self.cache.get(PageView().get_cache_key(), self.imm.generation)
+        self.assertEqual(gzip.decompress(data).decode('utf-8'), self.page)
+        self.assertEqual(self.stream(PageView(), True), self.page)
+
+    def test_uncached(self):
+        self.assertEqual(self.stream(UncachedPageView(), False), self.page)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_not_streamed(self):
+        self.config.stream_responses = False
+        self.assertEqual(self.stream(PageView(), True), self.page)
+        self.assertEqual(self.stream(UncachedPageView(), False), self.page)
+
+class GenerationContextTest(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.imm.collections = {}
+        self.render_menu = mock.Mock(side_effect=lambda menu: '<nav></nav>')
+        for patch in (mock.patch.object(menu, 'render_menu', self.render_menu),
+                      mock.patch.object(menu, '_menu', menu._CachedMenu(None, None, None)),
+                      mock.patch.dict(views.__dict__, {'__generation_context': (None, None)})):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def publish(self, generation):
+        self.imm = mock.Mock(timestamp=1000000000, generation=generation, collections={})
+        views.scimm.imm.return_value = self.imm
+        views.scimm._publish(self.imm)
+
+    def test_reused(self):
+        context = views.generation_context()
+        self.assertIs(context['imm'], self.imm)
+        self.assertIs(views.generation_context(), context)
+        self.assertIs(views.get_menu_html(), context['menu_html'])
+        self.assertIs(views.get_menu(), context['menu'])
+        self.assertEqual(self.render_menu.call_count, 1)
+
+    def test_rebuilt_when_published(self):
+        context = views.generation_context()
+        self.publish(2)
+        # The menu is rebuilt by the thread publishing the IMM.
+        self.assertEqual(self.render_menu.call_count, 2)
+        new_context = views.generation_context()
+        self.assertIsNot(new_context, context)
+        self.assertIs(new_context['imm'], self.imm)
+        self.assertIsNot(new_context['menu'], context['menu'])
+        self.assertIs(views.generation_context(), new_context)
+        self.assertEqual(self.render_menu.call_count, 2)
+        # Republishing the same generation changes nothing.
+        views.scimm._publish(self.imm)
+        self.assertIs(views.generation_context(), new_context)
+
+class TemplatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = pathlib.Path(tempfile.mkdtemp())
+        for patch in (mock.patch.object(sc, 'jinja2_bytecode_cache_dir', self.root),
+                      mock.patch.object(views, 'AssetsExtension', AssetsStubExtension),
+                      mock.patch.object(views.assets, 'get_env', return_value=None),
+                      mock.patch.dict(views.__dict__, {'__jinja2_environment': None})):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.root))
+
+    def test_bytecode_cache(self):
+        env = views.jinja2_environment()
+        cache = env.bytecode_cache
+        template = env.get_template('macros.html')
+        files = list(self.root.iterdir())
+        self.assertEqual(len(files), 1)
+        # Loaded from the cache.
+        env.cache.clear()
+        with mock.patch.object(env, 'compile', side_effect=AssertionError):
+            self.assertIsNot(env.get_template('macros.html'), template)
+        # A failed write leaves the cached file alone.
+        bucket = cache.get_bucket(env, 'macros.html', template.filename,
+                                  env.loader.get_source(env, 'macros.html')[0])
+        with mock.patch.object(bucket, 'write_bytecode', side_effect=OSError):
+            with self.assertRaises(OSError):
+                cache.dump_bytecode(bucket)
+        self.assertEqual(list(self.root.iterdir()), files)
+        env.cache.clear()
+        with mock.patch.object(env, 'compile', side_effect=AssertionError):
+            env.get_template('macros.html')
+
+    def test_precompile_errors(self):
+        env = views.jinja2_environment()
+        get_template = env.get_template
+        def failing(name, *args, **kwargs):
+            if name == 'about.html':
+                raise UnicodeDecodeError('utf-8', b'', 0, 1, 'bad')
+            if name == 'home.html':
+                raise jinja2.TemplateSyntaxError('bad', 1)
+            return get_template(name, *args, **kwargs)
+        with mock.patch.object(env, 'get_template', side_effect=failing):
+            names = [name for name, seconds in views.precompile_templates()]
+        self.assertNotIn('about.html', names)
+        self.assertNotIn('home.html', names)
+        self.assertIn('text.html', names)
+
+    def test_same_as_massage_whitespace(self):
+        env = views.jinja2_environment()
+        reference = jinja2.Environment(loader=env.loader,
+            extensions=[AssetsStubExtension], trim_blocks=True, lstrip_blocks=True)
+        reference.filters.update(env.filters)
+        rendered = 0
+        for undefined in (AnyUndefined, TruthyUndefined):
+            env.undefined = reference.undefined = undefined
+            env.cache.clear()
+            reference.cache.clear()
+            for name in env.list_templates(extensions=('html',)):
+                try:
+                    expected = reference_massage_whitespace(
+                        reference.get_template(name).render())
+                except Exception:
+                    # Needs a real context.
+                    continue
+                template = env.get_template(name)
+                page = template.render()
+                self.assertEqual(''.join(views.ViewBase.strip_indentation(
+                    template, [page])), expected, name)
+                # Split as when streamed.
+                chunks = [page[i:i + 100] for i in range(0, len(page), 100)]
+                self.assertEqual(''.join(views.ViewBase.strip_indentation(
+                    template, chunks)), expected, name)
+                rendered += 1
+        self.assertGreater(rendered, 20)